@@ -5,3 +5,6 @@ CREATE TABLE IF NOT EXISTS users_rate_tb (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
+
+-- The rating counters and their trigger are created by the server when it
+-- first connects (server/helpers/db_helpers.py).
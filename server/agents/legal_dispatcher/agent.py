@@ -1,24 +1,121 @@
+import asyncio
+import hashlib
 import typing
 
 from google.adk.agents import LlmAgent
+from google.adk.events import Event
 from google.adk.sessions import (
     BaseSessionService,
     DatabaseSessionService,
     Session,
 )
+from google.adk.sessions.base_session_service import GetSessionConfig
 from google.adk.runners import Runner
 
+from helpers.metrics import timed
+
+from .callbacks import prepare_llm_request
 from .subagents.civil_cause.agent import root_agent as civil_law_agent
 from .subagents.consumer_cause.agent import root_agent as consumer_law_agent
 from .subagents.worker_cause.agent import root_agent as worker_law_agent
 
 
+class ThreadedDatabaseSessionService(DatabaseSessionService):
+    """
+    A DatabaseSessionService that keeps the event loop free.
+
+    ADK's methods are coroutines in name only: they run their SQLAlchemy
+    queries synchronously, so one slow query would stall every request the
+    worker is serving. Each call runs on a worker thread instead, in a loop
+    of its own, which is enough since those coroutines never suspend.
+
+    With `max_events` set, sessions are loaded with only that many recent
+    events, including the loads the runner makes, so each turn reads a
+    bounded number of rows however long the conversation gets.
+    """
+
+    def __init__(
+            self,
+            db_url: str,
+            max_events: int | None = None,
+            **kwargs: typing.Any,
+    ):
+        super().__init__(db_url, **kwargs)
+        self.max_events = max_events
+
+    async def create_session(self, *args, **kwargs) -> Session:
+        return await asyncio.to_thread(
+            asyncio.run,
+            super().create_session(*args, **kwargs),
+        )
+
+    async def get_session(self, *args, **kwargs) -> typing.Optional[Session]:
+        if kwargs.get("config") is None and self.max_events:
+            kwargs["config"] = GetSessionConfig(
+                num_recent_events=self.max_events,
+            )
+
+        return await asyncio.to_thread(
+            asyncio.run,
+            super().get_session(*args, **kwargs),
+        )
+
+    async def list_sessions(self, *args, **kwargs):
+        return await asyncio.to_thread(
+            asyncio.run,
+            super().list_sessions(*args, **kwargs),
+        )
+
+    async def delete_session(self, *args, **kwargs) -> None:
+        return await asyncio.to_thread(
+            asyncio.run,
+            super().delete_session(*args, **kwargs),
+        )
+
+    async def append_event(self, *args, **kwargs) -> Event:
+        return await asyncio.to_thread(
+            asyncio.run,
+            super().append_event(*args, **kwargs),
+        )
+
+
 async def instantiate_database_session_service(
         db_url: str,
+        pool_size: int = 5,
+        max_overflow: int = 10,
+        pool_recycle: int = 1800,
+        pool_pre_ping: bool = True,
+        max_events: int | None = None,
 ) -> DatabaseSessionService:
-    return DatabaseSessionService(db_url)
+    # Every keyword argument is forwarded to SQLAlchemy's create_engine, so
+    # the service owns a single engine (and connection pool) for its lifetime.
+    # Creating it also creates the tables, so that runs on a thread too.
+    return await asyncio.to_thread(
+        ThreadedDatabaseSessionService,
+        db_url,
+        max_events=max_events,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_recycle=pool_recycle,
+        pool_pre_ping=pool_pre_ping,
+    )
+
+
+async def retrieve_pool_stats_async(
+        database_service: DatabaseSessionService,
+) -> dict[str, int | str]:
+    pool = database_service.db_engine.pool
 
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "status": pool.status(),
+    }
 
+
+@timed("session.load")
 async def retrieve_session_async(
         database_service: DatabaseSessionService,
         app_name: str,
@@ -37,6 +134,7 @@ async def retrieve_session_async(
     return session
 
 
+@timed("session.create")
 async def create_session_async(
         database_service: DatabaseSessionService,
         app_name: str,
@@ -61,6 +159,7 @@ async def create_session_async(
     return created_session
 
 
+@timed("session.delete")
 async def delete_session_async(
         database_session_service: DatabaseSessionService,
         app_name: str,
@@ -74,6 +173,7 @@ async def delete_session_async(
     )
 
 
+@timed("runner.setup")
 async def create_runner_async(
         app_name: str,
         session_service: BaseSessionService,
@@ -103,8 +203,29 @@ async def create_root_agent_async() -> LlmAgent:
             properly.
         """,
         description="Main entrypoint for legal questions",
+        before_model_callback=prepare_llm_request,
         # allow_transfer=True is often implicit with sub_agents in AutoFlow
         sub_agents=[civil_law_agent, consumer_law_agent, worker_law_agent]
     )
 
     return root_agent
+
+
+async def compute_agent_version_async(agent: LlmAgent) -> str:
+    """
+    Fingerprint the agent tree (names, models and instructions), so cached
+    answers are not reused once any prompt or model changes.
+    """
+
+    digest = hashlib.sha1()
+
+    pending = [agent]
+    while pending:
+        current = pending.pop(0)
+        digest.update(current.name.encode("utf-8"))
+        digest.update(str(getattr(current, "model", "")).encode("utf-8"))
+        digest.update(str(getattr(current, "instruction", "")).encode("utf-8"))
+
+        pending.extend(current.sub_agents)
+
+    return digest.hexdigest()
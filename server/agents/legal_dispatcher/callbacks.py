@@ -0,0 +1,122 @@
+import contextvars
+import typing
+
+from google.adk.agents.callback_context import CallbackContext
+from google.adk.models import LlmRequest, LlmResponse
+
+from .history import (
+    find_event,
+    HISTORY_START_STATE_KEY,
+    HISTORY_SUMMARY_STATE_KEY,
+)
+
+RAG_CONTEXT_INSTRUCTION = (
+    "Please, use the provided context below to provide "
+    "a better response to the user.\n\n"
+    "{chunks}"
+)
+
+# Retrieved law text for the current turn. Each request runs in its own
+# task, and therefore its own context, so turns never see each other's.
+rag_context: contextvars.ContextVar[str | None] = contextvars.ContextVar(
+    "rag_context",
+    default=None,
+)
+
+
+def set_rag_context(chunks_text: str | None) -> None:
+    rag_context.set(chunks_text)
+
+
+def inject_history_summary(
+        callback_context: CallbackContext,
+        llm_request: LlmRequest,
+) -> typing.Optional[LlmResponse]:
+    """
+    Add the rolling summary of compacted turns to the system instruction,
+    so the model keeps the gist of turns no longer in the request.
+    """
+
+    summary = callback_context.state.get(HISTORY_SUMMARY_STATE_KEY)
+    if summary:
+        llm_request.append_instructions([
+            "Summary of the earlier conversation with this user:\n"
+            f"{summary}"
+        ])
+
+    # Returning None lets the model call go ahead with the edited request.
+    return None
+
+
+def drop_summarized_turns(
+        callback_context: CallbackContext,
+        llm_request: LlmRequest,
+) -> typing.Optional[LlmResponse]:
+    """
+    Remove the turns the history summary covers from the request, which
+    ADK builds from every event loaded with the session.
+    """
+
+    history_start = callback_context.state.get(HISTORY_START_STATE_KEY)
+    if not history_start:
+        return None
+
+    # CallbackContext has no public way to the session's events.
+    events = callback_context._invocation_context.session.events
+    start = find_event(events, history_start["event_id"])
+    if start is None:
+        # Older than the events loaded, so none of them are summarized.
+        return None
+
+    # Requests carry contents, not events, so the first kept turn is found
+    # again by its message and by how many identical ones come before it.
+    first_content = events[start].content
+    repeats = sum(
+        1
+        for event in events[:start]
+        if event.author == "user" and event.content == first_content
+    )
+    for index, content in enumerate(llm_request.contents):
+        if content != first_content:
+            continue
+
+        if repeats == 0:
+            del llm_request.contents[:index]
+
+            break
+
+        repeats -= 1
+
+    return None
+
+
+def inject_rag_context(
+        callback_context: CallbackContext,
+        llm_request: LlmRequest,
+) -> typing.Optional[LlmResponse]:
+    """
+    Add this turn's retrieved chunks to the system instruction.
+
+    The request is rebuilt for every model call, so the chunks reach the
+    model (including a sub-agent after a transfer) without ever being
+    written to the session events.
+    """
+
+    chunks_text = rag_context.get()
+    if chunks_text:
+        llm_request.append_instructions([
+            RAG_CONTEXT_INSTRUCTION.format(chunks=chunks_text),
+        ])
+
+    return None
+
+
+def prepare_llm_request(
+        callback_context: CallbackContext,
+        llm_request: LlmRequest,
+) -> typing.Optional[LlmResponse]:
+    drop_summarized_turns(callback_context, llm_request)
+    inject_history_summary(callback_context, llm_request)
+    inject_rag_context(callback_context, llm_request)
+
+    return None
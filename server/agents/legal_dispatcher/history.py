@@ -0,0 +1,150 @@
+import logging
+
+from google import genai
+from google.adk.events import Event, EventActions
+from google.adk.sessions import BaseSessionService, Session
+
+from helpers.metrics import timed
+
+logger = logging.getLogger("server_logs")
+
+HISTORY_SUMMARY_STATE_KEY = "history_summary"
+# Where the turns the summary does not cover start.
+HISTORY_START_STATE_KEY = "history_start"
+HISTORY_AUTHOR = "history"
+
+SUMMARY_PROMPT = """
+    Summarize the conversation below between a user and a Brazilian legal
+    assistant. Keep the user's situation, the legal questions asked, the
+    conclusions given and the law articles cited. Write at most {max_words}
+    words, in the language of the conversation.
+
+    Previous summary:
+    {previous_summary}
+
+    Conversation:
+    {transcript}
+"""
+
+
+def split_turns(events: list[Event]) -> list[list[Event]]:
+    """Group events into turns, each starting at a user message."""
+
+    turns: list[list[Event]] = []
+    for event in events:
+        if event.author == "user" or not turns:
+            turns.append([])
+
+        turns[-1].append(event)
+
+    return turns
+
+
+def _event_text(event: Event, max_chars: int) -> str:
+    if not event.content or not event.content.parts:
+        return ""
+
+    text = "".join(part.text or "" for part in event.content.parts)
+
+    return text[:max_chars]
+
+
+@timed("history.summarize")
+async def summarize_history_async(
+        client: genai.Client,
+        model: str,
+        previous_summary: str | None,
+        events: list[Event],
+        max_words: int = 250,
+        max_message_chars: int = 1500,
+) -> str:
+    transcript = "\n".join(
+        f"{event.author}: {text}"
+        for event in events
+        if (text := _event_text(event, max_message_chars))
+    )
+
+    response = await client.aio.models.generate_content(
+        model=model,
+        contents=SUMMARY_PROMPT.format(
+            max_words=max_words,
+            previous_summary=previous_summary or "(none)",
+            transcript=transcript,
+        ),
+    )
+
+    return (response.text or "").strip()
+
+
+def find_event(events: list[Event], event_id: str | None) -> int | None:
+    for index, event in enumerate(events):
+        if event.id == event_id:
+            return index
+
+    return None
+
+
+async def compact_session_async(
+        session_service: BaseSessionService,
+        session: Session,
+        client: genai.Client,
+        model: str,
+        max_turns: int,
+        compact_batch: int,
+) -> Session:
+    """
+    Fold all but the last `max_turns` turns into the rolling summary.
+
+    Compaction only runs once `compact_batch` turns have piled up past the
+    window, so the summarizer is called every few turns instead of on each
+    one. The events themselves stay in the session: the summary and the
+    first turn still sent to the model are saved to the state, with a
+    single event, and the before-model callback drops the earlier turns
+    from each request. Sessions may be loaded with only their recent
+    events; the turns before those were summarized long ago.
+    """
+
+    history_start = session.state.get(HISTORY_START_STATE_KEY) or {}
+    # Absent once it is older than the events loaded, all of which are
+    # then still to be summarized.
+    start = find_event(session.events, history_start.get("event_id")) or 0
+
+    turns = split_turns(session.events[start:])
+    if max_turns <= 0 or len(turns) <= max_turns + compact_batch:
+        return session
+
+    old_events = [event for turn in turns[:-max_turns] for event in turn]
+    first_kept_event = turns[-max_turns][0]
+
+    summary = await summarize_history_async(
+        client,
+        model,
+        session.state.get(HISTORY_SUMMARY_STATE_KEY),
+        old_events,
+    )
+    if not summary:
+        logger.warning(f"Empty history summary for {session.id}, skipped")
+
+        return session
+
+    await session_service.append_event(
+        session,
+        Event(
+            invocation_id=Event.new_id(),
+            author=HISTORY_AUTHOR,
+            actions=EventActions(
+                state_delta={
+                    HISTORY_SUMMARY_STATE_KEY: summary,
+                    HISTORY_START_STATE_KEY: {
+                        "event_id": first_kept_event.id,
+                    },
+                },
+            ),
+        ),
+    )
+
+    logger.info(
+        f"Compacted {session.id}: {len(old_events)} events summarized"
+    )
+
+    return session
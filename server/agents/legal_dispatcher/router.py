@@ -0,0 +1,253 @@
+import collections
+import json
+import math
+import os
+import re
+import typing
+
+from helpers.text import content_words, normalize_text
+
+ROUTING_EXAMPLES_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "data",
+    "routing_examples.jsonl",
+)
+
+# Patterns are matched against normalize_text() output, so they are written
+# lowercase and without accents.
+KEYWORD_RULES: dict[str, tuple[str, ...]] = {
+    "WorkerLawAgent": (
+        r"\bclt\b", r"\bfgts\b", r"\baviso previo\b", r"\bferias\b",
+        r"\bdemi(ss|ti)", r"\brescis", r"\bhoras? extras?\b",
+        r"\bempregad[oa]s?\b", r"\bempregador", r"\bpatrao\b",
+        r"\bcarteira de trabalho\b", r"\bdecimo terceiro\b",
+        r"\bjusta causa\b", r"\bsalari", r"\bjornada\b", r"\bsindicat",
+        r"\btrabalhista\b", r"\binsalubr", r"\bpericulos", r"\bestagi",
+        r"\bseguro.desemprego\b", r"\blicenca maternidade\b",
+    ),
+    "ConsumerLawAgent": (
+        r"\bconsumidor", r"\bcdc\b", r"\bprocon\b", r"\bprodutos?\b",
+        r"\bdefeito", r"\bgarantia\b", r"\bfornecedor", r"\bloja\b",
+        r"\bcompras?\b", r"\breembols", r"\bdevolu", r"\barrependimento\b",
+        r"\bpropaganda\b", r"\bnegativad", r"\boperadora\b",
+        r"\bplano de saude\b", r"\brecall\b", r"\bcobranca indevida\b",
+        r"\bvenda casada\b", r"\bassistencia tecnica\b",
+    ),
+    "CivilLawAgent": (
+        r"\bheranca\b", r"\busucapiao\b", r"\btestamento\b", r"\bdivorci",
+        r"\bcasamento\b", r"\buniao estavel\b", r"\bpensao alimenticia\b",
+        r"\baluguel\b", r"\blocacao\b", r"\binquilino\b", r"\bfiador\b",
+        r"\bguarda compartilhada\b", r"\bcondominio\b", r"\bposse\b",
+        r"\bcodigo civil\b", r"\bprescricao\b", r"\bvizinh", r"\badocao\b",
+        r"\bdoacao\b", r"\bescritura\b", r"\bregime de bens\b",
+    ),
+}
+
+
+class RoutingDecision(typing.NamedTuple):
+    # None means the question is ambiguous and the root agent should route.
+    domain: str | None
+    confidence: float
+    scores: dict[str, float]
+
+
+def tokenize(text: str) -> list[str]:
+    """Stemmed content words plus their bigrams."""
+
+    words = content_words(text)
+    bigrams = [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+    return words + bigrams
+
+
+def load_routing_examples(
+        path: str = ROUTING_EXAMPLES_PATH,
+) -> list[tuple[str, str]]:
+    examples = []
+    with open(path, encoding="utf-8") as examples_file:
+        for line in examples_file:
+            if not line.strip():
+                continue
+
+            example = json.loads(line)
+            examples.append((example["question"], example["domain"]))
+
+    return examples
+
+
+class DomainRouter:
+    """
+    Local classifier that picks the legal domain of a question.
+
+    Scores are the cosine similarity between the question's TF-IDF vector
+    and each domain's centroid, plus a fixed boost per keyword rule hit.
+    A softmax over the scores gives the confidence; below `threshold` the
+    question is left to the LLM root agent.
+    """
+
+    def __init__(
+            self,
+            examples: list[tuple[str, str]],
+            keyword_rules: dict[str, tuple[str, ...]] = KEYWORD_RULES,
+            threshold: float = 0.75,
+            keyword_weight: float = 0.5,
+            temperature: float = 8.0,
+    ):
+        self._keyword_rules = {
+            domain: [re.compile(pattern) for pattern in patterns]
+            for domain, patterns in keyword_rules.items()
+        }
+        self.threshold = threshold
+        self._keyword_weight = keyword_weight
+        self._temperature = temperature
+
+        self._idf: dict[str, float] = {}
+        self._centroids: dict[str, dict[str, float]] = {}
+        self.fit(examples)
+
+    @property
+    def domains(self) -> list[str]:
+        return sorted(set(self._centroids) | set(self._keyword_rules))
+
+    def fit(self, examples: list[tuple[str, str]]) -> None:
+        tokenized = [(set(tokenize(q)), domain) for q, domain in examples]
+
+        document_frequency: collections.Counter[str] = collections.Counter()
+        for tokens, _ in tokenized:
+            document_frequency.update(tokens)
+
+        total = len(tokenized)
+        self._idf = {
+            token: math.log((1 + total) / (1 + frequency)) + 1
+            for token, frequency in document_frequency.items()
+        }
+
+        sums: dict[str, collections.Counter[str]] = collections.defaultdict(
+            collections.Counter,
+        )
+        for question, domain in examples:
+            for token, weight in self._vectorize(question).items():
+                sums[domain][token] += weight
+
+        self._centroids = {
+            domain: _normalize_vector(dict(vector))
+            for domain, vector in sums.items()
+        }
+
+    def _vectorize(self, text: str) -> dict[str, float]:
+        counts = collections.Counter(
+            token for token in tokenize(text) if token in self._idf
+        )
+
+        return _normalize_vector({
+            token: (1 + math.log(count)) * self._idf[token]
+            for token, count in counts.items()
+        })
+
+    def classify(self, question: str) -> RoutingDecision:
+        vector = self._vectorize(question)
+        normalized_question = normalize_text(question)
+
+        scores = {}
+        for domain in self.domains:
+            centroid = self._centroids.get(domain, {})
+            similarity = sum(
+                weight * centroid.get(token, 0.0)
+                for token, weight in vector.items()
+            )
+            hits = sum(
+                1
+                for pattern in self._keyword_rules.get(domain, ())
+                if pattern.search(normalized_question)
+            )
+            scores[domain] = similarity + self._keyword_weight * hits
+
+        # Softmax over the raw scores; subtracting the max keeps exp() small.
+        top_score = max(scores.values())
+        exponentials = {
+            domain: math.exp(self._temperature * (score - top_score))
+            for domain, score in scores.items()
+        }
+        total = sum(exponentials.values())
+        probabilities = {
+            domain: value / total for domain, value in exponentials.items()
+        }
+
+        domain, confidence = max(
+            probabilities.items(),
+            key=lambda item: item[1],
+        )
+        if confidence < self.threshold:
+            return RoutingDecision(None, confidence, probabilities)
+
+        return RoutingDecision(domain, confidence, probabilities)
+
+
+def _normalize_vector(vector: dict[str, float]) -> dict[str, float]:
+    norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+    if not norm:
+        return {}
+
+    return {token: weight / norm for token, weight in vector.items()}
+
+
+async def instantiate_domain_router(
+        examples_path: str = ROUTING_EXAMPLES_PATH,
+        threshold: float = 0.75,
+) -> DomainRouter:
+    return DomainRouter(
+        load_routing_examples(examples_path),
+        threshold=threshold,
+    )
+
+
+def evaluate_router(
+        examples: list[tuple[str, str]],
+        threshold: float = 0.75,
+        held_out: list[tuple[str, str]] | None = None,
+) -> dict[str, typing.Any]:
+    """
+    Measure the router offline.
+
+    With `held_out`, the router is trained on `examples` and scored on it;
+    otherwise every example is scored by a router trained on the others
+    (leave-one-out). `accuracy` only counts the questions the router was
+    confident about, the rest fall back to the LLM and count as coverage
+    misses, never as errors.
+    """
+
+    if held_out is not None:
+        router = DomainRouter(examples, threshold=threshold)
+        decisions = [
+            (router.classify(question), domain)
+            for question, domain in held_out
+        ]
+
+    else:
+        decisions = []
+        for i, (question, domain) in enumerate(examples):
+            router = DomainRouter(
+                examples[:i] + examples[i + 1:],
+                threshold=threshold,
+            )
+            decisions.append((router.classify(question), domain))
+
+    routed = [(d, domain) for d, domain in decisions if d.domain is not None]
+    correct = sum(1 for d, domain in routed if d.domain == domain)
+
+    confusion: dict[str, collections.Counter[str]] = collections.defaultdict(
+        collections.Counter,
+    )
+    for decision, domain in decisions:
+        confusion[domain][decision.domain or "fallback"] += 1
+
+    return {
+        "examples": len(decisions),
+        "routed": len(routed),
+        "coverage": len(routed) / len(decisions) if decisions else 0.0,
+        "accuracy": correct / len(routed) if routed else 0.0,
+        "confusion": {
+            domain: dict(predictions)
+            for domain, predictions in sorted(confusion.items())
+        },
+    }
@@ -1,5 +1,7 @@
 from google.adk.agents import Agent
 
+from ...callbacks import prepare_llm_request
+
 root_agent = Agent(
     name="CivilLawAgent",
     model="gemini-2.5-flash",
@@ -11,4 +13,5 @@ root_agent = Agent(
         of the text the related articles, explaining why these articles
         helps the user.
     """,
+    before_model_callback=prepare_llm_request,
 )
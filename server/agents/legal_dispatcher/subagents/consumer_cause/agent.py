@@ -1,5 +1,7 @@
 from google.adk.agents import LlmAgent
 
+from ...callbacks import prepare_llm_request
+
 root_agent = LlmAgent(
     name="ConsumerLawAgent",
     model="gemini-2.5-flash",
@@ -11,4 +13,5 @@ root_agent = LlmAgent(
         of the text the related articles, explaining why these articles
         helps the user
     """,
+    before_model_callback=prepare_llm_request,
 )
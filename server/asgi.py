@@ -0,0 +1,260 @@
+import contextlib
+import json
+import time
+import typing
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+from starlette.routing import Route
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from helpers.log_helpers import set_request_id
+from helpers.metrics import REQUEST_SECONDS, REQUESTS
+
+from services import (
+    BODY_SAMPLER,
+    clear_user_session,
+    enqueue_query,
+    JOB_QUEUE_ENABLED,
+    logger,
+    RATINGS_CACHE_MAX_AGE,
+    retrieve_cache_stats,
+    retrieve_job,
+    retrieve_metrics,
+    retrieve_pool_stats,
+    retrieve_rating_percentages,
+    run_query,
+    save_rating,
+    setup_shared_resources,
+    stream_query_events,
+    teardown_shared_resources,
+    validate_callback_url,
+    validate_query_request,
+)
+
+
+class MetricsMiddleware:
+    """
+    Count requests and time them until the last body chunk is sent, so
+    streamed answers are measured in full. Paths outside `endpoints` share
+    one label to keep the series count bounded.
+    """
+
+    def __init__(self, app: ASGIApp, endpoints: set[str]):
+        self.app = app
+        self.endpoints = endpoints
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+
+            return
+
+        path = scope["path"]
+        endpoint = path if path in self.endpoints else "other"
+        started_at = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+
+        finally:
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - started_at,
+                endpoint=endpoint,
+            )
+            REQUESTS.inc(endpoint=endpoint, status=str(status))
+
+
+class RequestIdMiddleware:
+    """
+    Tag every log record of a request with one id: the caller's
+    X-Request-ID if it sent one, a new id otherwise. The id is echoed back
+    in the response headers.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+
+            return
+
+        incoming = dict(scope["headers"]).get(b"x-request-id", b"")
+        request_id = set_request_id(incoming.decode("latin-1")[:64] or None)
+
+        async def send_with_request_id(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-request-id", request_id.encode("latin-1")))
+                message = {**message, "headers": headers}
+
+            await send(message)
+
+        await self.app(scope, receive, send_with_request_id)
+
+
+async def _get_json(request: Request) -> typing.Any:
+    try:
+        return await request.json()
+
+    except json.JSONDecodeError:
+        return None
+
+
+async def query(request: Request) -> Response:
+    request_data = await _get_json(request)
+    if not validate_query_request(request_data):
+        return JSONResponse({"response": "Missing request data."}, 400)
+
+    if not validate_callback_url(request_data):
+        return JSONResponse({"response": "Callback URL not allowed."}, 400)
+
+    logged_query = BODY_SAMPLER.sample(request_data["query"])
+    if logged_query is not None:
+        logger.info(f"Received query: {logged_query}")
+
+    if JOB_QUEUE_ENABLED:
+        job_id = await enqueue_query(request_data)
+
+        return JSONResponse({"job_id": job_id, "status": "queued"}, 202)
+
+    response, status = await run_query(request_data)
+
+    return JSONResponse(response, status)
+
+
+async def job_status(request: Request) -> Response:
+    job = await retrieve_job(request.path_params["job_id"])
+    if job is None:
+        return JSONResponse({"response": "Job not found."}, 404)
+
+    return JSONResponse(job, 200)
+
+
+async def query_stream(request: Request) -> Response:
+    request_data = await _get_json(request)
+    if not validate_query_request(request_data):
+        return JSONResponse({"response": "Missing request data."}, 400)
+
+    logged_query = BODY_SAMPLER.sample(request_data["query"])
+    if logged_query is not None:
+        logger.info(f"Received streaming query: {logged_query}")
+
+    async def _generate() -> typing.AsyncIterator[str]:
+        async for event in stream_query_events(request_data):
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(
+        _generate(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def clear_session(request: Request) -> Response:
+    request_user_id = request.query_params.get("user_id")
+
+    status = await clear_user_session(request_user_id)
+
+    return Response(status_code=status)
+
+
+async def rate_interaction(request: Request) -> Response:
+    request_data = await _get_json(request)
+
+    response, status = await save_rating(request_data)
+
+    return JSONResponse(response, status)
+
+
+async def get_ratings(request: Request) -> Response:
+    percentages, status, etag = await retrieve_rating_percentages()
+    if etag is None:
+        return JSONResponse(percentages, status)
+
+    headers = {
+        "ETag": f'"{etag}"',
+        "Cache-Control": f"public, max-age={RATINGS_CACHE_MAX_AGE}",
+    }
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+
+    return JSONResponse(percentages, status, headers=headers)
+
+
+async def pool_stats(request: Request) -> Response:
+    stats = await retrieve_pool_stats()
+
+    return JSONResponse(stats, 200)
+
+
+async def cache_stats(request: Request) -> Response:
+    stats = await retrieve_cache_stats()
+
+    return JSONResponse(stats, 200)
+
+
+async def metrics(request: Request) -> Response:
+    body = await retrieve_metrics()
+
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
+
+
+async def healthcheck(request: Request) -> Response:
+    return JSONResponse({"status": "ok"}, 200)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: Starlette) -> typing.AsyncIterator[None]:
+    # Runs on the worker's event loop, so every pooled client created here
+    # is reused by all requests the worker serves.
+    await setup_shared_resources()
+
+    try:
+        yield
+
+    finally:
+        await teardown_shared_resources()
+
+
+routes = [
+    Route("/query/", query, methods=["POST"]),
+    Route("/query/stream/", query_stream, methods=["POST"]),
+    Route("/jobs/{job_id}", job_status, methods=["GET"]),
+    Route("/clear/", clear_session, methods=["DELETE"]),
+    Route("/rate/", rate_interaction, methods=["POST"]),
+    Route("/api/get-ratings", get_ratings, methods=["GET"]),
+    Route("/stats/pool/", pool_stats, methods=["GET"]),
+    Route("/stats/cache/", cache_stats, methods=["GET"]),
+    Route("/metrics", metrics, methods=["GET"]),
+    Route("/healthcheck/", healthcheck, methods=["GET"]),
+]
+
+app = Starlette(
+    routes=routes,
+    middleware=[
+        Middleware(RequestIdMiddleware),
+        Middleware(
+            MetricsMiddleware,
+            endpoints={route.path for route in routes},
+        ),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,559 @@
+import asyncio
+import collections
+import math
+import time
+import typing
+from types import SimpleNamespace
+
+import httpx
+from google.adk.models import BaseLlm, LlmRequest, LlmResponse
+from google.adk.sessions import InMemorySessionService
+from google.genai import types
+
+from helpers.db_helpers import _count_ratings_sync, _save_ratings_sync
+from helpers.sessions import _GET_OR_CREATE_USER_ID_SCRIPT
+from helpers.single_flight import RELEASE_LOCK_SCRIPT
+
+T = typing.TypeVar("T")
+
+# Stand-in for the law text RAGFlow returns; only its size matters here.
+SAMPLE_LAW_WORDS = (
+    "empregado empregador contrato trabalho salario jornada ferias rescisao "
+    "consumidor fornecedor produto servico defeito garantia reparacao dano "
+    "contrato obrigacao posse propriedade familia sucessao prazo direito"
+).split()
+
+
+def _encode(value: typing.Any) -> bytes:
+    if isinstance(value, bytes):
+        return value
+
+    return str(value).encode("utf-8")
+
+
+def _get_or_create_user_id(
+        redis_client: "FakeRedis",
+        keys: list[str],
+        args: list[typing.Any],
+) -> bytes:
+    user_id = redis_client.execute_command("get", keys[0])
+    if user_id is not None:
+        return user_id
+
+    redis_client.execute_command("set", keys[0], args[0])
+
+    return _encode(args[0])
+
+
+def _release_lock(
+        redis_client: "FakeRedis",
+        keys: list[str],
+        args: list[typing.Any],
+) -> int:
+    if redis_client.execute_command("get", keys[0]) != _encode(args[0]):
+        return 0
+
+    return redis_client.execute_command("delete", keys[0])
+
+
+class FakeRedis:
+    """
+    In-process stand-in for the redis.asyncio client, covering the commands
+    the server sends. Each command, and each pipeline, waits `latency`
+    seconds once, like a network round trip.
+    """
+
+    # Lua scripts the server registers, reimplemented in Python.
+    scripts: dict[str, typing.Callable[..., typing.Any]] = {
+        _GET_OR_CREATE_USER_ID_SCRIPT: _get_or_create_user_id,
+        RELEASE_LOCK_SCRIPT: _release_lock,
+    }
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self._values: dict[str, typing.Any] = {}
+        self._expires_at: dict[str, float] = {}
+        self._subscribers: dict[str, list[asyncio.Queue]] = (
+            collections.defaultdict(list)
+        )
+
+    async def round_trip(self) -> None:
+        await asyncio.sleep(self.latency)
+
+    def _lookup(self, key: str, default: typing.Any = None) -> typing.Any:
+        expires_at = self._expires_at.get(key)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._values.pop(key, None)
+            self._expires_at.pop(key, None)
+
+        return self._values.get(key, default)
+
+    def _keep(self, key: str, value: typing.Any) -> None:
+        # Emptied sets and sorted sets disappear, as in Redis.
+        if not value:
+            self._values.pop(key, None)
+            self._expires_at.pop(key, None)
+
+    def _cmd_get(self, key: str) -> bytes | None:
+        return self._lookup(key)
+
+    def _cmd_mget(self, keys: list[str]) -> list[bytes | None]:
+        return [self._lookup(key) for key in keys]
+
+    def _cmd_set(
+            self,
+            key: str,
+            value: typing.Any,
+            ex: float | None = None,
+            px: float | None = None,
+            nx: bool = False,
+    ) -> bool | None:
+        if nx and self._lookup(key) is not None:
+            return None
+
+        self._values[key] = _encode(value)
+        self._expires_at.pop(key, None)
+        if ex is not None:
+            self._expires_at[key] = time.monotonic() + ex
+        elif px is not None:
+            self._expires_at[key] = time.monotonic() + px / 1000
+
+        return True
+
+    def _cmd_delete(self, *keys: str) -> int:
+        deleted = 0
+        for key in keys:
+            if self._lookup(key) is not None:
+                deleted += 1
+
+            self._values.pop(key, None)
+            self._expires_at.pop(key, None)
+
+        return deleted
+
+    def _cmd_expire(self, key: str, seconds: float) -> bool:
+        if self._lookup(key) is None:
+            return False
+
+        self._expires_at[key] = time.monotonic() + seconds
+
+        return True
+
+    def _cmd_sadd(self, key: str, *members: typing.Any) -> int:
+        members_set = self._lookup(key)
+        if members_set is None:
+            members_set = self._values[key] = set()
+
+        added = {_encode(member) for member in members} - members_set
+        members_set.update(added)
+
+        return len(added)
+
+    def _cmd_srem(self, key: str, *members: typing.Any) -> int:
+        members_set = self._lookup(key, set())
+        removed = {_encode(member) for member in members} & members_set
+        members_set.difference_update(removed)
+        self._keep(key, members_set)
+
+        return len(removed)
+
+    def _cmd_smembers(self, key: str) -> set[bytes]:
+        return set(self._lookup(key, set()))
+
+    def _cmd_zadd(self, key: str, mapping: dict[typing.Any, float]) -> int:
+        scores = self._lookup(key)
+        if scores is None:
+            scores = self._values[key] = {}
+
+        added = 0
+        for member, score in mapping.items():
+            member = _encode(member)
+            added += member not in scores
+            scores[member] = float(score)
+
+        return added
+
+    def _cmd_zrem(self, key: str, *members: typing.Any) -> int:
+        scores = self._lookup(key, {})
+        removed = 0
+        for member in members:
+            removed += scores.pop(_encode(member), None) is not None
+        self._keep(key, scores)
+
+        return removed
+
+    def _cmd_zremrangebyscore(
+            self,
+            key: str,
+            min_score: typing.Any,
+            max_score: typing.Any,
+    ) -> int:
+        scores = self._lookup(key, {})
+        low, high = float(min_score), float(max_score)
+        removed = [
+            member for member, score in scores.items()
+            if low <= score <= high
+        ]
+        for member in removed:
+            del scores[member]
+        self._keep(key, scores)
+
+        return len(removed)
+
+    def _cmd_zcard(self, key: str) -> int:
+        return len(self._lookup(key, {}))
+
+    def _sorted_members(self, key: str) -> list[tuple[bytes, float]]:
+        scores = self._lookup(key, {})
+
+        return sorted(scores.items(), key=lambda item: (item[1], item[0]))
+
+    def _cmd_zrange(self, key: str, start: int, end: int) -> list[bytes]:
+        members = self._sorted_members(key)
+        end = len(members) if end == -1 else end + 1
+
+        return [member for member, _ in members[start:end]]
+
+    def _cmd_zpopmin(
+            self,
+            key: str,
+            count: int = 1,
+    ) -> list[tuple[bytes, float]]:
+        popped = self._sorted_members(key)[:count]
+        scores = self._lookup(key, {})
+        for member, _ in popped:
+            del scores[member]
+        self._keep(key, scores)
+
+        return popped
+
+    def _cmd_publish(self, channel: str, message: typing.Any) -> int:
+        subscribers = self._subscribers.get(channel, [])
+        for queue in subscribers:
+            queue.put_nowait({
+                "type": "message",
+                "channel": _encode(channel),
+                "data": _encode(message),
+            })
+
+        return len(subscribers)
+
+    def execute_command(self, name: str, *args, **kwargs) -> typing.Any:
+        command = getattr(self, f"_cmd_{name}", None)
+        if command is None:
+            raise NotImplementedError(f"FakeRedis has no {name} command")
+
+        return command(*args, **kwargs)
+
+    def __getattr__(self, name: str) -> typing.Callable[..., typing.Any]:
+        if name.startswith("_") or not hasattr(self, f"_cmd_{name}"):
+            raise AttributeError(name)
+
+        async def command(*args: typing.Any, **kwargs: typing.Any):
+            await self.round_trip()
+
+            return self.execute_command(name, *args, **kwargs)
+
+        return command
+
+    def pipeline(self, transaction: bool = True) -> "FakePipeline":
+        return FakePipeline(self)
+
+    def pubsub(self) -> "FakePubSub":
+        return FakePubSub(self)
+
+    def register_script(self, script: str) -> typing.Callable[..., typing.Any]:
+        handler = self.scripts[script]
+
+        async def run_script(
+                keys: typing.Sequence[str] = (),
+                args: typing.Sequence[typing.Any] = (),
+        ) -> typing.Any:
+            await self.round_trip()
+
+            return handler(self, list(keys), list(args))
+
+        return run_script
+
+    async def aclose(self) -> None:
+        pass
+
+
+class FakePipeline:
+    def __init__(self, redis_client: FakeRedis):
+        self._redis_client = redis_client
+        self._commands: list[tuple[str, tuple, dict]] = []
+
+    async def __aenter__(self) -> "FakePipeline":
+        return self
+
+    async def __aexit__(self, *exc_info: typing.Any) -> None:
+        self._commands.clear()
+
+    def __getattr__(self, name: str) -> typing.Callable[..., "FakePipeline"]:
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def queue_command(*args: typing.Any, **kwargs: typing.Any):
+            self._commands.append((name, args, kwargs))
+
+            return self
+
+        return queue_command
+
+    async def execute(self) -> list[typing.Any]:
+        await self._redis_client.round_trip()
+
+        commands, self._commands = self._commands, []
+
+        return [
+            self._redis_client.execute_command(name, *args, **kwargs)
+            for name, args, kwargs in commands
+        ]
+
+
+class FakePubSub:
+    def __init__(self, redis_client: FakeRedis):
+        self._redis_client = redis_client
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._channels: list[str] = []
+
+    async def __aenter__(self) -> "FakePubSub":
+        return self
+
+    async def __aexit__(self, *exc_info: typing.Any) -> None:
+        await self.aclose()
+
+    async def subscribe(self, *channels: str) -> None:
+        await self._redis_client.round_trip()
+
+        for channel in channels:
+            self._redis_client._subscribers[channel].append(self._queue)
+            self._channels.append(channel)
+
+    async def unsubscribe(self, *channels: str) -> None:
+        for channel in channels or tuple(self._channels):
+            subscribers = self._redis_client._subscribers[channel]
+            if self._queue in subscribers:
+                subscribers.remove(self._queue)
+
+            self._channels.remove(channel)
+
+    async def get_message(
+            self,
+            ignore_subscribe_messages: bool = False,
+            timeout: float | None = 0.0,
+    ) -> dict[str, typing.Any] | None:
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+
+        except TimeoutError:
+            return None
+
+    async def aclose(self) -> None:
+        await self.unsubscribe()
+
+
+class FakeRatingsPool:
+    """
+    Stands in for db_helpers.ConnectionPool. The rating upsert and count
+    queries run against in-memory dicts after `latency` seconds, holding
+    one of `maxconn` connections like the real pool does.
+    """
+
+    def __init__(self, latency: float = 0.0, maxconn: int = 10):
+        self.latency = latency
+        self.ratings: dict[int, str] = {}
+        self._semaphore = asyncio.Semaphore(maxconn)
+        self._queries: dict[typing.Callable, typing.Callable] = {
+            _save_ratings_sync: self._save_ratings,
+            _count_ratings_sync: self._count_ratings,
+        }
+
+    async def open(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    async def run(
+            self,
+            func: typing.Callable[..., T],
+            *args: typing.Any,
+    ) -> T:
+        query = self._queries.get(func)
+        if query is None:
+            raise NotImplementedError(f"No fake for {func.__name__}")
+
+        async with self._semaphore:
+            await asyncio.sleep(self.latency)
+
+            return query(*args)
+
+    def _save_ratings(self, ratings: list[tuple[int, str]]) -> None:
+        self.ratings.update(ratings)
+
+    def _count_ratings(self) -> list[tuple[str, int]]:
+        return list(collections.Counter(self.ratings.values()).items())
+
+
+class FakeSessionService(InMemorySessionService):
+    """ADK's in-memory sessions, with a database round trip per call."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+
+    async def create_session(self, **kwargs: typing.Any):
+        await asyncio.sleep(self.latency)
+
+        return await super().create_session(**kwargs)
+
+    async def get_session(self, **kwargs: typing.Any):
+        await asyncio.sleep(self.latency)
+
+        return await super().get_session(**kwargs)
+
+    async def delete_session(self, **kwargs: typing.Any):
+        await asyncio.sleep(self.latency)
+
+        return await super().delete_session(**kwargs)
+
+    async def append_event(self, session, event):
+        await asyncio.sleep(self.latency)
+
+        return await super().append_event(session, event)
+
+
+def _model_content(text: str) -> types.Content:
+    return types.Content(role="model", parts=[types.Part(text=text)])
+
+
+class FakeLlm(BaseLlm):
+    """
+    Answers every request with `response_text` after `latency` seconds.
+    When streaming, the answer arrives in `stream_chunks` partial events
+    spread over the same time.
+    """
+
+    model: str = "fake-llm"
+    latency: float = 0.0
+    response_text: str = (
+        "De acordo com a legislação aplicável, o seu caso depende dos "
+        "documentos apresentados. Procure o órgão competente."
+    )
+    stream_chunks: int = 8
+
+    async def generate_content_async(
+            self,
+            llm_request: LlmRequest,
+            stream: bool = False,
+    ) -> typing.AsyncGenerator[LlmResponse, None]:
+        if not stream:
+            await asyncio.sleep(self.latency)
+            yield LlmResponse(content=_model_content(self.response_text))
+
+            return
+
+        words = self.response_text.split(" ")
+        step = math.ceil(len(words) / self.stream_chunks)
+        for start in range(0, len(words), step):
+            await asyncio.sleep(self.latency / self.stream_chunks)
+            delta = " ".join(words[start:start + step])
+            yield LlmResponse(content=_model_content(delta), partial=True)
+
+        yield LlmResponse(content=_model_content(self.response_text))
+
+
+class _FakeGenaiModels:
+    def __init__(self, latency: float, dimensions: int):
+        self._latency = latency
+        self._dimensions = dimensions
+
+    async def generate_content(self, model: str, contents: typing.Any, **_):
+        await asyncio.sleep(self._latency)
+
+        return SimpleNamespace(
+            text="Resumo: o usuário fez perguntas sobre seus direitos.",
+        )
+
+    async def embed_content(self, model: str, contents: list[str], **_):
+        await asyncio.sleep(self._latency)
+
+        # Deterministic, so cached and fresh embeddings agree.
+        return SimpleNamespace(embeddings=[
+            SimpleNamespace(values=[
+                float((len(text) + i) % 7) for i in range(self._dimensions)
+            ])
+            for text in contents
+        ])
+
+
+class FakeGenaiClient:
+    """
+    The part of genai.Client used outside the agents: history summaries
+    and query embeddings.
+    """
+
+    def __init__(self, latency: float = 0.0, dimensions: int = 8):
+        self.aio = SimpleNamespace(
+            models=_FakeGenaiModels(latency, dimensions),
+        )
+
+
+def sample_chunks(
+        count: int = 8,
+        words_per_chunk: int = 120,
+) -> list[dict[str, typing.Any]]:
+    """RAGFlow retrieval results of roughly the size of real articles."""
+
+    chunks = []
+    for n in range(count):
+        words = [
+            SAMPLE_LAW_WORDS[(n * 7 + i) % len(SAMPLE_LAW_WORDS)]
+            for i in range(words_per_chunk)
+        ]
+        chunks.append({
+            "id": f"chunk-{n}",
+            "content": f"Art. {n + 1}. " + " ".join(words),
+            "document_id": "document-1",
+            "similarity": round(1 - n / (count * 2), 3),
+        })
+
+    return chunks
+
+
+def instantiate_fake_rag_object(
+        latency: float = 0.0,
+        chunks: list[dict[str, typing.Any]] | None = None,
+) -> httpx.AsyncClient:
+    """An httpx client answering the RAGFlow endpoints the server calls."""
+
+    if chunks is None:
+        chunks = sample_chunks()
+
+    async def handle(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(latency)
+
+        path = request.url.path.removeprefix("/api/v1")
+        if path == "/datasets":
+            data: typing.Any = [{
+                "id": "dataset-1",
+                "name": request.url.params.get("name"),
+            }]
+        elif path == "/datasets/dataset-1/documents":
+            data = {"docs": [{"id": "document-1"}], "total": 1}
+        elif path == "/retrieval":
+            data = {"chunks": chunks, "total": len(chunks)}
+        else:
+            return httpx.Response(
+                404,
+                json={"code": 404, "message": f"No fake for {path}"},
+            )
+
+        return httpx.Response(200, json={"code": 0, "data": data})
+
+    return httpx.AsyncClient(
+        base_url="http://ragflow.benchmark/api/v1",
+        transport=httpx.MockTransport(handle),
+    )
@@ -0,0 +1,354 @@
+import asyncio
+import collections
+import json
+import math
+import os
+import platform
+import time
+import typing
+
+import httpx
+
+from agents.legal_dispatcher.router import load_routing_examples
+from helpers.db_helpers import RATINGS
+
+from .fakes import (
+    FakeGenaiClient,
+    FakeLlm,
+    FakeRatingsPool,
+    FakeRedis,
+    FakeSessionService,
+    instantiate_fake_rag_object,
+)
+
+# Settings the fakes depend on. Anything else keeps its environment value,
+# so e.g. ANSWER_CACHE_ENABLED=true can be benchmarked too.
+BENCHMARK_ENVIRONMENT = {
+    "RETRIEVER_BACKEND": "ragflow",
+    "LAW_DATASET_NAME": "benchmark_laws",
+    "FLASK_APP_NAME": "legal_assistant_benchmark",
+    # /query/ is measured answering in the request; FakeRedis has no
+    # streams for the job queue.
+    "JOB_QUEUE_ENABLED": "false",
+}
+
+ENDPOINTS = ("/query/", "/rate/", "/clear/", "/api/get-ratings")
+
+RequestFactory = typing.Callable[[int], tuple[str, str, dict[str, typing.Any]]]
+
+
+class FakeLatencies(typing.NamedTuple):
+    """Seconds each fake waits per call, roughly production round trips."""
+
+    redis: float = 0.0005
+    postgres: float = 0.002
+    sessions: float = 0.003
+    ragflow: float = 0.08
+    llm: float = 1.5
+    genai: float = 0.4
+
+    @classmethod
+    def parse(cls, overrides: list[str]) -> "FakeLatencies":
+        """Build from NAME=SECONDS strings, e.g. ["llm=0.5"]."""
+
+        values: dict[str, float] = {}
+        for override in overrides:
+            name, _, seconds = override.partition("=")
+            if name not in cls._fields:
+                raise ValueError(
+                    f"Unknown fake '{name}', expected one of {cls._fields}"
+                )
+
+            values[name] = float(seconds)
+
+        return cls(**values)
+
+
+class EndpointResult(typing.NamedTuple):
+    requests: int
+    errors: int
+    statuses: dict[str, int]
+    throughput: float
+    mean_ms: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not sorted_values:
+        return 0.0
+
+    rank = math.ceil(fraction * len(sorted_values))
+
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def summarize_latencies(
+        latencies: list[float],
+        statuses: collections.Counter,
+        elapsed: float,
+) -> EndpointResult:
+    latencies = sorted(latencies)
+    errors = sum(
+        count for status, count in statuses.items() if status >= 400
+    )
+
+    return EndpointResult(
+        requests=len(latencies),
+        errors=errors,
+        statuses={str(status): count for status, count in statuses.items()},
+        throughput=len(latencies) / elapsed if elapsed else 0.0,
+        mean_ms=1000 * sum(latencies) / len(latencies) if latencies else 0.0,
+        p50_ms=1000 * percentile(latencies, 0.50),
+        p95_ms=1000 * percentile(latencies, 0.95),
+        p99_ms=1000 * percentile(latencies, 0.99),
+    )
+
+
+def build_request_factories(users: int) -> dict[str, RequestFactory]:
+    # Real questions, so routing, retrieval keys and prompts look like
+    # production traffic. Users cycle, so sessions build up history.
+    questions = [question for question, _ in load_routing_examples()]
+
+    def query(n: int):
+        user = n % users
+
+        return "POST", "/query/", {"json": {
+            "query": questions[n % len(questions)],
+            "username": f"benchmark{user}",
+            "user_id": user,
+        }}
+
+    def rate(n: int):
+        return "POST", "/rate/", {"json": {
+            "request_user_id": n % users,
+            "rating": RATINGS[n % len(RATINGS)],
+        }}
+
+    def clear(n: int):
+        return "DELETE", "/clear/", {"params": {"user_id": n % users}}
+
+    def get_ratings(n: int):
+        return "GET", "/api/get-ratings", {}
+
+    return {
+        "/query/": query,
+        "/rate/": rate,
+        "/clear/": clear,
+        "/api/get-ratings": get_ratings,
+    }
+
+
+async def install_fakes(latencies: FakeLatencies) -> None:
+    """
+    Put the fakes in the shared resource registry, where the getters find
+    them instead of connecting to the real services.
+    """
+
+    # Imported here: services reads the server settings on import.
+    import services
+    from helpers.context_helpers import set_context_var
+
+    await set_context_var(
+        services.REDIS_CLIENT_KEY,
+        FakeRedis(latency=latencies.redis),
+    )
+    await set_context_var(
+        services.DB_POOL_KEY,
+        FakeRatingsPool(latency=latencies.postgres),
+    )
+    await set_context_var(
+        services.DATABASE_SESSION_SERVICE_KEY,
+        FakeSessionService(latency=latencies.sessions),
+    )
+    await set_context_var(
+        services.RAG_OBJECT_KEY,
+        instantiate_fake_rag_object(latency=latencies.ragflow),
+    )
+    await set_context_var(
+        services.GENAI_CLIENT_KEY,
+        FakeGenaiClient(latency=latencies.genai),
+    )
+
+    pending = [await services.get_agent()]
+    while pending:
+        agent = pending.pop()
+        agent.model = FakeLlm(latency=latencies.llm)
+        pending.extend(agent.sub_agents)
+
+
+async def _run_endpoint(
+        client: httpx.AsyncClient,
+        make_request: RequestFactory,
+        requests: int,
+        concurrency: int,
+        first_request: int = 0,
+) -> EndpointResult:
+    latencies: list[float] = []
+    statuses: collections.Counter = collections.Counter()
+    request_numbers = iter(range(first_request, first_request + requests))
+
+    async def _worker() -> None:
+        # Workers share one iterator, so exactly `requests` are sent.
+        for n in request_numbers:
+            method, path, kwargs = make_request(n)
+            started_at = time.perf_counter()
+            response = await client.request(method, path, **kwargs)
+            latencies.append(time.perf_counter() - started_at)
+            statuses[response.status_code] += 1
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(_worker() for _ in range(concurrency)))
+
+    return summarize_latencies(
+        latencies,
+        statuses,
+        time.perf_counter() - started_at,
+    )
+
+
+async def run_benchmark(
+        endpoints: typing.Sequence[str] = ENDPOINTS,
+        requests: int = 200,
+        concurrency: int = 20,
+        warmup: int = 10,
+        users: int = 50,
+        latencies: FakeLatencies = FakeLatencies(),
+) -> dict[str, typing.Any]:
+    """
+    Drive the ASGI app in process, one endpoint at a time, and report
+    throughput and latency percentiles per endpoint.
+
+    This is a single worker with every external service faked, so the
+    numbers measure the server's own overhead and how it behaves under
+    concurrency, not production capacity. With all latencies at zero
+    only the server's CPU time is left.
+    """
+
+    for name, value in BENCHMARK_ENVIRONMENT.items():
+        os.environ[name] = value
+
+    await install_fakes(latencies)
+
+    # Imported here: services reads the server settings on import.
+    from asgi import app
+
+    factories = build_request_factories(users)
+    results: dict[str, EndpointResult] = {}
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+                transport=transport,
+                base_url="http://benchmark",
+                timeout=None,
+        ) as client:
+            for endpoint in endpoints:
+                make_request = factories[endpoint]
+                if warmup:
+                    await _run_endpoint(
+                        client,
+                        make_request,
+                        warmup,
+                        min(concurrency, warmup),
+                    )
+
+                results[endpoint] = await _run_endpoint(
+                    client,
+                    make_request,
+                    requests,
+                    concurrency,
+                    first_request=warmup,
+                )
+
+    return {
+        "settings": {
+            "requests": requests,
+            "concurrency": concurrency,
+            "warmup": warmup,
+            "users": users,
+            "latencies": latencies._asdict(),
+        },
+        "python": platform.python_version(),
+        "endpoints": {
+            endpoint: result._asdict() for endpoint, result in results.items()
+        },
+    }
+
+
+def compare_to_baseline(
+        report: dict[str, typing.Any],
+        baseline: dict[str, typing.Any],
+        tolerance: float = 0.2,
+) -> list[str]:
+    """
+    Describe every endpoint whose p95/p99 latency grew, or whose
+    throughput fell, by more than `tolerance` against the baseline.
+    """
+
+    regressions = []
+    if report["settings"] != baseline["settings"]:
+        regressions.append(
+            "Settings differ from the baseline, results are not comparable: "
+            f"{baseline['settings']} -> {report['settings']}"
+        )
+
+        return regressions
+
+    for endpoint, result in report["endpoints"].items():
+        expected = baseline["endpoints"].get(endpoint)
+        if expected is None:
+            continue
+
+        for field in ("p95_ms", "p99_ms"):
+            if result[field] > expected[field] * (1 + tolerance):
+                regressions.append(
+                    f"{endpoint} {field}: {expected[field]:.1f} -> "
+                    f"{result[field]:.1f}"
+                )
+
+        if result["throughput"] < expected["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{endpoint} throughput: {expected['throughput']:.1f} -> "
+                f"{result['throughput']:.1f} req/s"
+            )
+
+        if result["errors"] > expected["errors"]:
+            regressions.append(
+                f"{endpoint} errors: {expected['errors']} -> "
+                f"{result['errors']}"
+            )
+
+    return regressions
+
+
+def format_report(report: dict[str, typing.Any]) -> str:
+    lines = [
+        f"{'endpoint':<18} {'requests':>8} {'errors':>6} {'req/s':>8} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    ]
+    for endpoint, result in report["endpoints"].items():
+        lines.append(
+            f"{endpoint:<18} {result['requests']:>8} {result['errors']:>6} "
+            f"{result['throughput']:>8.1f} {result['p50_ms']:>8.1f} "
+            f"{result['p95_ms']:>8.1f} {result['p99_ms']:>8.1f}"
+        )
+
+    return "\n".join(lines)
+
+
+def load_report(path: str) -> dict[str, typing.Any]:
+    with open(path, encoding="utf-8") as report_file:
+        return json.load(report_file)
+
+
+def save_report(path: str, report: dict[str, typing.Any]) -> None:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    with open(path, "w", encoding="utf-8") as report_file:
+        json.dump(report, report_file, indent=2)
@@ -0,0 +1,76 @@
+import hashlib
+import json
+from uuid import uuid4
+
+from google.adk.events import Event
+from google.adk.sessions import BaseSessionService, Session
+from google.genai import types
+
+from .caching import TieredCache
+from .rag import RetrievedChunk
+from .text import normalize_text
+
+
+def fingerprint_chunks(chunks: list[RetrievedChunk]) -> str:
+    digest = hashlib.sha1()
+    for chunk in chunks:
+        digest.update(chunk.id.encode("utf-8"))
+        digest.update(hashlib.sha1(chunk.content.encode("utf-8")).digest())
+
+    return digest.hexdigest()
+
+
+def answer_cache_key(
+        cache: TieredCache,
+        user_query: str,
+        chunks: list[RetrievedChunk],
+        agent_version: str,
+) -> str:
+    return cache.key(
+        normalize_text(user_query),
+        fingerprint_chunks(chunks),
+        agent_version,
+    )
+
+
+def serialize_answer(response: str, author: str) -> bytes:
+    payload = {"response": response, "author": author}
+
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+
+def deserialize_answer(data: bytes) -> tuple[str, str]:
+    payload = json.loads(data.decode("utf-8"))
+
+    return payload["response"], payload["author"]
+
+
+async def replay_cached_answer(
+        session_service: BaseSessionService,
+        session: Session,
+        content: types.Content,
+        response: str,
+        author: str,
+) -> None:
+    """
+    Record a cached exchange in the session as if the runner produced it,
+    so follow-up questions still see the first question and its answer.
+    """
+
+    invocation_id = f"e-{uuid4()}"
+
+    await session_service.append_event(
+        session,
+        Event(invocation_id=invocation_id, author="user", content=content),
+    )
+    await session_service.append_event(
+        session,
+        Event(
+            invocation_id=invocation_id,
+            author=author,
+            content=types.Content(
+                role="model",
+                parts=[types.Part(text=response)],
+            ),
+        ),
+    )
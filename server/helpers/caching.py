@@ -0,0 +1,178 @@
+import hashlib
+import logging
+import time
+import typing
+
+import redis.asyncio as redis
+from cachetools import TTLCache
+
+logger = logging.getLogger("server_logs")
+
+
+class TieredCache:
+    """
+    Two-level cache: a per-worker TTL/LRU in front of Redis.
+
+    The Redis tier is shared by every worker. Its entries expire after
+    `remote_ttl` seconds and a sorted-set index, scored by write time,
+    keeps at most `remote_max_entries` of them. Redis failures are logged
+    and treated as misses so the cache never fails a request.
+    """
+
+    def __init__(
+            self,
+            namespace: str,
+            redis_client: redis.Redis,
+            local_maxsize: int = 1024,
+            local_ttl: float = 300.0,
+            remote_ttl: int = 3600,
+            remote_max_entries: int = 10_000,
+    ):
+        self._namespace = namespace
+        self._redis_client = redis_client
+        self._local: TTLCache[str, bytes] = TTLCache(
+            maxsize=local_maxsize,
+            ttl=local_ttl,
+        )
+        self._remote_ttl = remote_ttl
+        self._remote_max_entries = remote_max_entries
+        self._index_key = f"{namespace}:index"
+
+        self.local_hits = 0
+        self.remote_hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._miss_seconds = 0.0
+        self._timed_misses = 0
+
+    def key(self, *parts: str) -> str:
+        return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+    def _remote_key(self, key: str) -> str:
+        return f"{self._namespace}:{key}"
+
+    async def get(self, key: str) -> bytes | None:
+        value = self._local.get(key)
+        if value is not None:
+            self.local_hits += 1
+            return value
+
+        try:
+            value = await self._redis_client.get(self._remote_key(key))
+
+        except redis.RedisError as e:
+            self.errors += 1
+            logger.warning(f"Cache '{self._namespace}' read failed: {e}")
+            value = None
+
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.remote_hits += 1
+        self._local[key] = value
+
+        return value
+
+    def _tag_key(self, tag: str) -> str:
+        return f"{self._namespace}:tag:{tag}"
+
+    async def set(
+            self,
+            key: str,
+            value: bytes,
+            tags: typing.Iterable[str] = (),
+    ) -> None:
+        self._local[key] = value
+
+        now = time.time()
+        try:
+            async with self._redis_client.pipeline(transaction=False) as pipe:
+                pipe.set(self._remote_key(key), value, ex=self._remote_ttl)
+                for tag in tags:
+                    pipe.sadd(self._tag_key(tag), key)
+                    pipe.expire(self._tag_key(tag), self._remote_ttl)
+
+                pipe.zadd(self._index_key, {key: now})
+                pipe.zremrangebyscore(
+                    self._index_key,
+                    "-inf",
+                    now - self._remote_ttl,
+                )
+                pipe.zcard(self._index_key)
+                *_, size = await pipe.execute()
+
+            if size > self._remote_max_entries:
+                evicted = await self._redis_client.zpopmin(
+                    self._index_key,
+                    size - self._remote_max_entries,
+                )
+                if evicted:
+                    await self._redis_client.delete(*(
+                        self._remote_key(member.decode("utf-8"))
+                        for member, _ in evicted
+                    ))
+
+        except redis.RedisError as e:
+            self.errors += 1
+            logger.warning(f"Cache '{self._namespace}' write failed: {e}")
+
+    async def delete(self, *keys: str) -> None:
+        for key in keys:
+            self._local.pop(key, None)
+
+        if not keys:
+            return
+
+        async with self._redis_client.pipeline(transaction=False) as pipe:
+            pipe.delete(*(self._remote_key(key) for key in keys))
+            pipe.zrem(self._index_key, *keys)
+            await pipe.execute()
+
+    async def purge(self) -> int:
+        self._local.clear()
+
+        members = await self._redis_client.zrange(self._index_key, 0, -1)
+        keys = [member.decode("utf-8") for member in members]
+        await self.delete(*keys)
+        await self._redis_client.delete(self._index_key)
+
+        return len(keys)
+
+    async def purge_tag(self, tag: str) -> int:
+        """
+        Drop the entries stored with `tag`.
+
+        Only this worker's local tier is cleared; other workers keep their
+        local copies until `local_ttl` expires.
+        """
+
+        members = await self._redis_client.smembers(self._tag_key(tag))
+        keys = [member.decode("utf-8") for member in members]
+        await self.delete(*keys)
+        await self._redis_client.delete(self._tag_key(tag))
+
+        return len(keys)
+
+    def record_miss_latency(self, seconds: float) -> None:
+        self._miss_seconds += seconds
+        self._timed_misses += 1
+
+    def stats(self) -> dict[str, int | float]:
+        hits = self.local_hits + self.remote_hits
+        lookups = hits + self.misses
+        average_miss_seconds = (
+            self._miss_seconds / self._timed_misses
+            if self._timed_misses else 0.0
+        )
+
+        return {
+            "local_hits": self.local_hits,
+            "remote_hits": self.remote_hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+            "average_miss_seconds": round(average_miss_seconds, 4),
+            "estimated_seconds_saved": round(hits * average_miss_seconds, 2),
+            "local_entries": len(self._local),
+        }
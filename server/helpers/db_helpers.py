@@ -1,30 +1,287 @@
+import asyncio
+import logging
 import os
+import typing
+
 import psycopg2
+from psycopg2.extensions import connection as Connection
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+
+from .metrics import timed
+
+T = typing.TypeVar("T")
+
+logger = logging.getLogger("server_logs")
+
+RATINGS = ("bad", "good", "excellent")
+
+UPSERT_RATINGS_QUERY = """
+INSERT INTO users_rate_tb (request_user_id, rating)
+VALUES %s
+ON CONFLICT (request_user_id)
+DO UPDATE SET
+    rating = EXCLUDED.rating,
+    updated_at = CURRENT_TIMESTAMP;
+"""
+
+# Created by the server when its pool opens (see ensure_rating_counters).
+# The trigger runs inside the upsert's transaction, so the counters always
+# match users_rate_tb, including rating changes made by ON CONFLICT DO
+# UPDATE.
+RATING_COUNTERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users_rate_counters_tb (
+    rating VARCHAR(9) PRIMARY KEY,
+    total BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE OR REPLACE FUNCTION update_users_rate_counters()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.rating IS NOT DISTINCT FROM NEW.rating THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE users_rate_counters_tb
+        SET total = total - 1
+        WHERE rating = LOWER(OLD.rating);
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO users_rate_counters_tb (rating, total)
+        VALUES (LOWER(NEW.rating), 1)
+        ON CONFLICT (rating)
+        DO UPDATE SET
+            total = users_rate_counters_tb.total + 1;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER users_rate_counters_trigger
+AFTER INSERT OR DELETE OR UPDATE OF rating ON users_rate_tb
+FOR EACH ROW EXECUTE FUNCTION update_users_rate_counters();
+"""
+
+COUNT_RATINGS_QUERY = """
+SELECT
+    rating, total
+FROM
+    users_rate_counters_tb;
+"""
+
+REBUILD_RATING_COUNTERS_QUERY = """
+LOCK TABLE users_rate_tb IN SHARE MODE;
+
+DELETE FROM users_rate_counters_tb;
+
+INSERT INTO users_rate_counters_tb (rating, total)
+SELECT
+    LOWER(rating), COUNT(rating)
+FROM
+    users_rate_tb
+GROUP BY
+    LOWER(rating);
+"""
+
 
+# Serializes the check-and-create below across workers starting together.
+RATING_COUNTERS_LOCK_QUERY = "SELECT pg_advisory_xact_lock(hashtext(%s));"
 
-def get_db_connection_sync():
-    # TODO: host is not on the environment
-    return psycopg2.connect(
-        host="postgres",
+
+class ConnectionPool:
+    """
+    A psycopg2 connection pool usable from async code.
+
+    psycopg2 is blocking, so every unit of work runs on a worker thread
+    while holding one pooled connection; the semaphore makes callers wait
+    for a free connection instead of exhausting the pool.
+    """
+
+    def __init__(self, minconn: int, maxconn: int, **connect_kwargs):
+        self._minconn = minconn
+        self._maxconn = maxconn
+        self._connect_kwargs = connect_kwargs
+        self._pool: ThreadedConnectionPool | None = None
+        self._semaphore = asyncio.Semaphore(maxconn)
+
+    async def open(self) -> None:
+        self._pool = await asyncio.to_thread(
+            ThreadedConnectionPool,
+            self._minconn,
+            self._maxconn,
+            **self._connect_kwargs,
+        )
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            await asyncio.to_thread(self._pool.closeall)
+
+    async def run(
+            self,
+            func: typing.Callable[..., T],
+            *args: typing.Any,
+    ) -> T:
+        async with self._semaphore:
+            return await asyncio.to_thread(self._run_sync, func, *args)
+
+    def _run_sync(self, func: typing.Callable[..., T], *args: typing.Any) -> T:
+        if self._pool is None:
+            raise RuntimeError("The connection pool is not open.")
+
+        conn = self._pool.getconn()
+        broken = False
+        try:
+            # The connection context manager commits on success and rolls
+            # back on error; it does not close the connection.
+            with conn:
+                return func(conn, *args)
+
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+
+        finally:
+            self._pool.putconn(conn, close=broken or bool(conn.closed))
+
+
+async def instantiate_db_pool(
+        minconn: int = 1,
+        maxconn: int = 10,
+) -> ConnectionPool:
+    pool = ConnectionPool(
+        minconn,
+        maxconn,
+        host=os.environ.get("POSTGRES_HOST", "postgres"),
         database=os.environ["POSTGRES_DB"],
         user=os.environ["POSTGRES_USER"],
         password=os.environ["POSTGRES_PASSWORD"],
-        port=5432
+        port=int(os.environ.get("POSTGRES_PORT", 5432)),
     )
-# TODO: port is not too
+    await pool.open()
+    await ensure_rating_counters(pool)
+
+    return pool
+
 
+def _save_ratings_sync(
+        conn: Connection,
+        ratings: list[tuple[int, str]],
+) -> None:
+    with conn.cursor() as cur:
+        execute_values(cur, UPSERT_RATINGS_QUERY, ratings)
 
-def save_rating_sync(request_user_id: int, rating: int):
-    query = """
-    INSERT INTO users_rate_tb (request_user_id, rating)
-    VALUES (%s, %s)
-    ON CONFLICT (request_user_id)
-    DO UPDATE SET
-        rating = EXCLUDED.rating,
-        updated_at = CURRENT_TIMESTAMP;
+
+def _count_ratings_sync(conn: Connection) -> list[tuple[str, int]]:
+    with conn.cursor() as cur:
+        cur.execute(COUNT_RATINGS_QUERY)
+
+        return cur.fetchall()
+
+
+def _ensure_rating_counters_sync(conn: Connection) -> None:
+    with conn.cursor() as cur:
+        cur.execute(RATING_COUNTERS_LOCK_QUERY, ("users_rate_counters_tb",))
+        cur.execute("SELECT to_regclass('users_rate_counters_tb');")
+        if cur.fetchone()[0] is not None:
+            return
+
+        logger.info("Creating the rating counters from users_rate_tb")
+        cur.execute(RATING_COUNTERS_SCHEMA)
+        cur.execute(REBUILD_RATING_COUNTERS_QUERY)
+
+
+def _rebuild_rating_counters_sync(conn: Connection) -> None:
+    with conn.cursor() as cur:
+        cur.execute(RATING_COUNTERS_SCHEMA)
+        cur.execute(REBUILD_RATING_COUNTERS_QUERY)
+
+
+@timed("postgres.save_ratings")
+async def save_ratings(
+        pool: ConnectionPool,
+        ratings: list[tuple[int, str]],
+) -> None:
+    await pool.run(_save_ratings_sync, ratings)
+
+
+@timed("postgres.count_ratings")
+async def retrieve_rating_counts(
+        pool: ConnectionPool,
+) -> list[tuple[str, int]]:
+    return await pool.run(_count_ratings_sync)
+
+
+async def ensure_rating_counters(pool: ConnectionPool) -> None:
+    """
+    Create the counters table and its trigger, filled from the existing
+    ratings, on databases that predate them. Does nothing once they exist.
+    """
+
+    await pool.run(_ensure_rating_counters_sync)
+
+
+async def rebuild_rating_counters(pool: ConnectionPool) -> None:
+    await pool.run(_rebuild_rating_counters_sync)
+
+
+class RatingWriteBuffer:
     """
+    Write-behind buffer for rating upserts.
+
+    Ratings are kept per user (the latest one wins, which also keeps a
+    batch free of duplicate keys for ON CONFLICT) and written as a single
+    multi-row upsert once `max_size` users are pending or every
+    `flush_interval` seconds.
+    """
+
+    def __init__(
+            self,
+            pool: ConnectionPool,
+            max_size: int = 100,
+            flush_interval: float = 1.0,
+    ):
+        self._pool = pool
+        self._max_size = max_size
+        self._flush_interval = flush_interval
+        self._pending: dict[int, str] = {}
+        self._flush_lock = asyncio.Lock()
+
+    async def add(self, request_user_id: int, rating: str) -> None:
+        self._pending[request_user_id] = rating
+
+        if len(self._pending) >= self._max_size:
+            try:
+                await self.flush()
+
+            except Exception as e:
+                # The batch went back into the buffer and will be retried.
+                logger.error(f"Database error flushing ratings: {e}")
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._pending:
+                return
+
+            pending, self._pending = self._pending, {}
+            try:
+                await save_ratings(self._pool, list(pending.items()))
+
+            except Exception:
+                # Ratings received during the flush are newer, keep them.
+                for request_user_id, rating in pending.items():
+                    self._pending.setdefault(request_user_id, rating)
+
+                raise
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self._flush_interval)
+
+            try:
+                await self.flush()
 
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(query, (request_user_id, rating))
-        conn.commit()
+            except Exception as e:
+                logger.error(f"Database error flushing ratings: {e}")
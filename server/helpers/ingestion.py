@@ -0,0 +1,307 @@
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import os
+import typing
+
+import httpx
+import numpy as np
+
+from .law_parser import iter_statute_units
+from .local_index import (
+    IndexUnit,
+    iter_index_units,
+    LocalIndexWriter,
+    read_index_vectors,
+)
+from .rag import (
+    add_chunk,
+    delete_chunks,
+    RAGFlowError,
+    resolve_dataset_id,
+    update_chunk,
+    upload_document,
+)
+
+logger = logging.getLogger("server_logs")
+
+# (path, document id) pairs, e.g. ("laws/clt.txt", "clt")
+Sources = list[tuple[str, str]]
+TextEmbedder = typing.Callable[[list[str]], typing.Awaitable[np.ndarray]]
+
+
+class IngestionPlan(typing.NamedTuple):
+    hashes: dict[str, str]
+    changed: list[IndexUnit]
+    removed: list[str]
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.changed and not self.removed
+
+
+def content_hash(unit: IndexUnit) -> str:
+    return hashlib.sha256(unit.content.encode("utf-8")).hexdigest()
+
+
+def load_manifest(path: str) -> dict[str, typing.Any]:
+    """
+    The manifest maps every ingested unit id to its content hash, its
+    document and, for RAGFlow, its chunk id; and every document id to its
+    RAGFlow document.
+    """
+
+    if not os.path.exists(path):
+        return {"documents": {}, "units": {}}
+
+    with open(path, encoding="utf-8") as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(path: str, manifest: dict[str, typing.Any]) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, ensure_ascii=False)
+
+    os.replace(tmp_path, path)
+
+
+def iter_source_units(sources: Sources) -> typing.Iterator[IndexUnit]:
+    for path, document_id in sources:
+        # Some codes repeat a number (e.g. a revoked article kept next to
+        # its replacement), so repeated ids get a suffix to stay unique.
+        seen: collections.Counter[str] = collections.Counter()
+        for unit in iter_statute_units(path, document_id):
+            seen[unit.id] += 1
+            if seen[unit.id] > 1:
+                unit = unit._replace(id=f"{unit.id}~{seen[unit.id]}")
+
+            yield unit
+
+
+def plan_ingestion(
+        units: typing.Iterable[IndexUnit],
+        manifest: dict[str, typing.Any],
+        document_ids: set[str],
+        keep_content: bool = True,
+) -> IngestionPlan:
+    """
+    Compare parsed units with the manifest. Only changed units are kept in
+    memory, without their content unless `keep_content` is set; units of
+    `document_ids` missing from the parse are removed.
+    """
+
+    hashes: dict[str, str] = {}
+    changed: list[IndexUnit] = []
+    for unit in units:
+        unit_hash = content_hash(unit)
+        hashes[unit.id] = unit_hash
+
+        if manifest["units"].get(unit.id, {}).get("hash") != unit_hash:
+            changed.append(unit if keep_content else unit._replace(content=""))
+
+    removed = [
+        unit_id
+        for unit_id, entry in manifest["units"].items()
+        if entry["document_id"] in document_ids and unit_id not in hashes
+    ]
+
+    return IngestionPlan(hashes, changed, removed)
+
+
+def _record_units(
+        manifest: dict[str, typing.Any],
+        plan: IngestionPlan,
+        units: typing.Iterable[IndexUnit],
+) -> None:
+    for unit in units:
+        entry = manifest["units"].setdefault(unit.id, {})
+        entry["hash"] = plan.hashes[unit.id]
+        entry["document_id"] = unit.document_id
+
+
+async def ingest_into_local_index(
+        index_dir: str,
+        sources: Sources,
+        manifest: dict[str, typing.Any],
+        embed_texts: TextEmbedder | None = None,
+        batch_size: int = 100,
+) -> IngestionPlan:
+    """
+    Bring the local index up to date with `sources`.
+
+    Postings are rebuilt as a new index generation, which takes seconds for
+    the law codes; the expensive part, embedding, is only redone for
+    changed units. Units of documents not in `sources` are carried over.
+    Units are streamed from the previous index and the sources into the
+    new one, `batch_size` at a time, so memory does not grow with the
+    corpus beyond the postings.
+    """
+
+    document_ids = {document_id for _, document_id in sources}
+    plan = plan_ingestion(
+        iter_source_units(sources),
+        manifest,
+        document_ids,
+        keep_content=False,
+    )
+
+    previous_vectors = read_index_vectors(index_dir)
+    previous_rows = {
+        unit.id: row for row, unit in enumerate(iter_index_units(index_dir))
+    }
+    needs_vectors = embed_texts is not None and previous_vectors is None
+    if plan.is_empty and previous_rows and not needs_vectors:
+        return plan
+
+    changed_ids = {unit.id for unit in plan.changed}
+    if previous_vectors is None:
+        previous_rows = {}
+
+    def iter_units() -> typing.Iterator[IndexUnit]:
+        for unit in iter_index_units(index_dir):
+            if unit.document_id not in document_ids:
+                yield unit
+
+        yield from iter_source_units(sources)
+
+    writer = LocalIndexWriter(index_dir)
+
+    async def write_batch(batch: list[IndexUnit]) -> None:
+        if embed_texts is None:
+            for unit in batch:
+                writer.add(unit)
+
+            return
+
+        to_embed = [
+            unit for unit in batch
+            if unit.id in changed_ids or unit.id not in previous_rows
+        ]
+        embedded: dict[str, np.ndarray] = {}
+        if to_embed:
+            embedded = dict(zip(
+                (unit.id for unit in to_embed),
+                await embed_texts([unit.content for unit in to_embed]),
+            ))
+
+        for unit in batch:
+            vector = embedded.get(unit.id)
+            if vector is None:
+                vector = previous_vectors[previous_rows[unit.id]]
+
+            writer.add(unit, vector)
+
+    batch: list[IndexUnit] = []
+    for unit in iter_units():
+        batch.append(unit)
+        if len(batch) >= batch_size:
+            await write_batch(batch)
+            batch = []
+
+    await write_batch(batch)
+    writer.commit()
+
+    _record_units(manifest, plan, plan.changed)
+    for unit_id in plan.removed:
+        manifest["units"].pop(unit_id, None)
+
+    return plan
+
+
+async def ingest_into_ragflow(
+        rag_object: httpx.AsyncClient,
+        dataset_name: str,
+        sources: Sources,
+        manifest: dict[str, typing.Any],
+        concurrency: int = 8,
+) -> tuple[IngestionPlan, int]:
+    """
+    Upsert changed units as chunks of one RAGFlow document per source.
+
+    The manifest is updated as each call succeeds, so failed units keep
+    their old hash and are retried by the next run. Returns the plan and
+    the number of failed operations.
+    """
+
+    document_ids = {document_id for _, document_id in sources}
+    plan = plan_ingestion(iter_source_units(sources), manifest, document_ids)
+    if plan.is_empty:
+        return plan, 0
+
+    dataset_id = await resolve_dataset_id(dataset_name, rag_object)
+
+    documents = manifest["documents"]
+    for document_id in sorted(document_ids - documents.keys()):
+        documents[document_id] = await upload_document(
+            rag_object,
+            dataset_id,
+            f"{document_id}.txt",
+            f"{document_id}\n".encode("utf-8"),
+        )
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def upsert(unit: IndexUnit) -> None:
+        async with semaphore:
+            ragflow_document_id = documents[unit.document_id]
+            chunk_id = manifest["units"].get(unit.id, {}).get("chunk_id")
+            if chunk_id:
+                await update_chunk(
+                    rag_object,
+                    dataset_id,
+                    ragflow_document_id,
+                    chunk_id,
+                    unit.content,
+                )
+            else:
+                chunk_id = await add_chunk(
+                    rag_object,
+                    dataset_id,
+                    ragflow_document_id,
+                    unit.content,
+                )
+
+            _record_units(manifest, plan, (unit,))
+            manifest["units"][unit.id]["chunk_id"] = chunk_id
+
+    results = await asyncio.gather(
+        *(upsert(unit) for unit in plan.changed),
+        return_exceptions=True,
+    )
+    failures = [result for result in results if isinstance(result, Exception)]
+    for failure in failures:
+        logger.error(f"Could not upsert unit: {failure}")
+
+    removed_by_document: dict[str, list[str]] = collections.defaultdict(list)
+    for unit_id in plan.removed:
+        entry = manifest["units"][unit_id]
+        if entry.get("chunk_id"):
+            removed_by_document[entry["document_id"]].append(unit_id)
+        else:
+            manifest["units"].pop(unit_id)
+
+    for document_id, unit_ids in removed_by_document.items():
+        chunk_ids = [
+            manifest["units"][unit_id]["chunk_id"] for unit_id in unit_ids
+        ]
+        try:
+            await delete_chunks(
+                rag_object,
+                dataset_id,
+                documents[document_id],
+                chunk_ids,
+            )
+
+        except (httpx.HTTPError, RAGFlowError) as e:
+            logger.error(f"Could not delete chunks of {document_id}: {e}")
+            failures.append(e)
+
+            continue
+
+        for unit_id in unit_ids:
+            manifest["units"].pop(unit_id, None)
+
+    return plan, len(failures)
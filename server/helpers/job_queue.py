@@ -0,0 +1,309 @@
+import hashlib
+import hmac
+import json
+import logging
+import time
+import typing
+from urllib.parse import urlsplit
+from uuid import uuid4
+
+import redis.asyncio as redis
+
+from .metrics import REGISTRY
+
+logger = logging.getLogger("server_logs")
+
+JOBS = REGISTRY.counter(
+    "legal_assistant_jobs_total",
+    "Background jobs by outcome: enqueued, completed, retried, reclaimed "
+    "(from a worker that died), expired (its client stopped waiting) or "
+    "dead_lettered.",
+    ("outcome",),
+)
+
+
+def is_allowed_callback_url(
+        callback_url: typing.Any,
+        allowed_hosts: typing.Collection[str],
+) -> bool:
+    """Whether `callback_url` is an http(s) URL on one of `allowed_hosts`."""
+
+    if not isinstance(callback_url, str):
+        return False
+
+    try:
+        url = urlsplit(callback_url)
+        hostname = url.hostname
+        url.port  # Raises on a malformed port.
+
+    except ValueError:
+        return False
+
+    return url.scheme in ("http", "https") and hostname in allowed_hosts
+
+
+def sign_callback(secret: str, body: bytes) -> str:
+    """HMAC-SHA256 of a callback body, hex-encoded."""
+
+    return hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+
+class Job(typing.NamedTuple):
+    message_id: bytes
+    job_id: str
+    payload: dict[str, typing.Any]
+    # Set on retried jobs, whose stream entries are newer than the job.
+    first_enqueued_at: float | None = None
+
+    @property
+    def enqueued_at(self) -> float:
+        if self.first_enqueued_at is not None:
+            return self.first_enqueued_at
+
+        # Stream ids start with the entry's creation time in milliseconds.
+        return int(self.message_id.split(b"-")[0]) / 1000
+
+
+def _parse_entries(entries: list) -> list[Job]:
+    return [
+        Job(
+            message_id=message_id,
+            job_id=fields[b"job_id"].decode("utf-8"),
+            payload=json.loads(fields[b"payload"]),
+            first_enqueued_at=(
+                float(fields[b"enqueued_at"])
+                if b"enqueued_at" in fields
+                else None
+            ),
+        )
+        for message_id, fields in entries
+        # XAUTOCLAIM reports entries trimmed from the stream as empty.
+        if fields
+    ]
+
+
+class JobQueue:
+    """
+    Jobs on a Redis Stream, shared by a consumer group.
+
+    Every job also has a hash, `{name}:job:{job_id}`, with its status,
+    attempts and, once done, its result, which outlives the stream entry
+    for `result_ttl` seconds. A job that raises is added to the stream
+    again at once; one whose worker died stays pending until it has been
+    idle for `claim_idle` seconds and is claimed by another consumer. After
+    `max_attempts` it goes to the `{name}:dead` stream instead.
+    """
+
+    def __init__(
+            self,
+            redis_client: redis.Redis,
+            name: str = "query_jobs",
+            group: str = "query_workers",
+            max_attempts: int = 3,
+            claim_idle: float = 330.0,
+            claim_interval: float = 30.0,
+            result_ttl: int = 3600,
+            max_length: int = 100_000,
+    ):
+        self.redis_client = redis_client
+        self.name = name
+        self.group = group
+        self.dead_letters = f"{name}:dead"
+        self.max_attempts = max_attempts
+        self._claim_idle = claim_idle
+        self._claim_interval = claim_interval
+        self._result_ttl = result_ttl
+        self._max_length = max_length
+        self._claimed_at = 0.0
+
+    def _job_key(self, job_id: str) -> str:
+        return f"{self.name}:job:{job_id}"
+
+    async def ensure_group(self) -> None:
+        try:
+            # From the start of the stream, so jobs enqueued before the
+            # first worker ever ran are not skipped.
+            await self.redis_client.xgroup_create(
+                self.name,
+                self.group,
+                id="0",
+                mkstream=True,
+            )
+
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def enqueue(self, payload: dict[str, typing.Any]) -> str:
+        job_id = uuid4().hex
+        job_key = self._job_key(job_id)
+
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.hset(job_key, mapping={"status": "queued", "attempts": 0})
+            pipe.expire(job_key, self._result_ttl)
+            pipe.xadd(
+                self.name,
+                {"job_id": job_id, "payload": json.dumps(payload)},
+                maxlen=self._max_length,
+                approximate=True,
+            )
+            await pipe.execute()
+
+        JOBS.inc(outcome="enqueued")
+
+        return job_id
+
+    async def read(
+            self,
+            consumer: str,
+            block: float = 2.0,
+    ) -> list[Job]:
+        """
+        The next job for `consumer`: one left behind by a dead worker if
+        it is time to look for those, else a new one, waiting up to
+        `block` seconds for it.
+        """
+
+        now = time.monotonic()
+        if now - self._claimed_at >= self._claim_interval:
+            self._claimed_at = now
+            response = await self.redis_client.xautoclaim(
+                self.name,
+                self.group,
+                consumer,
+                min_idle_time=int(self._claim_idle * 1000),
+                count=1,
+            )
+            jobs = _parse_entries(response[1])
+            if jobs:
+                JOBS.inc(outcome="reclaimed")
+                # There may be more to claim.
+                self._claimed_at = 0.0
+
+                return jobs
+
+        response = await self.redis_client.xreadgroup(
+            self.group,
+            consumer,
+            {self.name: ">"},
+            count=1,
+            block=int(block * 1000),
+        )
+        if not response:
+            return []
+
+        return _parse_entries(response[0][1])
+
+    async def begin(self, job: Job) -> int | None:
+        """
+        Count an attempt at `job` and return its number, or None if the
+        job already finished and only its acknowledgement was lost.
+        """
+
+        job_key = self._job_key(job.job_id)
+        if await self.redis_client.hget(job_key, "status") in (
+            b"done",
+            b"failed",
+        ):
+            return None
+
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.hincrby(job_key, "attempts", 1)
+            pipe.hset(job_key, "status", "running")
+            pipe.expire(job_key, self._result_ttl)
+            attempts, _, _ = await pipe.execute()
+
+        return attempts
+
+    async def retrieve(self, job_id: str) -> dict[str, typing.Any] | None:
+        record = await self.redis_client.hgetall(self._job_key(job_id))
+        if not record:
+            return None
+
+        job = {
+            "job_id": job_id,
+            "status": record[b"status"].decode("utf-8"),
+            "attempts": int(record.get(b"attempts", 0)),
+        }
+        if b"result" in record:
+            job.update(json.loads(record[b"result"]))
+
+        return job
+
+    async def complete(
+            self,
+            job: Job,
+            result: dict[str, typing.Any],
+            status: str = "done",
+    ) -> None:
+        """Store `result` where `retrieve` finds it and acknowledge `job`."""
+
+        job_key = self._job_key(job.job_id)
+
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.hset(
+                job_key,
+                mapping={"status": status, "result": json.dumps(result)},
+            )
+            pipe.expire(job_key, self._result_ttl)
+            pipe.xack(self.name, self.group, job.message_id)
+            pipe.xdel(self.name, job.message_id)
+            await pipe.execute()
+
+        if status == "done":
+            JOBS.inc(outcome="completed")
+
+    async def acknowledge(self, job: Job) -> None:
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.xack(self.name, self.group, job.message_id)
+            pipe.xdel(self.name, job.message_id)
+            await pipe.execute()
+
+    async def retry(self, job: Job) -> None:
+        """Put `job` back at the end of the stream."""
+
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.xadd(
+                self.name,
+                {
+                    "job_id": job.job_id,
+                    "payload": json.dumps(job.payload),
+                    "enqueued_at": job.enqueued_at,
+                },
+                maxlen=self._max_length,
+                approximate=True,
+            )
+            pipe.xack(self.name, self.group, job.message_id)
+            pipe.xdel(self.name, job.message_id)
+            await pipe.execute()
+
+        JOBS.inc(outcome="retried")
+
+    async def expire(self, job: Job, result: dict[str, typing.Any]) -> None:
+        """Give up on `job` because nobody waits for its result anymore."""
+
+        await self.complete(job, result, status="failed")
+
+        JOBS.inc(outcome="expired")
+
+    async def dead_letter(
+            self,
+            job: Job,
+            result: dict[str, typing.Any],
+            reason: str,
+    ) -> None:
+        """Give up on `job`, keeping it for inspection in `dead_letters`."""
+
+        await self.redis_client.xadd(
+            self.dead_letters,
+            {
+                "job_id": job.job_id,
+                "payload": json.dumps(job.payload),
+                "reason": reason,
+            },
+            maxlen=self._max_length,
+            approximate=True,
+        )
+        await self.complete(job, result, status="failed")
+
+        JOBS.inc(outcome="dead_lettered")
@@ -0,0 +1,156 @@
+import re
+import typing
+
+from .local_index import IndexUnit
+
+ARTICLE_PATTERN = re.compile(
+    r"^Art\.?\s*(\d[\d.]*)\s*[º°o]?\s*(-[A-Z])?"
+    r"\s*\.?\s*(?:[-–—]\s*)?(.*)$",
+)
+PARAGRAPH_PATTERN = re.compile(
+    r"^§\s*(\d+)\s*[º°o]?\s*\.?\s*(?:[-–—]\s*)?(.*)$",
+)
+SOLE_PARAGRAPH_PATTERN = re.compile(
+    r"^Par[áa]grafo\s+[úu]nico\s*\.?\s*(?:[-–—]\s*)?(.*)$",
+    re.IGNORECASE,
+)
+INCISO_PATTERN = re.compile(r"^([IVXLCDM]+)\s*[-–—]\s*(.*)$")
+# Structural headings (LIVRO I, TÍTULO II, CAPÍTULO III, Seção IV...) are
+# not part of any article.
+HEADING_PATTERN = re.compile(
+    r"^(LIVRO|T[ÍI]TULO|CAP[ÍI]TULO|SE[ÇC][ÃA]O|SUBSE[ÇC][ÃA]O|"
+    r"Se[çc][ãa]o|Subse[çc][ãa]o)\b",
+)
+
+
+class _PendingUnit:
+    def __init__(
+            self,
+            unit_id: str,
+            label: str,
+            text: str,
+            context: str = "",
+    ):
+        self.unit_id = unit_id
+        self.label = label
+        self.lines = [text] if text else []
+        self.context = context
+
+    @property
+    def text(self) -> str:
+        return " ".join(self.lines)
+
+    def to_index_unit(self, document_id: str) -> IndexUnit:
+        # Incisos are meaningless without the sentence that introduces
+        # them, so that sentence is repeated in front of them.
+        parts = [f"{document_id.upper()} {self.label}"]
+        if self.context:
+            parts.append(self.context)
+        parts.append(self.text)
+
+        return IndexUnit(
+            id=self.unit_id,
+            document_id=document_id,
+            content=" ".join(parts),
+        )
+
+
+def parse_statute(
+        lines: typing.Iterable[str],
+        document_id: str,
+) -> typing.Iterator[IndexUnit]:
+    """
+    Split a statute into article, paragraph (§) and inciso units.
+
+    Lines are consumed one at a time and each unit is yielded as soon as
+    the next one starts, so only the current article is held in memory.
+    Alíneas and wrapped lines are folded into the unit they belong to.
+    """
+
+    article: str | None = None
+    parent_id = ""
+    parent_label = ""
+    parent_text = ""
+    pending: _PendingUnit | None = None
+
+    for raw_line in lines:
+        line = " ".join(raw_line.split())
+        if not line:
+            continue
+
+        if HEADING_PATTERN.match(line):
+            if pending is not None:
+                yield pending.to_index_unit(document_id)
+            pending = None
+
+            continue
+
+        if match := ARTICLE_PATTERN.match(line):
+            if pending is not None:
+                yield pending.to_index_unit(document_id)
+
+            number, suffix, text = match.groups()
+            article = number.rstrip(".") + (suffix or "")
+            parent_id = f"{document_id}:art-{article}"
+            parent_label = f"Art. {article}"
+            parent_text = text
+            pending = _PendingUnit(parent_id, parent_label, text)
+
+            continue
+
+        if article is None:
+            # Preamble before the first article.
+            continue
+
+        paragraph_match = PARAGRAPH_PATTERN.match(line)
+        sole_match = SOLE_PARAGRAPH_PATTERN.match(line)
+        if paragraph_match or sole_match:
+            if pending is not None:
+                yield pending.to_index_unit(document_id)
+
+            if paragraph_match:
+                number, text = paragraph_match.groups()
+                label = f"Art. {article}, § {number}"
+            else:
+                number, text = "unico", sole_match.group(1)
+                label = f"Art. {article}, parágrafo único"
+
+            parent_id = f"{document_id}:art-{article}:par-{number}"
+            parent_label = label
+            parent_text = text
+            pending = _PendingUnit(parent_id, label, text)
+
+            continue
+
+        if match := INCISO_PATTERN.match(line):
+            if pending is not None:
+                yield pending.to_index_unit(document_id)
+
+            inciso, text = match.groups()
+            pending = _PendingUnit(
+                f"{parent_id}:inc-{inciso}",
+                f"{parent_label}, {inciso}",
+                text,
+                context=parent_text,
+            )
+
+            continue
+
+        if pending is not None:
+            # Alíneas and wrapped lines belong to the current unit, and an
+            # article or paragraph introduction keeps growing until its
+            # first inciso.
+            pending.lines.append(line)
+            if pending.unit_id == parent_id:
+                parent_text = pending.text
+
+    if pending is not None:
+        yield pending.to_index_unit(document_id)
+
+
+def iter_statute_units(
+        path: str,
+        document_id: str,
+) -> typing.Iterator[IndexUnit]:
+    with open(path, encoding="utf-8") as statute_file:
+        yield from parse_statute(statute_file, document_id)
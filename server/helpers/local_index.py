@@ -0,0 +1,393 @@
+import array
+import collections
+import json
+import logging
+import os
+import typing
+
+import numpy as np
+from google import genai
+
+from .metrics import timed
+from .rag import RetrievedChunk
+from .text import content_words
+
+logger = logging.getLogger("server_logs")
+
+META_FILENAME = "meta.json"
+
+
+class IndexUnit(typing.NamedTuple):
+    id: str
+    document_id: str
+    content: str
+
+
+def _generation_path(index_dir: str, generation: int, name: str) -> str:
+    return os.path.join(index_dir, f"{generation}-{name}")
+
+
+def _read_meta(index_dir: str) -> dict[str, typing.Any]:
+    with open(os.path.join(index_dir, META_FILENAME), encoding="utf-8") as f:
+        return json.load(f)
+
+
+class LocalIndexWriter:
+    """
+    Build the next generation of a BM25 index (and optional dense vectors)
+    one unit at a time, so the corpus never has to be in memory at once.
+
+    Units go straight to disk, and so do vectors, normalized, until
+    `commit` copies them into place. Only the postings stay in memory, as
+    compact arrays. Every build is a new generation of files. meta.json,
+    which names the current generation, is swapped in last with os.replace,
+    so readers see either the old index or the new one. The generation
+    before the previous one is removed, leaving time for readers still
+    using it.
+    """
+
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        os.makedirs(index_dir, exist_ok=True)
+
+        self._previous_generation = -1
+        if os.path.exists(os.path.join(index_dir, META_FILENAME)):
+            self._previous_generation = _read_meta(index_dir)["generation"]
+        self.generation = self._previous_generation + 1
+
+        self._postings: dict[str, tuple[array.array, array.array]] = (
+            collections.defaultdict(
+                lambda: (array.array("i"), array.array("f")),
+            )
+        )
+        self._doc_lengths = array.array("i")
+        self._units_file = open(
+            self._path("units.jsonl"),
+            "w",
+            encoding="utf-8",
+        )
+        self._vectors_file: typing.BinaryIO | None = None
+        self._dimensions = 0
+
+    def _path(self, name: str) -> str:
+        return _generation_path(self.index_dir, self.generation, name)
+
+    def add(self, unit: IndexUnit, vector: np.ndarray | None = None) -> None:
+        """Append `unit`; every unit has a vector, or none does."""
+
+        doc = len(self._doc_lengths)
+        if doc and (vector is None) != (self._vectors_file is None):
+            raise ValueError("Either every unit has a vector or none does.")
+
+        self._units_file.write(
+            json.dumps(unit._asdict(), ensure_ascii=False) + "\n",
+        )
+
+        words = content_words(unit.content)
+        self._doc_lengths.append(len(words))
+        for term, frequency in collections.Counter(words).items():
+            docs, frequencies = self._postings[term]
+            docs.append(doc)
+            frequencies.append(frequency)
+
+        if vector is None:
+            return
+
+        vector = np.asarray(vector, dtype=np.float32)
+        if self._vectors_file is None:
+            self._dimensions = len(vector)
+            self._vectors_file = open(self._path("vectors.raw"), "wb")
+
+        norm = max(float(np.linalg.norm(vector)), 1e-12)
+        self._vectors_file.write((vector / norm).tobytes())
+
+    def _write_vectors(self, doc_count: int, chunk_rows: int = 4096) -> None:
+        self._vectors_file.close()
+
+        raw_path = self._path("vectors.raw")
+        shape = (doc_count, self._dimensions)
+        vectors = np.lib.format.open_memmap(
+            self._path("vectors.npy"),
+            mode="w+",
+            dtype=np.float32,
+            shape=shape,
+        )
+        if doc_count:
+            raw = np.memmap(raw_path, dtype=np.float32, mode="r", shape=shape)
+            for start in range(0, doc_count, chunk_rows):
+                vectors[start:start + chunk_rows] = raw[
+                    start:start + chunk_rows
+                ]
+            del raw
+
+        vectors.flush()
+        del vectors
+        os.remove(raw_path)
+
+    def commit(self) -> int:
+        """
+        Write the postings and make this generation current. Returns the
+        number of units written.
+        """
+
+        self._units_file.close()
+        doc_count = len(self._doc_lengths)
+
+        terms = sorted(self._postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        for row, term in enumerate(terms):
+            offsets[row + 1] = offsets[row] + len(self._postings[term][0])
+
+        postings_docs = np.empty(offsets[-1], dtype=np.int32)
+        postings_tfs = np.empty(offsets[-1], dtype=np.float32)
+        for row, term in enumerate(terms):
+            docs, frequencies = self._postings.pop(term)
+            postings_docs[offsets[row]:offsets[row + 1]] = docs
+            postings_tfs[offsets[row]:offsets[row + 1]] = frequencies
+
+        arrays = {
+            "offsets.npy": offsets,
+            "postings_docs.npy": postings_docs,
+            "postings_tfs.npy": postings_tfs,
+            "doc_lengths.npy": np.asarray(
+                self._doc_lengths,
+                dtype=np.float32,
+            ),
+        }
+        for name, values in arrays.items():
+            np.save(self._path(name), values)
+
+        has_vectors = self._vectors_file is not None
+        if has_vectors:
+            self._write_vectors(doc_count)
+
+        with open(self._path("terms.json"), "w", encoding="utf-8") as f:
+            json.dump(terms, f, ensure_ascii=False)
+
+        total_length = sum(self._doc_lengths)
+        meta = {
+            "generation": self.generation,
+            "doc_count": doc_count,
+            "avg_doc_length": total_length / doc_count if doc_count else 0.0,
+            "has_vectors": has_vectors,
+        }
+        meta_tmp_path = os.path.join(self.index_dir, f"{META_FILENAME}.tmp")
+        with open(meta_tmp_path, "w", encoding="utf-8") as meta_file:
+            json.dump(meta, meta_file)
+
+        os.replace(meta_tmp_path, os.path.join(self.index_dir, META_FILENAME))
+
+        stale_prefix = f"{self._previous_generation - 1}-"
+        for filename in os.listdir(self.index_dir):
+            if (
+                    self._previous_generation > 0
+                    and filename.startswith(stale_prefix)
+            ):
+                os.remove(os.path.join(self.index_dir, filename))
+
+        return doc_count
+
+
+def write_local_index(
+        index_dir: str,
+        units: typing.Iterable[IndexUnit],
+        vectors: np.ndarray | None = None,
+) -> int:
+    """
+    Write a BM25 index (and optional dense vectors, one row per unit) for
+    `units` as a new generation. Returns the number of units written.
+    """
+
+    writer = LocalIndexWriter(index_dir)
+    for row, unit in enumerate(units):
+        writer.add(unit, None if vectors is None else vectors[row])
+
+    return writer.commit()
+
+
+def iter_index_units(index_dir: str) -> typing.Iterator[IndexUnit]:
+    """Units of the current generation, in row order; none if no index."""
+
+    if not os.path.exists(os.path.join(index_dir, META_FILENAME)):
+        return
+
+    generation = _read_meta(index_dir)["generation"]
+    units_path = _generation_path(index_dir, generation, "units.jsonl")
+    with open(units_path, encoding="utf-8") as units_file:
+        for line in units_file:
+            yield IndexUnit(**json.loads(line))
+
+
+def read_index_vectors(index_dir: str) -> np.ndarray | None:
+    """Memory-mapped vectors of the current generation, if it has any."""
+
+    if not os.path.exists(os.path.join(index_dir, META_FILENAME)):
+        return None
+
+    meta = _read_meta(index_dir)
+    if not meta["has_vectors"]:
+        return None
+
+    return np.load(
+        _generation_path(index_dir, meta["generation"], "vectors.npy"),
+        mmap_mode="r",
+    )
+
+
+class LocalIndex:
+    """
+    Read side of a local index: BM25 over memory-mapped postings, plus
+    cosine similarity over memory-mapped unit vectors when present.
+
+    Postings for a term are one contiguous slice of `postings_docs` and
+    `postings_tfs`, so scoring a query is a handful of vectorized NumPy
+    operations, one per query term.
+    """
+
+    def __init__(self, index_dir: str, k1: float = 1.2, b: float = 0.75):
+        self.index_dir = index_dir
+        self._k1 = k1
+
+        meta = _read_meta(index_dir)
+        self.generation: int = meta["generation"]
+        self.doc_count: int = meta["doc_count"]
+
+        def load(name: str) -> np.ndarray:
+            path = _generation_path(index_dir, self.generation, name)
+
+            return np.load(path, mmap_mode="r")
+
+        self._offsets = load("offsets.npy")
+        self._postings_docs = load("postings_docs.npy")
+        self._postings_tfs = load("postings_tfs.npy")
+        self._vectors = load("vectors.npy") if meta["has_vectors"] else None
+
+        terms_path = _generation_path(index_dir, self.generation, "terms.json")
+        with open(terms_path, encoding="utf-8") as terms_file:
+            terms = json.load(terms_file)
+        self._terms = {term: row for row, term in enumerate(terms)}
+
+        document_frequencies = np.diff(self._offsets).astype(np.float32)
+        self._idf = np.log(
+            1 + (self.doc_count - document_frequencies + 0.5)
+            / (document_frequencies + 0.5)
+        )
+
+        # The length part of the BM25 denominator only depends on the unit,
+        # so it is computed once here instead of on every query.
+        doc_lengths = load("doc_lengths.npy")
+        avg_doc_length = meta["avg_doc_length"] or 1.0
+        self._length_norm = k1 * (1 - b + b * doc_lengths / avg_doc_length)
+
+        units_path = _generation_path(
+            index_dir,
+            self.generation,
+            "units.jsonl",
+        )
+        with open(units_path, encoding="utf-8") as units_file:
+            self._units = [
+                IndexUnit(**json.loads(line)) for line in units_file
+            ]
+
+    @property
+    def has_vectors(self) -> bool:
+        return self._vectors is not None
+
+    def bm25_scores(self, question: str) -> np.ndarray:
+        scores = np.zeros(self.doc_count, dtype=np.float32)
+        for term in set(content_words(question)):
+            row = self._terms.get(term)
+            if row is None:
+                continue
+
+            start, end = self._offsets[row], self._offsets[row + 1]
+            docs = self._postings_docs[start:end]
+            tfs = self._postings_tfs[start:end]
+
+            # A term appears once per unit in its postings, so plain fancy
+            # indexing accumulates correctly without np.add.at.
+            scores[docs] += (
+                self._idf[row] * tfs * (self._k1 + 1)
+                / (tfs + self._length_norm[docs])
+            )
+
+        return scores
+
+    @timed("local_index.search")
+    def search(
+            self,
+            question: str,
+            top_k: int = 8,
+            query_vector: np.ndarray | None = None,
+            dense_weight: float = 0.0,
+    ) -> list[RetrievedChunk]:
+        if not self.doc_count:
+            return []
+
+        scores = self.bm25_scores(question)
+        top_score = scores.max()
+        if top_score > 0:
+            # Scaled to [0, 1] so it mixes with cosine similarity and reads
+            # like RAGFlow's similarity field.
+            scores /= top_score
+
+        if (
+                query_vector is not None
+                and self._vectors is not None
+                and dense_weight > 0
+        ):
+            norm = max(float(np.linalg.norm(query_vector)), 1e-12)
+            similarities = np.maximum(self._vectors @ (query_vector / norm), 0)
+            scores = (1 - dense_weight) * scores + dense_weight * similarities
+
+        k = min(top_k, self.doc_count)
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        ranked = candidates[np.argsort(-scores[candidates])]
+
+        return [
+            RetrievedChunk(
+                id=self._units[doc].id,
+                content=self._units[doc].content,
+                document_id=self._units[doc].document_id,
+                similarity=float(scores[doc]),
+            )
+            for doc in ranked
+            if scores[doc] > 0
+        ]
+
+
+async def open_local_index(index_dir: str) -> LocalIndex:
+    local_index = LocalIndex(index_dir)
+    logger.info(
+        f"Local index generation {local_index.generation} opened "
+        f"({local_index.doc_count} units)"
+    )
+
+    return local_index
+
+
+async def embed_texts_async(
+        client: genai.Client,
+        model: str,
+        texts: list[str],
+        batch_size: int = 100,
+) -> np.ndarray:
+    vectors = []
+    for start in range(0, len(texts), batch_size):
+        response = await client.aio.models.embed_content(
+            model=model,
+            contents=texts[start:start + batch_size],
+        )
+        vectors.extend(embedding.values for embedding in response.embeddings)
+
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def generation_changed(local_index: LocalIndex) -> bool:
+    try:
+        meta = _read_meta(local_index.index_dir)
+
+        return meta["generation"] != local_index.generation
+
+    except (OSError, ValueError):
+        return False
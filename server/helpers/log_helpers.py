@@ -0,0 +1,147 @@
+import atexit
+import contextvars
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import uuid
+
+from .metrics import LOG_RECORDS_DROPPED
+
+request_id: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "request_id",
+    default="-",
+)
+
+
+def set_request_id(value: str | None = None) -> str:
+    value = value or uuid.uuid4().hex[:16]
+    request_id.set(value)
+
+    return value
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, built on the listener thread."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(
+                record.created,
+                tz=datetime.timezone.utc,
+            ).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "pid": record.process,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hand records to the listener thread as they are.
+
+    The stock QueueHandler formats every record on the calling thread so it
+    can be pickled; this queue never leaves the process, so only the
+    request id, which lives in the caller's context, is captured here. A
+    full queue drops records instead of blocking the request.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.request_id = request_id.get()
+
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+class DrainingQueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self) -> None:
+        # Waits for room instead of failing when the queue is full, so
+        # stopping still writes out every queued record.
+        self.queue.put(self._sentinel)
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            super().stop()
+
+
+class BodySampler:
+    """
+    Decide whether a prompt or response body is logged, and cut it to
+    `max_chars`. With `sample_rate` below 1 only that share of bodies is
+    kept; a `max_chars` of 0 disables body logging.
+    """
+
+    def __init__(self, max_chars: int = 500, sample_rate: float = 1.0):
+        self._max_chars = max_chars
+        self._sample_rate = sample_rate
+
+    def sample(self, body: str | None) -> str | None:
+        if body is None or self._max_chars <= 0:
+            return None
+
+        if self._sample_rate < 1 and random.random() >= self._sample_rate:
+            return None
+
+        if len(body) <= self._max_chars:
+            return body
+
+        return f"{body[:self._max_chars]}... ({len(body)} chars)"
+
+
+def configure_server_logging(
+        logger: logging.Logger,
+        path: str,
+        max_bytes: int = 10 * 1024 * 1024,
+        backup_count: int = 5,
+        queue_size: int = 10_000,
+        log_format: str = "json",
+) -> DrainingQueueListener:
+    """
+    Send `logger` through a bounded queue to a rotating file written by a
+    background thread, so requests never wait on disk I/O or formatting.
+
+    A `{pid}` placeholder in `path` gives every worker its own file, which
+    keeps size-based rotation from racing between processes.
+    """
+
+    file_handler = logging.handlers.RotatingFileHandler(
+        path.format(pid=os.getpid()),
+        maxBytes=max_bytes,
+        backupCount=backup_count,
+        encoding="utf-8",
+    )
+    if log_format == "json":
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter(
+            "%(asctime)s - %(levelname)s - %(request_id)s - %(message)s",
+        ))
+
+    log_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    listener = DrainingQueueListener(
+        log_queue,
+        file_handler,
+        respect_handler_level=True,
+    )
+    listener.start()
+    # Stopping drains whatever is still queued.
+    atexit.register(listener.stop)
+
+    logger.addHandler(ContextQueueHandler(log_queue))
+
+    return listener
@@ -0,0 +1,115 @@
+import asyncio
+import contextvars
+import queue
+import threading
+import typing
+from concurrent.futures import Future
+
+T = typing.TypeVar("T")
+
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+
+
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(
+                target=loop.run_forever,
+                name="background-event-loop",
+                daemon=True,
+            )
+            thread.start()
+
+            _loop = loop
+
+    return _loop
+
+
+def run_coroutine_sync(
+        coroutine: typing.Coroutine[typing.Any, typing.Any, T],
+) -> T:
+    """
+    Run a coroutine on the worker's long-lived event loop and wait for it.
+
+    The caller's context variables are copied into the task, so Flask's
+    request and app contexts stay available inside async views.
+    """
+
+    loop = get_background_loop()
+    context = contextvars.copy_context()
+    future: Future[T] = Future()
+
+    def _copy_result(task: asyncio.Task[T]) -> None:
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def _schedule() -> None:
+        task = loop.create_task(coroutine, context=context)
+        task.add_done_callback(_copy_result)
+
+    loop.call_soon_threadsafe(_schedule)
+
+    return future.result()
+
+
+_DONE = object()
+
+
+def iterate_async_sync(
+        async_iterable: typing.AsyncIterable[T],
+) -> typing.Iterator[T]:
+    """
+    Consume an async iterable on the worker's event loop from sync code.
+
+    The whole iteration runs as a single task (so context variables set
+    while iterating keep their values between items). Closing the returned
+    generator early, e.g. when a streaming client disconnects, cancels it.
+    """
+
+    loop = get_background_loop()
+    context = contextvars.copy_context()
+    items: queue.Queue[tuple[typing.Any, BaseException | None]] = queue.Queue()
+    task_future: Future[asyncio.Task[None]] = Future()
+
+    async def _consume() -> None:
+        try:
+            async for item in async_iterable:
+                items.put((item, None))
+
+        except asyncio.CancelledError:
+            items.put((_DONE, None))
+            raise
+
+        except Exception as e:
+            items.put((_DONE, e))
+
+        else:
+            items.put((_DONE, None))
+
+    def _schedule() -> None:
+        task_future.set_result(loop.create_task(_consume(), context=context))
+
+    loop.call_soon_threadsafe(_schedule)
+
+    try:
+        while True:
+            item, error = items.get()
+            if item is _DONE:
+                if error is not None:
+                    raise error
+
+                return
+
+            yield item
+
+    finally:
+        task = task_future.result()
+        loop.call_soon_threadsafe(task.cancel)
@@ -0,0 +1,366 @@
+import asyncio
+import bisect
+import contextlib
+import functools
+import inspect
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import typing
+
+import redis.asyncio as redis
+
+logger = logging.getLogger("server_logs")
+
+DEFAULT_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+    30.0, 60.0,
+)
+WORKERS_KEY = "metrics:workers"
+
+F = typing.TypeVar("F", bound=typing.Callable[..., typing.Any])
+
+
+class Counter:
+    def __init__(
+            self,
+            name: str,
+            help_text: str,
+            label_names: tuple[str, ...],
+    ):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values: dict[tuple[str, ...], float] = {}
+        # The WSGI server, and code run with asyncio.to_thread, update
+        # metrics from several threads at once.
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def snapshot(self) -> dict[str, typing.Any]:
+        with self._lock:
+            series = [[list(k), v] for k, v in self._values.items()]
+
+        return {
+            "type": "counter",
+            "help": self.help_text,
+            "labels": list(self.label_names),
+            "series": series,
+        }
+
+
+class Histogram:
+    """
+    Cumulative-bucket histogram. An observation is one bisect and three
+    additions; rendering turns the per-bucket counts into the cumulative
+    `le` series Prometheus expects.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            help_text: str,
+            label_names: tuple[str, ...],
+            buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._series: dict[tuple[str, ...], list[typing.Any]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.label_names)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                counts = [0] * (len(self.buckets) + 1)
+                series = self._series[key] = [counts, 0.0, 0]
+
+            series[0][bucket] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self) -> dict[str, typing.Any]:
+        with self._lock:
+            series = [
+                [list(k), list(counts), total, count]
+                for k, (counts, total, count) in self._series.items()
+            ]
+
+        return {
+            "type": "histogram",
+            "help": self.help_text,
+            "labels": list(self.label_names),
+            "buckets": list(self.buckets),
+            "series": series,
+        }
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, Counter | Histogram] = {}
+
+    def counter(
+            self,
+            name: str,
+            help_text: str,
+            label_names: tuple[str, ...] = (),
+    ) -> Counter:
+        metric = Counter(name, help_text, label_names)
+        self._metrics[name] = metric
+
+        return metric
+
+    def histogram(
+            self,
+            name: str,
+            help_text: str,
+            label_names: tuple[str, ...] = (),
+            buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        metric = Histogram(name, help_text, label_names, buckets)
+        self._metrics[name] = metric
+
+        return metric
+
+    def snapshot(self) -> dict[str, typing.Any]:
+        return {
+            name: metric.snapshot()
+            for name, metric in list(self._metrics.items())
+        }
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(
+        names: list[str],
+        values: list[str],
+        **extra: str,
+) -> str:
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ""
+
+    return "{" + ",".join(
+        f'{name}="{_escape(str(value))}"' for name, value in pairs
+    ) + "}"
+
+
+def merge_snapshots(
+        snapshots: list[dict[str, typing.Any]],
+) -> dict[str, typing.Any]:
+    """Add up the series of several workers' snapshots."""
+
+    merged: dict[str, typing.Any] = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, {**metric, "series": {}})
+            for series in metric["series"]:
+                key = tuple(series[0])
+                if metric["type"] == "counter":
+                    target["series"][key] = (
+                        target["series"].get(key, 0.0) + series[1]
+                    )
+
+                    continue
+
+                counts, total, count = target["series"].get(
+                    key,
+                    ([0] * len(series[1]), 0.0, 0),
+                )
+                target["series"][key] = (
+                    [a + b for a, b in zip(counts, series[1])],
+                    total + series[2],
+                    count + series[3],
+                )
+
+    return merged
+
+
+def render_metrics(snapshots: list[dict[str, typing.Any]]) -> str:
+    """Prometheus text exposition format (0.0.4)."""
+
+    lines: list[str] = []
+    for name, metric in sorted(merge_snapshots(snapshots).items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+
+        for key, value in sorted(metric["series"].items()):
+            label_names = metric["labels"]
+            labels = _format_labels(label_names, list(key))
+            if metric["type"] == "counter":
+                lines.append(f"{name}{labels} {value}")
+
+                continue
+
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(metric["buckets"], counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(
+                    label_names,
+                    list(key),
+                    le=str(bound),
+                )
+                lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+
+            inf_labels = _format_labels(label_names, list(key), le="+Inf")
+            lines.append(f"{name}_bucket{inf_labels} {count}")
+            lines.append(f"{name}_sum{labels} {total}")
+            lines.append(f"{name}_count{labels} {count}")
+
+    return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "legal_assistant_stage_seconds",
+    "Time spent in each stage of request handling.",
+    ("stage",),
+)
+STAGE_ERRORS = REGISTRY.counter(
+    "legal_assistant_stage_errors_total",
+    "Exceptions raised by each stage, by error type.",
+    ("stage", "error"),
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "legal_assistant_request_seconds",
+    "End-to-end request latency by endpoint.",
+    ("endpoint",),
+)
+REQUESTS = REGISTRY.counter(
+    "legal_assistant_requests_total",
+    "Requests served, by endpoint and HTTP status.",
+    ("endpoint", "status"),
+)
+LOG_RECORDS_DROPPED = REGISTRY.counter(
+    "legal_assistant_log_records_dropped_total",
+    "Log records dropped because the log queue was full.",
+)
+QUERY_ERRORS = REGISTRY.counter(
+    "legal_assistant_query_errors_total",
+    "Failed queries, by error type and the status returned.",
+    ("error", "status"),
+)
+
+
+def error_type(error: BaseException) -> str:
+    # google.genai errors carry the HTTP status as `code`, which separates
+    # e.g. ClientError 400 from 429.
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return f"{type(error).__name__}_{code}"
+
+    return type(error).__name__
+
+
+@contextlib.contextmanager
+def time_stage(stage: str) -> typing.Iterator[None]:
+    started_at = time.perf_counter()
+    try:
+        yield
+
+    except Exception as e:
+        STAGE_ERRORS.inc(stage=stage, error=error_type(e))
+        raise
+
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started_at, stage=stage)
+
+
+def timed(stage: str) -> typing.Callable[[F], F]:
+    """Decorator form of time_stage, for sync and async functions."""
+
+    def decorator(func: F) -> F:
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args: typing.Any, **kwargs: typing.Any):
+                with time_stage(stage):
+                    return await func(*args, **kwargs)
+
+            return typing.cast(F, async_wrapper)
+
+        @functools.wraps(func)
+        def wrapper(*args: typing.Any, **kwargs: typing.Any):
+            with time_stage(stage):
+                return func(*args, **kwargs)
+
+        return typing.cast(F, wrapper)
+
+    return decorator
+
+
+def _worker_key() -> str:
+    # Processes in different containers can share a pid.
+    return f"metrics:worker:{socket.gethostname()}:{os.getpid()}"
+
+
+async def publish_metrics(
+        redis_client: redis.Redis,
+        interval: float = 5.0,
+) -> None:
+    """
+    Background task: share this worker's snapshot through Redis, so
+    /metrics on any worker can report all of them. A worker that stops
+    publishing drops out once its key expires.
+    """
+
+    worker_key = _worker_key()
+    while True:
+        try:
+            async with redis_client.pipeline(transaction=False) as pipeline:
+                pipeline.set(
+                    worker_key,
+                    json.dumps(REGISTRY.snapshot()),
+                    ex=int(interval * 3) + 1,
+                )
+                pipeline.sadd(WORKERS_KEY, worker_key)
+                await pipeline.execute()
+
+        except redis.RedisError as e:
+            logger.error(f"Could not publish metrics: {e}")
+
+        await asyncio.sleep(interval)
+
+
+async def collect_metrics(redis_client: redis.Redis) -> str:
+    worker_key = _worker_key()
+    snapshots = [REGISTRY.snapshot()]
+
+    try:
+        worker_keys = [
+            key.decode("utf-8")
+            for key in await redis_client.smembers(WORKERS_KEY)
+        ]
+        other_keys = [key for key in worker_keys if key != worker_key]
+        if other_keys:
+            payloads = await redis_client.mget(other_keys)
+            expired = []
+            for key, payload in zip(other_keys, payloads):
+                if payload is None:
+                    expired.append(key)
+                else:
+                    snapshots.append(json.loads(payload))
+
+            if expired:
+                await redis_client.srem(WORKERS_KEY, *expired)
+
+    except redis.RedisError as e:
+        # Still serve this worker's own numbers.
+        logger.error(f"Could not collect worker metrics: {e}")
+
+    return render_metrics(snapshots)
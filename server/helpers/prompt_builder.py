@@ -0,0 +1,126 @@
+import hashlib
+import re
+import typing
+
+from .rag import RetrievedChunk
+from .text import normalize_text
+
+# Gemini averages roughly four characters per token on Portuguese prose.
+# Counting exactly would cost a count_tokens round trip per request, which
+# is the latency this stage is trying to remove.
+CHARS_PER_TOKEN = 4
+
+CHUNK_TEMPLATE = "Chunk #{number}\n{content}\n\n"
+
+
+class PromptContext(typing.NamedTuple):
+    text: str
+    chunks: list[RetrievedChunk]
+    tokens: int
+    tokens_saved: int
+    duplicates: int
+    over_budget: int
+
+
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def _shingles(text: str, size: int = 5) -> set[str]:
+    words = re.findall(r"\w+", normalize_text(text))
+    if len(words) <= size:
+        return {" ".join(words)}
+
+    return {
+        " ".join(words[i:i + size])
+        for i in range(len(words) - size + 1)
+    }
+
+
+def dedupe_chunks(
+        chunks: list[RetrievedChunk],
+        threshold: float = 0.8,
+) -> list[RetrievedChunk]:
+    """
+    Drop repeated and overlapping chunks, keeping the most relevant copy.
+
+    Two chunks are near-duplicates when the share of word 5-grams they have
+    in common, relative to the smaller one, reaches `threshold`. Measuring
+    against the smaller chunk also catches a chunk contained in another,
+    which is what overlapping retrieval windows produce.
+    """
+
+    kept: list[RetrievedChunk] = []
+    kept_shingles: list[set[str]] = []
+    seen_digests: set[bytes] = set()
+
+    for chunk in rerank_chunks(chunks):
+        digest = hashlib.sha1(
+            normalize_text(chunk.content).encode("utf-8"),
+        ).digest()
+        if digest in seen_digests:
+            continue
+
+        shingles = _shingles(chunk.content)
+        is_duplicate = any(
+            len(shingles & other) / min(len(shingles), len(other))
+            >= threshold
+            for other in kept_shingles
+        )
+        if is_duplicate:
+            continue
+
+        seen_digests.add(digest)
+        kept.append(chunk)
+        kept_shingles.append(shingles)
+
+    return kept
+
+
+def rerank_chunks(chunks: list[RetrievedChunk]) -> list[RetrievedChunk]:
+    # sorted() is stable, so ties keep the retriever's order.
+    return sorted(chunks, key=lambda chunk: chunk.similarity, reverse=True)
+
+
+def build_prompt_context(
+        chunks: list[RetrievedChunk],
+        token_budget: int = 6000,
+        dedup_threshold: float = 0.8,
+) -> PromptContext:
+    """
+    Deduplicate, rerank and pack `chunks` into at most `token_budget`
+    tokens. Chunks that do not fit are skipped so a smaller, less relevant
+    one can still use the remaining budget.
+    """
+
+    unique_chunks = dedupe_chunks(chunks, dedup_threshold)
+
+    parts: list[str] = []
+    packed: list[RetrievedChunk] = []
+    tokens = 0
+    for chunk in unique_chunks:
+        part = CHUNK_TEMPLATE.format(
+            number=len(packed) + 1,
+            content=chunk.content,
+        )
+        part_tokens = estimate_tokens(part)
+        if tokens + part_tokens > token_budget:
+            continue
+
+        parts.append(part)
+        packed.append(chunk)
+        tokens += part_tokens
+
+    unpacked_tokens = sum(
+        estimate_tokens(CHUNK_TEMPLATE.format(number=i + 1, content=c.content))
+        for i, c in enumerate(chunks)
+    )
+
+    return PromptContext(
+        text="".join(parts),
+        chunks=packed,
+        tokens=tokens,
+        tokens_saved=max(unpacked_tokens - tokens, 0),
+        duplicates=len(chunks) - len(unique_chunks),
+        over_budget=len(unique_chunks) - len(packed),
+    )
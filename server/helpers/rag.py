@@ -1,29 +1,346 @@
-from ragflow_sdk import Chunk, RAGFlow
+import json
+import time
+import typing
+import zlib
 
+import httpx
+from cachetools import TTLCache
 
-async def instantiate_rag_object(api_key: str, base_url: str) -> RAGFlow:
-    rag_object = RAGFlow(api_key=api_key, base_url=base_url)
+from .caching import TieredCache
+from .metrics import timed
+from .single_flight import SingleFlight
+from .text import normalize_text
+
+# dataset name -> (dataset id, document ids)
+DatasetCache = TTLCache[str, tuple[str, list[str]]]
+
+
+class RetrievedChunk(typing.NamedTuple):
+    id: str
+    content: str
+    document_id: str
+    similarity: float
+
+
+class RAGFlowError(Exception):
+    pass
+
+
+def _to_retrieved_chunk(chunk: dict[str, typing.Any]) -> RetrievedChunk:
+    return RetrievedChunk(
+        id=str(chunk.get("id", "")),
+        content=chunk["content"],
+        document_id=str(chunk.get("document_id", "")),
+        similarity=float(chunk.get("similarity") or 0.0),
+    )
+
+
+def serialize_chunks(chunks: list[RetrievedChunk]) -> bytes:
+    payload = json.dumps(
+        [list(chunk) for chunk in chunks],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+
+    return zlib.compress(payload.encode("utf-8"))
+
+
+def deserialize_chunks(data: bytes) -> list[RetrievedChunk]:
+    payload = json.loads(zlib.decompress(data).decode("utf-8"))
+
+    return [RetrievedChunk(*fields) for fields in payload]
+
+
+async def instantiate_rag_object(
+        api_key: str,
+        base_url: str,
+        timeout: float = 15.0,
+        connect_timeout: float = 3.0,
+        max_connections: int = 20,
+) -> httpx.AsyncClient:
+    # Talks to the RAGFlow REST API directly: ragflow_sdk is synchronous and
+    # has no timeouts, so each call would block the event loop.
+    rag_object = httpx.AsyncClient(
+        base_url=f"{base_url.rstrip('/')}/api/v1",
+        headers={"Authorization": f"Bearer {api_key}"},
+        timeout=httpx.Timeout(timeout, connect=connect_timeout),
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        ),
+    )
 
     return rag_object
 
 
-async def retrieve_chunks(
+async def close_rag_object(rag_object: httpx.AsyncClient) -> None:
+    await rag_object.aclose()
+
+
+async def _request(
+        rag_object: httpx.AsyncClient,
+        method: str,
+        path: str,
+        **kwargs: typing.Any,
+) -> typing.Any:
+    response = await rag_object.request(method, path, **kwargs)
+    response.raise_for_status()
+
+    payload = response.json()
+    if payload.get("code") != 0:
+        raise RAGFlowError(payload.get("message", "Unknown RAGFlow error"))
+
+    return payload["data"]
+
+
+async def instantiate_dataset_cache(
+        maxsize: int = 32,
+        ttl: float = 600.0,
+) -> DatasetCache:
+    return TTLCache(maxsize=maxsize, ttl=ttl)
+
+
+async def invalidate_dataset_cache(
+        cache: DatasetCache,
+        dataset_name: str | None = None,
+) -> None:
+    if dataset_name is None:
+        cache.clear()
+    else:
+        cache.pop(dataset_name, None)
+
+
+async def resolve_dataset_id(
+        dataset_name: str,
+        rag_object: httpx.AsyncClient,
+) -> str:
+    datasets = await _request(
+        rag_object,
+        "GET",
+        "/datasets",
+        params={"name": dataset_name},
+    )
+
+    return datasets[0]["id"]
+
+
+async def iter_documents(
+        rag_object: httpx.AsyncClient,
+        dataset_id: str,
+        page_size: int = 100,
+) -> typing.AsyncIterator[dict[str, typing.Any]]:
+    page = 1
+    while True:
+        documents = await _request(
+            rag_object,
+            "GET",
+            f"/datasets/{dataset_id}/documents",
+            params={"page": page, "page_size": page_size},
+        )
+        for document in documents["docs"]:
+            yield document
+
+        if len(documents["docs"]) < page_size:
+            return
+
+        page += 1
+
+
+async def upload_document(
+        rag_object: httpx.AsyncClient,
+        dataset_id: str,
+        filename: str,
+        content: bytes,
+) -> str:
+    documents = await _request(
+        rag_object,
+        "POST",
+        f"/datasets/{dataset_id}/documents",
+        files=[("file", (filename, content))],
+    )
+
+    return documents[0]["id"]
+
+
+async def add_chunk(
+        rag_object: httpx.AsyncClient,
+        dataset_id: str,
+        document_id: str,
+        content: str,
+) -> str:
+    data = await _request(
+        rag_object,
+        "POST",
+        f"/datasets/{dataset_id}/documents/{document_id}/chunks",
+        json={"content": content},
+    )
+
+    return data["chunk"]["id"]
+
+
+async def update_chunk(
+        rag_object: httpx.AsyncClient,
+        dataset_id: str,
+        document_id: str,
+        chunk_id: str,
+        content: str,
+) -> None:
+    await _request(
+        rag_object,
+        "PUT",
+        f"/datasets/{dataset_id}/documents/{document_id}/chunks/{chunk_id}",
+        json={"content": content},
+    )
+
+
+async def delete_chunks(
+        rag_object: httpx.AsyncClient,
+        dataset_id: str,
+        document_id: str,
+        chunk_ids: list[str],
+) -> None:
+    await _request(
+        rag_object,
+        "DELETE",
+        f"/datasets/{dataset_id}/documents/{document_id}/chunks",
+        json={"chunk_ids": chunk_ids},
+    )
+
+
+@timed("ragflow.resolve_dataset")
+async def resolve_dataset(
         dataset_name: str,
+        rag_object: httpx.AsyncClient,
+        cache: DatasetCache | None = None,
+) -> tuple[str, list[str]]:
+    if cache is not None and dataset_name in cache:
+        return cache[dataset_name]
+
+    dataset_id = await resolve_dataset_id(dataset_name, rag_object)
+    document_ids = [
+        document["id"]
+        async for document in iter_documents(rag_object, dataset_id)
+    ]
+
+    resolved = (dataset_id, document_ids)
+    if cache is not None:
+        cache[dataset_name] = resolved
+
+    return resolved
+
+
+@timed("ragflow.retrieve")
+async def _retrieve(
+        rag_object: httpx.AsyncClient,
+        dataset_id: str,
+        document_ids: list[str],
         question: str,
-        rag_object: RAGFlow,
-) -> list[Chunk]:
-    page_size = 10
+) -> list[dict[str, typing.Any]]:
+    data = await _request(
+        rag_object,
+        "POST",
+        "/retrieval",
+        json={
+            "dataset_ids": [dataset_id],
+            "document_ids": document_ids,
+            "question": question,
+        },
+    )
 
-    datasets = rag_object.list_datasets(name=dataset_name)
-    dataset = datasets[0]
+    return data["chunks"]
 
-    documents = dataset.list_documents(page_size=page_size)
-    document_ids = [d.id for d in documents]
 
-    chunks = rag_object.retrieve(
-        dataset_ids=[dataset.id],
-        document_ids=document_ids,
-        question=question,
+async def _retrieve_from_ragflow(
+        dataset_name: str,
+        question: str,
+        rag_object: httpx.AsyncClient,
+        dataset_cache: DatasetCache | None = None,
+) -> list[RetrievedChunk]:
+    dataset_id, document_ids = await resolve_dataset(
+        dataset_name,
+        rag_object,
+        dataset_cache,
     )
 
+    try:
+        chunks = await _retrieve(
+            rag_object,
+            dataset_id,
+            document_ids,
+            question,
+        )
+
+    except (httpx.HTTPStatusError, RAGFlowError):
+        if dataset_cache is None:
+            raise
+
+        # The cached ids may be stale (e.g. documents were re-uploaded), so
+        # resolve them again once before giving up.
+        await invalidate_dataset_cache(dataset_cache, dataset_name)
+        dataset_id, document_ids = await resolve_dataset(
+            dataset_name,
+            rag_object,
+            dataset_cache,
+        )
+        chunks = await _retrieve(
+            rag_object,
+            dataset_id,
+            document_ids,
+            question,
+        )
+
+    return [_to_retrieved_chunk(chunk) for chunk in chunks]
+
+
+async def retrieve_chunks(
+        dataset_name: str,
+        question: str,
+        rag_object: httpx.AsyncClient,
+        dataset_cache: DatasetCache | None = None,
+        retrieval_cache: TieredCache | None = None,
+        single_flight: SingleFlight[list[RetrievedChunk]] | None = None,
+) -> list[RetrievedChunk]:
+    """
+    Retrieve through the cache. On a miss, concurrent retrievals of the
+    same question share one RAGFlow call when `single_flight` is given.
+    """
+
+    if retrieval_cache is None:
+        return await _retrieve_from_ragflow(
+            dataset_name,
+            question,
+            rag_object,
+            dataset_cache,
+        )
+
+    dataset_id, _ = await resolve_dataset(
+        dataset_name,
+        rag_object,
+        dataset_cache,
+    )
+    cache_key = retrieval_cache.key(dataset_id, normalize_text(question))
+
+    cached_chunks = await retrieval_cache.get(cache_key)
+    if cached_chunks is not None:
+        return deserialize_chunks(cached_chunks)
+
+    async def _retrieve_and_cache() -> list[RetrievedChunk]:
+        started_at = time.perf_counter()
+        chunks = await _retrieve_from_ragflow(
+            dataset_name,
+            question,
+            rag_object,
+            dataset_cache,
+        )
+        retrieval_cache.record_miss_latency(time.perf_counter() - started_at)
+
+        await retrieval_cache.set(cache_key, serialize_chunks(chunks))
+
+        return chunks
+
+    if single_flight is None:
+        return await _retrieve_and_cache()
+
+    chunks, _ = await single_flight.run(cache_key, _retrieve_and_cache)
+
     return chunks
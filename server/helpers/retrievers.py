@@ -0,0 +1,106 @@
+import time
+import typing
+
+import httpx
+import numpy as np
+
+from .caching import TieredCache
+from .local_index import generation_changed, LocalIndex, open_local_index
+from .rag import DatasetCache, retrieve_chunks, RetrievedChunk
+from .single_flight import SingleFlight
+
+QueryEmbedder = typing.Callable[[str], typing.Awaitable[np.ndarray]]
+
+
+class Retriever(typing.Protocol):
+    """What the query pipeline needs from a retrieval backend."""
+
+    name: str
+
+    async def retrieve(self, question: str) -> list[RetrievedChunk]:
+        ...
+
+
+class RAGFlowRetriever:
+    name = "ragflow"
+
+    def __init__(
+            self,
+            dataset_name: str,
+            rag_object: httpx.AsyncClient,
+            dataset_cache: DatasetCache | None = None,
+            retrieval_cache: TieredCache | None = None,
+            single_flight: SingleFlight[list[RetrievedChunk]] | None = None,
+    ):
+        self._dataset_name = dataset_name
+        self._rag_object = rag_object
+        self._dataset_cache = dataset_cache
+        self._retrieval_cache = retrieval_cache
+        self._single_flight = single_flight
+
+    async def retrieve(self, question: str) -> list[RetrievedChunk]:
+        return await retrieve_chunks(
+            self._dataset_name,
+            question,
+            self._rag_object,
+            self._dataset_cache,
+            self._retrieval_cache,
+            self._single_flight,
+        )
+
+
+class LocalRetriever:
+    """
+    Retrieval from an on-disk LocalIndex, in process.
+
+    Scoring takes well under a millisecond for the law codes, so it runs
+    directly on the event loop and skips the retrieval cache. A rebuilt
+    index is picked up within `reload_interval` seconds.
+    """
+
+    name = "local"
+
+    def __init__(
+            self,
+            local_index: LocalIndex,
+            top_k: int = 8,
+            dense_weight: float = 0.0,
+            embed_query: QueryEmbedder | None = None,
+            reload_interval: float = 30.0,
+    ):
+        self._local_index = local_index
+        self._top_k = top_k
+        self._dense_weight = dense_weight
+        self._embed_query = embed_query
+        self._reload_interval = reload_interval
+        self._checked_at = time.monotonic()
+
+    async def _reload_if_changed(self) -> None:
+        now = time.monotonic()
+        if now - self._checked_at < self._reload_interval:
+            return
+
+        self._checked_at = now
+        if generation_changed(self._local_index):
+            self._local_index = await open_local_index(
+                self._local_index.index_dir,
+            )
+
+    async def retrieve(self, question: str) -> list[RetrievedChunk]:
+        await self._reload_if_changed()
+
+        query_vector = None
+        use_vectors = (
+            self._dense_weight > 0
+            and self._embed_query is not None
+            and self._local_index.has_vectors
+        )
+        if use_vectors:
+            query_vector = await self._embed_query(question)
+
+        return self._local_index.search(
+            question,
+            top_k=self._top_k,
+            query_vector=query_vector,
+            dense_weight=self._dense_weight,
+        )
@@ -1,46 +1,150 @@
+import asyncio
+import logging
 from uuid import uuid4
 
-import redis
+import redis.asyncio as redis
+from cachetools import TTLCache
+from redis.commands.core import AsyncScript
+
+from .metrics import timed
+
+logger = logging.getLogger("server_logs")
+
+USER_ID_INVALIDATION_CHANNEL = "user_id_invalidations"
+
+# Returns the stored user id, creating it from ARGV[1] when the chat has none.
+_GET_OR_CREATE_USER_ID_SCRIPT = """
+local user_id = redis.call('GET', KEYS[1])
+if user_id then
+    return user_id
+end
+
+redis.call('SET', KEYS[1], ARGV[1])
+return ARGV[1]
+"""
 
 
 async def instantiate_redis_client(
         host: str,
         port: int,
         db: int = 0,
+        max_connections: int = 50,
+        pool_timeout: float = 5.0,
+        socket_timeout: float = 5.0,
+        socket_connect_timeout: float = 2.0,
+        health_check_interval: int = 30,
 ) -> redis.Redis:
-    client = redis.Redis(host, port, db)
+    # A blocking pool makes callers wait for a free connection instead of
+    # failing (or opening new sockets) when every connection is busy.
+    connection_pool = redis.BlockingConnectionPool(
+        host=host,
+        port=port,
+        db=db,
+        max_connections=max_connections,
+        timeout=pool_timeout,
+        socket_timeout=socket_timeout,
+        socket_connect_timeout=socket_connect_timeout,
+        health_check_interval=health_check_interval,
+    )
+    client = redis.Redis.from_pool(connection_pool)
 
     return client
 
 
-async def _generate_user_id(username: bytes) -> str:
+async def close_redis_client(client: redis.Redis) -> None:
+    await client.aclose()
+
+
+async def instantiate_user_id_cache(
+        maxsize: int = 10_000,
+        ttl: float = 300.0,
+) -> TTLCache[str, str]:
+    return TTLCache(maxsize=maxsize, ttl=ttl)
+
+
+async def instantiate_user_id_script(client: redis.Redis) -> AsyncScript:
+    # Registered once per client; calling it sends EVALSHA and only falls
+    # back to loading the script after a NOSCRIPT reply.
+    return client.register_script(_GET_OR_CREATE_USER_ID_SCRIPT)
+
+
+async def _generate_user_id(username: str) -> str:
     random_uuid = str(uuid4())
     user_id = f"{username}-{random_uuid}"
 
     return user_id
 
 
-async def set_user_id(
+@timed("redis.resolve_user_id")
+async def resolve_user_id(
         chat_user_id: str,
         username: str,
-        client: redis.Redis,
-) -> bytes:
-    user_id = await _generate_user_id(username.encode())
-    client.set(chat_user_id, user_id)
+        get_or_create: AsyncScript,
+        cache: TTLCache[str, str] | None = None,
+) -> str:
+    if cache is not None and chat_user_id in cache:
+        return cache[chat_user_id]
 
-    return client.get(chat_user_id)
+    candidate_user_id = await _generate_user_id(username)
+    user_id_bytes: bytes = await get_or_create(
+        keys=[chat_user_id],
+        args=[candidate_user_id],
+    )
+
+    user_id = user_id_bytes.decode("utf-8")
+    if cache is not None:
+        cache[chat_user_id] = user_id
+
+    return user_id
 
 
 async def retrieve_user_id(
         chat_user_id: str,
         client: redis.Redis,
 ) -> bytes | None:
-    user_id = client.get(chat_user_id)
+    user_id = await client.get(chat_user_id)
     if user_id is not None:
         return user_id
 
     return None
 
 
-async def pop_user_id(chat_user_id: str, client: redis.Redis) -> None:
-    client.delete(chat_user_id)
+@timed("redis.pop_user_id")
+async def pop_user_id(
+        chat_user_id: str,
+        client: redis.Redis,
+        cache: TTLCache[str, str] | None = None,
+) -> None:
+    if cache is not None:
+        cache.pop(chat_user_id, None)
+
+    # Other workers may still hold the mapping in their local cache.
+    async with client.pipeline(transaction=False) as pipe:
+        pipe.delete(chat_user_id)
+        pipe.publish(USER_ID_INVALIDATION_CHANNEL, chat_user_id)
+        await pipe.execute()
+
+
+async def listen_user_id_invalidations(
+        client: redis.Redis,
+        cache: TTLCache[str, str],
+) -> None:
+    while True:
+        try:
+            async with client.pubsub() as pubsub:
+                await pubsub.subscribe(USER_ID_INVALIDATION_CHANNEL)
+
+                while True:
+                    message = await pubsub.get_message(
+                        ignore_subscribe_messages=True,
+                        timeout=1.0,
+                    )
+                    if message is not None:
+                        cache.pop(message["data"].decode("utf-8"), None)
+
+        except redis.RedisError as e:
+            logger.warning(f"User id invalidation listener failed: {e}")
+            # Entries cached while disconnected may have missed invalidations.
+            cache.clear()
+
+            await asyncio.sleep(1.0)
@@ -0,0 +1,300 @@
+import asyncio
+import logging
+import typing
+from uuid import uuid4
+
+import redis.asyncio as redis
+
+from .metrics import REGISTRY
+
+logger = logging.getLogger("server_logs")
+
+T = typing.TypeVar("T")
+
+SINGLE_FLIGHT_CALLS = REGISTRY.counter(
+    "legal_assistant_single_flight_total",
+    "Coalesced calls by role: leader, follower (same worker), "
+    "remote_follower (another worker) or fallback (waited in vain).",
+    ("namespace", "role"),
+)
+
+# Deletes the lock only if this leader still holds it; an expired lock may
+# already belong to another worker.
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_ABANDONED = object()
+
+
+class Flight(typing.Generic[T]):
+    """
+    One caller's part in a coalesced call.
+
+    A leader (`is_leader`) produces the result and hands it over with
+    `finish`. Anyone else calls `wait` first and only produces the result
+    itself when `wait` returns None. Every caller must end with `finish`,
+    even on errors, or this worker's followers wait until their timeout.
+    """
+
+    def __init__(
+            self,
+            group: "SingleFlight[T]",
+            key: str,
+            future: asyncio.Future,
+            owner: bool,
+            is_leader: bool = False,
+            lock_token: str | None = None,
+    ):
+        self.key = key
+        self._group = group
+        self._future = future
+        # The owner registered the in-flight future this worker's other
+        # callers wait on, and must settle it.
+        self._owner = owner
+        self._lock_token = lock_token
+        self.is_leader = is_leader
+
+    async def wait(self) -> T | None:
+        """The leader's result, or None if it failed or took too long."""
+
+        if self._owner:
+            result = await self._group._wait_remote(self.key)
+            role = "remote_follower"
+
+        else:
+            try:
+                result = await asyncio.wait_for(
+                    asyncio.shield(self._future),
+                    self._group.timeout,
+                )
+
+            except TimeoutError:
+                result = None
+
+            if result is _ABANDONED:
+                result = None
+
+            role = "follower"
+
+        if result is None:
+            role = "fallback"
+        SINGLE_FLIGHT_CALLS.inc(namespace=self._group.namespace, role=role)
+
+        return result
+
+    async def finish(self, result: T | None) -> None:
+        """Share `result` with the waiting callers; None means failure."""
+
+        if not self._owner:
+            return
+
+        self._owner = False
+        if not self._future.done():
+            self._future.set_result(_ABANDONED if result is None else result)
+
+        if self._group._in_flight.get(self.key) is self._future:
+            del self._group._in_flight[self.key]
+
+        if self._lock_token is not None:
+            await self._group._publish(self.key, result, self._lock_token)
+
+
+class SingleFlight(typing.Generic[T]):
+    """
+    Coalesce concurrent calls that share a key into a single upstream call.
+
+    In a worker, the first caller leads and later ones await its future.
+    With a Redis client the leader also takes a short Redis lock, so
+    callers in other workers wait too: the leader publishes the encoded
+    result on a channel that `listen` relays to them, and keeps it for
+    `result_ttl` seconds for callers that arrive in between. Followers
+    give up after `timeout` seconds and make the call themselves.
+    """
+
+    def __init__(
+            self,
+            namespace: str,
+            encode: typing.Callable[[T], bytes],
+            decode: typing.Callable[[bytes], T],
+            redis_client: redis.Redis | None = None,
+            timeout: float = 30.0,
+            lock_ttl: float = 60.0,
+            result_ttl: float = 10.0,
+    ):
+        self.namespace = namespace
+        self.redis_client = redis_client
+        self.timeout = timeout
+        self._encode = encode
+        self._decode = decode
+        self._lock_ttl = lock_ttl
+        self._result_ttl = result_ttl
+        self._channel = f"{namespace}:single_flight"
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self._remote_waiters: dict[str, asyncio.Future] = {}
+        self._release_lock = None
+        if redis_client is not None:
+            self._release_lock = redis_client.register_script(
+                RELEASE_LOCK_SCRIPT,
+            )
+
+    def _lock_key(self, key: str) -> str:
+        return f"{self.namespace}:single_flight:lock:{key}"
+
+    def _result_key(self, key: str) -> str:
+        return f"{self.namespace}:single_flight:result:{key}"
+
+    async def begin(self, key: str) -> Flight[T]:
+        future = self._in_flight.get(key)
+        if future is not None:
+            return Flight(self, key, future, owner=False)
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+
+        lock_token: str | None = None
+        if self.redis_client is not None:
+            lock_token = uuid4().hex
+            try:
+                acquired = await self.redis_client.set(
+                    self._lock_key(key),
+                    lock_token,
+                    nx=True,
+                    px=int(self._lock_ttl * 1000),
+                )
+                if not acquired:
+                    # Another worker leads; this caller waits for it.
+                    return Flight(self, key, future, owner=True)
+
+            except redis.RedisError as e:
+                # Still coalesces within this worker.
+                logger.warning(f"Single flight '{self.namespace}' lock: {e}")
+                lock_token = None
+
+            except BaseException:
+                # E.g. cancelled: nobody would settle the future otherwise.
+                del self._in_flight[key]
+                future.set_result(_ABANDONED)
+                raise
+
+        SINGLE_FLIGHT_CALLS.inc(namespace=self.namespace, role="leader")
+
+        return Flight(
+            self,
+            key,
+            future,
+            owner=True,
+            is_leader=True,
+            lock_token=lock_token,
+        )
+
+    async def run(
+            self,
+            key: str,
+            call: typing.Callable[[], typing.Awaitable[T | None]],
+    ) -> tuple[T | None, bool]:
+        """
+        Return the result of `call`, or of an identical call already in
+        flight, and whether it came from that other call.
+        """
+
+        flight = await self.begin(key)
+        result = None
+        try:
+            if not flight.is_leader:
+                result = await flight.wait()
+                if result is not None:
+                    return result, True
+
+            result = await call()
+
+            return result, False
+
+        finally:
+            await flight.finish(result)
+
+    async def _wait_remote(self, key: str) -> T | None:
+        waiter = asyncio.get_running_loop().create_future()
+        self._remote_waiters[key] = waiter
+
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                pipe.get(self._result_key(key))
+                pipe.get(self._lock_key(key))
+                payload, lock_token = await pipe.execute()
+
+            if payload is None:
+                if lock_token is None:
+                    # The leader is gone without leaving a result.
+                    return None
+
+                payload = await asyncio.wait_for(waiter, self.timeout)
+
+            # An empty payload is the leader reporting a failure.
+            return self._decode(payload) if payload else None
+
+        except (TimeoutError, redis.RedisError):
+            return None
+
+        finally:
+            self._remote_waiters.pop(key, None)
+
+    async def _publish(
+            self,
+            key: str,
+            result: T | None,
+            lock_token: str,
+    ) -> None:
+        payload = b"" if result is None else self._encode(result)
+
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                if payload:
+                    pipe.set(
+                        self._result_key(key),
+                        payload,
+                        px=int(self._result_ttl * 1000),
+                    )
+                pipe.publish(
+                    self._channel,
+                    key.encode("utf-8") + b"\n" + payload,
+                )
+                await pipe.execute()
+
+            await self._release_lock(keys=[self._lock_key(key)], args=[lock_token])
+
+        except redis.RedisError as e:
+            # Followers elsewhere fall back once the lock or their wait
+            # expires.
+            logger.warning(f"Single flight '{self.namespace}' publish: {e}")
+
+    async def listen(self) -> None:
+        """Background task relaying other workers' results to waiters."""
+
+        while True:
+            try:
+                async with self.redis_client.pubsub() as pubsub:
+                    await pubsub.subscribe(self._channel)
+
+                    while True:
+                        message = await pubsub.get_message(
+                            ignore_subscribe_messages=True,
+                            timeout=1.0,
+                        )
+                        if message is None:
+                            continue
+
+                        key, _, payload = message["data"].partition(b"\n")
+                        waiter = self._remote_waiters.get(key.decode("utf-8"))
+                        if waiter is not None and not waiter.done():
+                            waiter.set_result(payload)
+
+            except redis.RedisError as e:
+                logger.warning(
+                    f"Single flight '{self.namespace}' listener failed: {e}"
+                )
+
+                await asyncio.sleep(1.0)
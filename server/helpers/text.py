@@ -0,0 +1,34 @@
+import re
+import unicodedata
+
+# Function words that carry no legal meaning. Matched after normalize_text,
+# so they are lowercase and without accents.
+STOPWORDS = frozenset((
+    "a", "ao", "aos", "as", "com", "como", "da", "das", "de", "do", "dos",
+    "e", "ela", "ele", "em", "esta", "eu", "isso", "me", "meu", "minha",
+    "na", "nas", "no", "nos", "o", "os", "ou", "para", "pela", "pelo",
+    "por", "posso", "pode", "qual", "quais", "que", "se", "sem", "ser",
+    "sua", "seu", "tem", "tenho", "um", "uma", "fazer",
+))
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase, strip accents and collapse whitespace."""
+
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    folded = "".join(c for c in decomposed if not unicodedata.combining(c))
+
+    return " ".join(folded.split())
+
+
+def content_words(text: str, stem_length: int = 6) -> list[str]:
+    """
+    Normalized words of `text` without stopwords, cut to `stem_length`
+    characters as a crude stemmer ("demitido"/"demitida" -> "demiti").
+    """
+
+    return [
+        word[:stem_length]
+        for word in re.findall(r"[a-z0-9]+", normalize_text(text))
+        if len(word) > 1 and word not in STOPWORDS
+    ]
@@ -0,0 +1,279 @@
+import argparse
+import asyncio
+import functools
+import json
+import os
+import sys
+
+from dotenv import load_dotenv
+
+from agents.legal_dispatcher.router import (
+    evaluate_router,
+    load_routing_examples,
+    ROUTING_EXAMPLES_PATH,
+)
+from helpers.db_helpers import instantiate_db_pool, rebuild_rating_counters
+from helpers.ingestion import (
+    ingest_into_local_index,
+    ingest_into_ragflow,
+    load_manifest,
+    save_manifest,
+)
+from helpers.local_index import embed_texts_async
+
+
+async def ingest_laws_command(args: argparse.Namespace) -> None:
+    # Each file is one document, named after it: laws/clt.txt -> "clt".
+    sources = [
+        (path, os.path.splitext(os.path.basename(path))[0])
+        for path in args.sources
+    ]
+
+    manifest_path = args.manifest
+    if manifest_path is None and args.target == "local":
+        manifest_path = os.path.join(args.index_dir, "manifest.json")
+    elif manifest_path is None:
+        manifest_path = "ragflow_manifest.json"
+
+    manifest = load_manifest(manifest_path)
+
+    if args.target == "local":
+        embed_texts = None
+        if args.embed:
+            from google import genai
+
+            embed_texts = functools.partial(
+                embed_texts_async,
+                genai.Client(),
+                os.environ.get("LOCAL_EMBEDDING_MODEL", "text-embedding-004"),
+            )
+
+        plan = await ingest_into_local_index(
+            args.index_dir,
+            sources,
+            manifest,
+            embed_texts,
+        )
+        failures = 0
+        save_manifest(manifest_path, manifest)
+
+    else:
+        # Imported here: services reads the server settings on import.
+        from services import (
+            get_rag_object,
+            get_retrieval_cache,
+            teardown_shared_resources,
+        )
+
+        try:
+            plan, failures = await ingest_into_ragflow(
+                await get_rag_object(),
+                os.environ["LAW_DATASET_NAME"],
+                sources,
+                manifest,
+                concurrency=args.concurrency,
+            )
+
+            if not plan.is_empty:
+                # Cached retrievals may hold the old text of changed units.
+                retrieval_cache = await get_retrieval_cache()
+                await retrieval_cache.purge()
+
+        finally:
+            # Saved even on failure, so finished upserts are not redone.
+            save_manifest(manifest_path, manifest)
+            await teardown_shared_resources()
+
+    print(
+        f"{len(plan.hashes)} units parsed, {len(plan.changed)} upserted, "
+        f"{len(plan.removed)} removed, {failures} failed."
+    )
+
+
+async def evaluate_router_command(args: argparse.Namespace) -> None:
+    examples = load_routing_examples(args.examples)
+    held_out = None
+    if args.held_out is not None:
+        held_out = load_routing_examples(args.held_out)
+
+    report = evaluate_router(examples, args.threshold, held_out)
+    print(json.dumps(report, indent=2))
+
+
+async def benchmark_command(args: argparse.Namespace) -> None:
+    from benchmarks.harness import (
+        compare_to_baseline,
+        FakeLatencies,
+        format_report,
+        load_report,
+        run_benchmark,
+        save_report,
+    )
+
+    report = await run_benchmark(
+        endpoints=args.endpoints,
+        requests=args.requests,
+        concurrency=args.concurrency,
+        warmup=args.warmup,
+        users=args.users,
+        latencies=FakeLatencies.parse(args.latency),
+    )
+    print(format_report(report))
+
+    if args.save_baseline:
+        save_report(args.save_baseline, report)
+        print(f"Baseline saved to {args.save_baseline}.")
+
+    if args.baseline:
+        regressions = compare_to_baseline(
+            report,
+            load_report(args.baseline),
+            args.tolerance,
+        )
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+
+        if regressions:
+            sys.exit(1)
+
+        print("No regressions against the baseline.")
+
+
+async def purge_answer_cache_command(args: argparse.Namespace) -> None:
+    # Imported here: services reads the server settings on import.
+    from services import get_redis_client, purge_answer_cache
+    from helpers.sessions import close_redis_client
+
+    try:
+        purged = await purge_answer_cache(args.domain)
+        print(f"Purged {purged} cached answers.")
+
+    finally:
+        await close_redis_client(await get_redis_client())
+
+
+async def rebuild_rating_counters_command(args: argparse.Namespace) -> None:
+    db_pool = await instantiate_db_pool(minconn=1, maxconn=1)
+    try:
+        await rebuild_rating_counters(db_pool)
+        print("Rating counters rebuilt.")
+
+    finally:
+        await db_pool.close()
+
+
+def main() -> None:
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Legal Assistant management")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    rebuild_parser = subparsers.add_parser(
+        "rebuild-rating-counters",
+        help="Recompute users_rate_counters_tb from users_rate_tb.",
+    )
+    rebuild_parser.set_defaults(handler=rebuild_rating_counters_command)
+
+    purge_parser = subparsers.add_parser(
+        "purge-answer-cache",
+        help="Delete cached answers, optionally for a single domain.",
+    )
+    purge_parser.add_argument(
+        "--domain",
+        help="Sub-agent name, e.g. WorkerLawAgent. Purges everything if omitted.",
+    )
+    purge_parser.set_defaults(handler=purge_answer_cache_command)
+
+    router_parser = subparsers.add_parser(
+        "evaluate-router",
+        help="Report the local domain router's coverage and accuracy.",
+    )
+    router_parser.add_argument(
+        "--examples",
+        default=ROUTING_EXAMPLES_PATH,
+        help="Labeled JSONL used for training.",
+    )
+    router_parser.add_argument(
+        "--held-out",
+        help="Labeled JSONL to score. Uses leave-one-out if omitted.",
+    )
+    router_parser.add_argument("--threshold", type=float, default=0.75)
+    router_parser.set_defaults(handler=evaluate_router_command)
+
+    ingest_parser = subparsers.add_parser(
+        "ingest-laws",
+        help="Parse statutes and upsert changed articles into the index.",
+    )
+    ingest_parser.add_argument("sources", nargs="+", help="UTF-8 text files.")
+    ingest_parser.add_argument(
+        "--target",
+        choices=("local", "ragflow"),
+        default=os.environ.get("RETRIEVER_BACKEND", "ragflow"),
+    )
+    ingest_parser.add_argument(
+        "--index-dir",
+        default=os.environ.get("LOCAL_INDEX_DIR", "local_index"),
+    )
+    ingest_parser.add_argument(
+        "--manifest",
+        help="Content hashes of ingested units. Defaults per target.",
+    )
+    ingest_parser.add_argument(
+        "--embed",
+        action="store_true",
+        help="Local target: also store vectors from LOCAL_EMBEDDING_MODEL.",
+    )
+    ingest_parser.add_argument("--concurrency", type=int, default=8)
+    ingest_parser.set_defaults(handler=ingest_laws_command)
+
+    benchmark_parser = subparsers.add_parser(
+        "benchmark",
+        help="Load-test the ASGI app in process against local fakes.",
+    )
+    benchmark_parser.add_argument(
+        "--endpoints",
+        nargs="+",
+        choices=("/query/", "/rate/", "/clear/", "/api/get-ratings"),
+        default=["/query/", "/rate/", "/clear/", "/api/get-ratings"],
+    )
+    benchmark_parser.add_argument("--requests", type=int, default=200)
+    benchmark_parser.add_argument("--concurrency", type=int, default=20)
+    benchmark_parser.add_argument("--warmup", type=int, default=10)
+    benchmark_parser.add_argument(
+        "--users",
+        type=int,
+        default=50,
+        help="Distinct chat users the requests cycle through.",
+    )
+    benchmark_parser.add_argument(
+        "--latency",
+        action="append",
+        default=[],
+        metavar="FAKE=SECONDS",
+        help="Fake latency, e.g. --latency llm=0.5 --latency redis=0. "
+             "Fakes: redis, postgres, sessions, ragflow, llm, genai.",
+    )
+    benchmark_parser.add_argument(
+        "--save-baseline",
+        metavar="PATH",
+        help="Write the results as JSON, to compare later runs against.",
+    )
+    benchmark_parser.add_argument(
+        "--baseline",
+        metavar="PATH",
+        help="Fail if results regressed against this saved baseline.",
+    )
+    benchmark_parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Allowed relative slowdown before it counts as a regression.",
+    )
+    benchmark_parser.set_defaults(handler=benchmark_command)
+
+    args = parser.parse_args()
+    asyncio.run(args.handler(args))
+
+
+if __name__ == "__main__":
+    main()
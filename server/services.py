@@ -0,0 +1,1425 @@
+import asyncio
+import dataclasses
+import hashlib
+import logging
+import os
+import time
+import typing
+
+import httpx
+import numpy as np
+import redis.asyncio as redis
+from cachetools import TTLCache
+from redis.commands.core import AsyncScript
+
+from dotenv import load_dotenv
+from flask import Config
+from google import genai
+from google.genai import types
+
+from google.adk.agents import LlmAgent
+from google.adk.agents.run_config import RunConfig, StreamingMode
+from google.adk.events import Event
+from google.adk.runners import Runner
+from google.adk.sessions import DatabaseSessionService, Session
+from google.genai import errors as google_exceptions
+
+from agents.legal_dispatcher.agent import (
+    compute_agent_version_async,
+    create_root_agent_async,
+    create_runner_async,
+    create_session_async,
+    delete_session_async,
+    instantiate_database_session_service,
+    retrieve_pool_stats_async,
+    retrieve_session_async,
+)
+from agents.legal_dispatcher.callbacks import (
+    RAG_CONTEXT_INSTRUCTION,
+    set_rag_context,
+)
+from agents.legal_dispatcher.history import compact_session_async
+from agents.legal_dispatcher.router import (
+    DomainRouter,
+    instantiate_domain_router,
+)
+from helpers.context_helpers import (
+    ContextKey,
+    get_context_var,
+    set_context_var,
+)
+from helpers.db_helpers import (
+    ConnectionPool,
+    instantiate_db_pool,
+    RATINGS,
+    RatingWriteBuffer,
+    retrieve_rating_counts,
+)
+from helpers.answer_cache import (
+    answer_cache_key,
+    deserialize_answer,
+    replay_cached_answer,
+    serialize_answer,
+)
+from helpers.caching import TieredCache
+from helpers.job_queue import is_allowed_callback_url, JobQueue
+from helpers.prompt_builder import build_prompt_context
+from helpers.sessions import (
+    close_redis_client,
+    instantiate_redis_client,
+    instantiate_user_id_cache,
+    instantiate_user_id_script,
+    listen_user_id_invalidations,
+    pop_user_id,
+    resolve_user_id,
+    retrieve_user_id,
+)
+
+from helpers.local_index import embed_texts_async, open_local_index
+from helpers.log_helpers import BodySampler, configure_server_logging
+from helpers.metrics import (
+    collect_metrics,
+    error_type,
+    publish_metrics,
+    QUERY_ERRORS,
+    STAGE_SECONDS,
+    timed,
+)
+from helpers.rag import (
+    close_rag_object,
+    DatasetCache,
+    deserialize_chunks,
+    instantiate_dataset_cache,
+    instantiate_rag_object,
+    RetrievedChunk,
+    serialize_chunks,
+)
+from helpers.retrievers import LocalRetriever, RAGFlowRetriever, Retriever
+from helpers.single_flight import Flight, SingleFlight
+
+entrypoint = os.path.abspath(os.path.dirname(__file__))
+
+load_dotenv()
+
+logger = logging.getLogger("server_logs")
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+# Importing this module twice (e.g. as __main__ and by name) must not add
+# a second writer, which would duplicate every line.
+if not logger.handlers:
+    configure_server_logging(
+        logger,
+        os.environ.get(
+            "LOG_FILE",
+            os.path.join(entrypoint, "server_logs.log"),
+        ),
+        max_bytes=int(os.environ.get("LOG_MAX_BYTES", 10 * 1024 * 1024)),
+        backup_count=int(os.environ.get("LOG_BACKUP_COUNT", 5)),
+        queue_size=int(os.environ.get("LOG_QUEUE_SIZE", 10_000)),
+        log_format=os.environ.get("LOG_FORMAT", "json").lower(),
+    )
+
+# Queries and model answers can be long; only a sample, cut to
+# LOG_BODY_MAX_CHARS, is logged.
+BODY_SAMPLER = BodySampler(
+    max_chars=int(os.environ.get("LOG_BODY_MAX_CHARS", 500)),
+    sample_rate=float(os.environ.get("LOG_BODY_SAMPLE_RATE", 1.0)),
+)
+
+# Shared by the WSGI (Flask) and ASGI entry points, both of which keep
+# reading their settings from FLASK_* environment variables.
+config = Config(entrypoint)
+config.from_prefixed_env()
+
+RATINGS_CACHE_MAX_AGE = int(os.environ.get("RATINGS_CACHE_MAX_AGE", 10))
+ANSWER_CACHE_ENABLED = (
+    os.environ.get("ANSWER_CACHE_ENABLED", "false").lower() == "true"
+)
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", 6000))
+PROMPT_DEDUP_THRESHOLD = float(os.environ.get("PROMPT_DEDUP_THRESHOLD", 0.8))
+# "inline" stores the chunks in the session with the question, "ephemeral"
+# only passes them to the model for the current turn.
+RAG_CONTEXT_MODE = os.environ.get("RAG_CONTEXT_MODE", "inline").lower()
+HISTORY_MAX_TURNS = int(os.environ.get("HISTORY_MAX_TURNS", 6))
+HISTORY_COMPACT_BATCH = int(os.environ.get("HISTORY_COMPACT_BATCH", 4))
+# Sessions are loaded with at most this many recent events. It must cover
+# the HISTORY_MAX_TURNS + HISTORY_COMPACT_BATCH turns compaction looks at,
+# and a turn takes a few events (question, transfers, tool calls, answer).
+HISTORY_MAX_EVENTS = int(
+    os.environ.get(
+        "HISTORY_MAX_EVENTS",
+        20 * (HISTORY_MAX_TURNS + HISTORY_COMPACT_BATCH + 1),
+    ),
+)
+ROUTER_ENABLED = os.environ.get("ROUTER_ENABLED", "true").lower() == "true"
+# Identical concurrent retrievals and first-turn answers share one call in
+# each worker, and across workers too when SINGLE_FLIGHT_DISTRIBUTED is on.
+SINGLE_FLIGHT_DISTRIBUTED = (
+    os.environ.get("SINGLE_FLIGHT_DISTRIBUTED", "false").lower() == "true"
+)
+RAGFLOW_RETRIEVAL_TIMEOUT = float(
+    os.environ.get("RAGFLOW_RETRIEVAL_TIMEOUT", 30.0),
+)
+# Followers stop waiting for the leader early enough to still retrieve by
+# themselves within RAGFLOW_RETRIEVAL_TIMEOUT.
+RETRIEVAL_FLIGHT_TIMEOUT = float(
+    os.environ.get("RETRIEVAL_FLIGHT_TIMEOUT", RAGFLOW_RETRIEVAL_TIMEOUT / 2),
+)
+# When on, /query/ only enqueues the query and worker.py answers it.
+JOB_QUEUE_ENABLED = (
+    os.environ.get("JOB_QUEUE_ENABLED", "false").lower() == "true"
+)
+JOB_TIMEOUT = float(os.environ.get("JOB_TIMEOUT", 300.0))
+# Comma-separated hosts workers may POST results to. A /query/ naming any
+# other callback host is refused, so callers cannot aim workers elsewhere.
+JOB_CALLBACK_HOSTS = frozenset(
+    host.strip()
+    for host in os.environ.get("JOB_CALLBACK_HOSTS", "").split(",")
+    if host.strip()
+)
+# Saved with the question a job's attempt adds to the session, so another
+# attempt neither asks it again nor answers it twice. "temp:" keeps it out
+# of the session state; it stays on the event.
+JOB_ID_STATE_KEY = "temp:job_id"
+
+AGENT_KEY = ContextKey[LlmAgent]("agent")
+AGENT_VERSION_KEY = ContextKey[str]("agent_version")
+DOMAIN_ROUTER_KEY = ContextKey[DomainRouter]("domain_router")
+GENAI_CLIENT_KEY = ContextKey[genai.Client]("genai_client")
+RETRIEVER_KEY = ContextKey[Retriever]("retriever")
+REDIS_CLIENT_KEY = ContextKey[redis.Redis]("redis_client")
+USER_ID_CACHE_KEY = ContextKey[TTLCache[str, str]]("user_id_cache")
+USER_ID_SCRIPT_KEY = ContextKey[AsyncScript]("user_id_script")
+DB_POOL_KEY = ContextKey[ConnectionPool]("db_pool")
+RATING_BUFFER_KEY = ContextKey[RatingWriteBuffer]("rating_buffer")
+RAG_OBJECT_KEY = ContextKey[httpx.AsyncClient]("rag_object")
+DATASET_CACHE_KEY = ContextKey[DatasetCache]("dataset_cache")
+RETRIEVAL_CACHE_KEY = ContextKey[TieredCache]("retrieval_cache")
+ANSWER_CACHE_KEY = ContextKey[TieredCache]("answer_cache")
+RETRIEVAL_FLIGHT_KEY = ContextKey[SingleFlight[list[RetrievedChunk]]](
+    "retrieval_flight",
+)
+ANSWER_FLIGHT_KEY = ContextKey[SingleFlight[tuple[str, str]]](
+    "answer_flight",
+)
+JOB_QUEUE_KEY = ContextKey[JobQueue]("job_queue")
+BACKGROUND_TASKS_KEY = ContextKey[list[asyncio.Task]]("background_tasks")
+DATABASE_SESSION_SERVICE_KEY = ContextKey[DatabaseSessionService](
+    "database_session_service",
+)
+
+
+async def get_database_session_service() -> DatabaseSessionService:
+    database_session_service = await get_context_var(
+        DATABASE_SESSION_SERVICE_KEY,
+    )
+    if database_session_service is None:
+        database_session_service = await instantiate_database_session_service(
+            config["DB_URL"],
+            pool_size=config.get("DB_POOL_SIZE", 5),
+            max_overflow=config.get("DB_MAX_OVERFLOW", 10),
+            pool_recycle=config.get("DB_POOL_RECYCLE", 1800),
+            pool_pre_ping=config.get("DB_POOL_PRE_PING", True),
+            max_events=HISTORY_MAX_EVENTS if HISTORY_MAX_TURNS > 0 else None,
+        )
+        await set_context_var(
+            DATABASE_SESSION_SERVICE_KEY,
+            database_session_service,
+        )
+
+    return database_session_service
+
+
+async def get_redis_client() -> redis.Redis:
+    redis_client = await get_context_var(REDIS_CLIENT_KEY)
+    if redis_client is None:
+        redis_client = await instantiate_redis_client(
+            os.environ["REDIS_HOST"],
+            int(os.environ["REDIS_PORT"]),
+            max_connections=int(os.environ.get("REDIS_MAX_CONNECTIONS", 50)),
+            pool_timeout=float(os.environ.get("REDIS_POOL_TIMEOUT", 5.0)),
+            socket_timeout=float(os.environ.get("REDIS_SOCKET_TIMEOUT", 5.0)),
+            socket_connect_timeout=float(
+                os.environ.get("REDIS_SOCKET_CONNECT_TIMEOUT", 2.0),
+            ),
+        )
+        await set_context_var(REDIS_CLIENT_KEY, redis_client)
+
+    return redis_client
+
+
+async def get_user_id_script() -> AsyncScript:
+    user_id_script = await get_context_var(USER_ID_SCRIPT_KEY)
+    if user_id_script is None:
+        user_id_script = await instantiate_user_id_script(
+            await get_redis_client(),
+        )
+        await set_context_var(USER_ID_SCRIPT_KEY, user_id_script)
+
+    return user_id_script
+
+
+async def get_user_id_cache() -> TTLCache[str, str]:
+    user_id_cache = await get_context_var(USER_ID_CACHE_KEY)
+    if user_id_cache is None:
+        user_id_cache = await instantiate_user_id_cache(
+            maxsize=int(os.environ.get("USER_ID_CACHE_SIZE", 10_000)),
+            ttl=float(os.environ.get("USER_ID_CACHE_TTL", 300.0)),
+        )
+        await set_context_var(USER_ID_CACHE_KEY, user_id_cache)
+
+    return user_id_cache
+
+
+async def get_db_pool() -> ConnectionPool:
+    db_pool = await get_context_var(DB_POOL_KEY)
+    if db_pool is None:
+        db_pool = await instantiate_db_pool(
+            minconn=int(os.environ.get("POSTGRES_POOL_MIN", 1)),
+            maxconn=int(os.environ.get("POSTGRES_POOL_MAX", 10)),
+        )
+        await set_context_var(DB_POOL_KEY, db_pool)
+
+    return db_pool
+
+
+async def get_rating_buffer() -> RatingWriteBuffer:
+    rating_buffer = await get_context_var(RATING_BUFFER_KEY)
+    if rating_buffer is None:
+        rating_buffer = RatingWriteBuffer(
+            await get_db_pool(),
+            max_size=int(os.environ.get("RATING_BATCH_SIZE", 100)),
+            flush_interval=float(
+                os.environ.get("RATING_FLUSH_INTERVAL", 1.0),
+            ),
+        )
+        await set_context_var(RATING_BUFFER_KEY, rating_buffer)
+
+    return rating_buffer
+
+
+async def get_rag_object() -> httpx.AsyncClient:
+    rag_object = await get_context_var(RAG_OBJECT_KEY)
+    if rag_object is None:
+        rag_object = await instantiate_rag_object(
+            api_key=os.environ["RAGFLOW_API_KEY"],
+            base_url=os.environ["RAGFLOW_BASE_URL"],
+            timeout=float(os.environ.get("RAGFLOW_TIMEOUT", 15.0)),
+            connect_timeout=float(
+                os.environ.get("RAGFLOW_CONNECT_TIMEOUT", 3.0),
+            ),
+            max_connections=int(
+                os.environ.get("RAGFLOW_MAX_CONNECTIONS", 20),
+            ),
+        )
+        await set_context_var(RAG_OBJECT_KEY, rag_object)
+
+    return rag_object
+
+
+async def get_dataset_cache() -> DatasetCache:
+    dataset_cache = await get_context_var(DATASET_CACHE_KEY)
+    if dataset_cache is None:
+        dataset_cache = await instantiate_dataset_cache(
+            ttl=float(os.environ.get("RAGFLOW_DATASET_CACHE_TTL", 600.0)),
+        )
+        await set_context_var(DATASET_CACHE_KEY, dataset_cache)
+
+    return dataset_cache
+
+
+async def get_retrieval_cache() -> TieredCache:
+    retrieval_cache = await get_context_var(RETRIEVAL_CACHE_KEY)
+    if retrieval_cache is None:
+        retrieval_cache = TieredCache(
+            "retrieval",
+            await get_redis_client(),
+            local_maxsize=int(
+                os.environ.get("RETRIEVAL_CACHE_LOCAL_SIZE", 1024),
+            ),
+            local_ttl=float(os.environ.get("RETRIEVAL_CACHE_LOCAL_TTL", 300.0)),
+            remote_ttl=int(os.environ.get("RETRIEVAL_CACHE_TTL", 3600)),
+            remote_max_entries=int(
+                os.environ.get("RETRIEVAL_CACHE_MAX_ENTRIES", 10_000),
+            ),
+        )
+        await set_context_var(RETRIEVAL_CACHE_KEY, retrieval_cache)
+
+    return retrieval_cache
+
+
+async def get_answer_cache() -> TieredCache:
+    answer_cache = await get_context_var(ANSWER_CACHE_KEY)
+    if answer_cache is None:
+        answer_cache = TieredCache(
+            "answers",
+            await get_redis_client(),
+            local_maxsize=int(os.environ.get("ANSWER_CACHE_LOCAL_SIZE", 512)),
+            # Kept short because purges only reach this worker's local tier.
+            local_ttl=float(os.environ.get("ANSWER_CACHE_LOCAL_TTL", 60.0)),
+            remote_ttl=int(os.environ.get("ANSWER_CACHE_TTL", 86400)),
+            remote_max_entries=int(
+                os.environ.get("ANSWER_CACHE_MAX_ENTRIES", 5000),
+            ),
+        )
+        await set_context_var(ANSWER_CACHE_KEY, answer_cache)
+
+    return answer_cache
+
+
+async def _instantiate_single_flight(
+        namespace: str,
+        encode: typing.Callable[[typing.Any], bytes],
+        decode: typing.Callable[[bytes], typing.Any],
+        timeout: float,
+) -> SingleFlight:
+    redis_client = None
+    if SINGLE_FLIGHT_DISTRIBUTED:
+        redis_client = await get_redis_client()
+
+    return SingleFlight(
+        namespace,
+        encode,
+        decode,
+        redis_client=redis_client,
+        timeout=timeout,
+        lock_ttl=float(os.environ.get("SINGLE_FLIGHT_LOCK_TTL", 60.0)),
+    )
+
+
+async def get_retrieval_flight() -> SingleFlight[list[RetrievedChunk]]:
+    retrieval_flight = await get_context_var(RETRIEVAL_FLIGHT_KEY)
+    if retrieval_flight is None:
+        retrieval_flight = await _instantiate_single_flight(
+            "retrieval",
+            serialize_chunks,
+            deserialize_chunks,
+            timeout=RETRIEVAL_FLIGHT_TIMEOUT,
+        )
+        await set_context_var(RETRIEVAL_FLIGHT_KEY, retrieval_flight)
+
+    return retrieval_flight
+
+
+async def get_answer_flight() -> SingleFlight[tuple[str, str]]:
+    answer_flight = await get_context_var(ANSWER_FLIGHT_KEY)
+    if answer_flight is None:
+        answer_flight = await _instantiate_single_flight(
+            "answers",
+            lambda answer: serialize_answer(*answer),
+            deserialize_answer,
+            timeout=float(os.environ.get("ANSWER_FLIGHT_TIMEOUT", 60.0)),
+        )
+        await set_context_var(ANSWER_FLIGHT_KEY, answer_flight)
+
+    return answer_flight
+
+
+async def get_job_queue() -> JobQueue:
+    job_queue = await get_context_var(JOB_QUEUE_KEY)
+    if job_queue is None:
+        job_queue = JobQueue(
+            await get_redis_client(),
+            max_attempts=int(os.environ.get("JOB_MAX_ATTEMPTS", 3)),
+            # A job still running must never look abandoned.
+            claim_idle=float(
+                os.environ.get("JOB_CLAIM_IDLE", JOB_TIMEOUT + 30.0),
+            ),
+            result_ttl=int(os.environ.get("JOB_RESULT_TTL", 3600)),
+        )
+        await set_context_var(JOB_QUEUE_KEY, job_queue)
+
+    return job_queue
+
+
+async def get_agent() -> LlmAgent:
+    agent = await get_context_var(AGENT_KEY)
+    if agent is None:
+        agent = await create_root_agent_async()
+        await set_context_var(AGENT_KEY, agent)
+
+    return agent
+
+
+async def get_agent_version() -> str:
+    agent_version = await get_context_var(AGENT_VERSION_KEY)
+    if agent_version is None:
+        agent_version = await compute_agent_version_async(await get_agent())
+        await set_context_var(AGENT_VERSION_KEY, agent_version)
+
+    return agent_version
+
+
+async def get_domain_router() -> DomainRouter:
+    domain_router = await get_context_var(DOMAIN_ROUTER_KEY)
+    if domain_router is None:
+        domain_router = await instantiate_domain_router(
+            threshold=float(
+                os.environ.get("ROUTER_CONFIDENCE_THRESHOLD", 0.75),
+            ),
+        )
+        await set_context_var(DOMAIN_ROUTER_KEY, domain_router)
+
+    return domain_router
+
+
+async def get_genai_client() -> genai.Client:
+    genai_client = await get_context_var(GENAI_CLIENT_KEY)
+    if genai_client is None:
+        # Reads the same GOOGLE_API_KEY the agents use.
+        genai_client = genai.Client()
+        await set_context_var(GENAI_CLIENT_KEY, genai_client)
+
+    return genai_client
+
+
+async def embed_query(question: str) -> np.ndarray:
+    vectors = await embed_texts_async(
+        await get_genai_client(),
+        os.environ.get("LOCAL_EMBEDDING_MODEL", "text-embedding-004"),
+        [question],
+    )
+
+    return vectors[0]
+
+
+async def get_retriever() -> Retriever:
+    retriever = await get_context_var(RETRIEVER_KEY)
+    if retriever is not None:
+        return retriever
+
+    backend = os.environ.get("RETRIEVER_BACKEND", "ragflow").lower()
+    if backend == "local":
+        dense_weight = float(os.environ.get("LOCAL_DENSE_WEIGHT", 0.0))
+        retriever = LocalRetriever(
+            await open_local_index(os.environ["LOCAL_INDEX_DIR"]),
+            top_k=int(os.environ.get("LOCAL_TOP_K", 8)),
+            dense_weight=dense_weight,
+            embed_query=embed_query if dense_weight > 0 else None,
+        )
+
+    elif backend == "ragflow":
+        retriever = RAGFlowRetriever(
+            os.environ["LAW_DATASET_NAME"],
+            await get_rag_object(),
+            await get_dataset_cache(),
+            await get_retrieval_cache(),
+            await get_retrieval_flight(),
+        )
+
+    else:
+        raise ValueError(f"Unknown RETRIEVER_BACKEND: {backend}")
+
+    await set_context_var(RETRIEVER_KEY, retriever)
+
+    return retriever
+
+
+@timed("history.compact")
+async def compact_query_session(session: Session) -> Session:
+    """
+    Send the model only the last HISTORY_MAX_TURNS turns plus a summary.
+
+    A failed summarization leaves the history as it is; the next turn tries
+    again. If saving the summary fails, whatever was stored is reloaded.
+    """
+
+    if HISTORY_MAX_TURNS <= 0:
+        return session
+
+    database_session_service = await get_database_session_service()
+    try:
+        return await compact_session_async(
+            database_session_service,
+            session,
+            await get_genai_client(),
+            os.environ.get("HISTORY_SUMMARY_MODEL", "gemini-2.5-flash-lite"),
+            max_turns=HISTORY_MAX_TURNS,
+            compact_batch=HISTORY_COMPACT_BATCH,
+        )
+
+    except Exception as e:
+        logger.error(f"Could not compact session {session.id}: {e}")
+
+    stored_session = await retrieve_session_async(
+        database_session_service,
+        session.app_name,
+        session.user_id,
+        session.id,
+    )
+    if stored_session is None:
+        stored_session = await create_session_async(
+            database_session_service,
+            session.app_name,
+            session.user_id,
+            session.id,
+        )
+
+    return stored_session
+
+
+@timed("routing")
+async def route_query(user_query: str) -> LlmAgent:
+    """
+    Pick the agent that should answer `user_query`.
+
+    Confident local classifications go straight to the domain sub-agent,
+    skipping the root agent's LLM routing call. Ambiguous questions keep
+    the root agent, which also resumes whichever sub-agent answered last.
+    """
+
+    agent = await get_agent()
+    if not ROUTER_ENABLED:
+        return agent
+
+    domain_router = await get_domain_router()
+    decision = domain_router.classify(user_query)
+    if decision.domain is None:
+        logger.info(
+            f"Router fallback to {agent.name} "
+            f"(confidence {decision.confidence:.2f})"
+        )
+
+        return agent
+
+    sub_agent = agent.find_agent(decision.domain)
+    if sub_agent is None:
+        logger.warning(f"Router picked unknown agent: {decision.domain}")
+
+        return agent
+
+    logger.info(
+        f"Routed locally to {sub_agent.name} "
+        f"(confidence {decision.confidence:.2f})"
+    )
+
+    return typing.cast(LlmAgent, sub_agent)
+
+
+async def setup_shared_resources() -> None:
+    await get_database_session_service()
+    redis_client = await get_redis_client()
+    await get_user_id_script()
+    user_id_cache = await get_user_id_cache()
+    rating_buffer = await get_rating_buffer()
+    await get_retriever()
+    await get_retrieval_cache()
+    await get_answer_cache()
+    await get_domain_router()
+    retrieval_flight = await get_retrieval_flight()
+    answer_flight = await get_answer_flight()
+
+    background_tasks = [
+        asyncio.create_task(
+            listen_user_id_invalidations(redis_client, user_id_cache),
+        ),
+        asyncio.create_task(rating_buffer.run()),
+        asyncio.create_task(
+            publish_metrics(
+                redis_client,
+                float(os.environ.get("METRICS_PUBLISH_INTERVAL", 5.0)),
+            ),
+        ),
+    ]
+    if SINGLE_FLIGHT_DISTRIBUTED:
+        background_tasks.extend((
+            asyncio.create_task(retrieval_flight.listen()),
+            asyncio.create_task(answer_flight.listen()),
+        ))
+    await set_context_var(BACKGROUND_TASKS_KEY, background_tasks)
+
+    logger.info("Shared resources created")
+
+
+async def teardown_shared_resources() -> None:
+    background_tasks = await get_context_var(BACKGROUND_TASKS_KEY) or []
+    for task in background_tasks:
+        task.cancel()
+
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+
+    rating_buffer = await get_context_var(RATING_BUFFER_KEY)
+    if rating_buffer is not None:
+        try:
+            await rating_buffer.flush()
+
+        except Exception as e:
+            logger.error(f"Database error flushing ratings: {e}")
+
+    db_pool = await get_context_var(DB_POOL_KEY)
+    if db_pool is not None:
+        await db_pool.close()
+
+    rag_object = await get_context_var(RAG_OBJECT_KEY)
+    if rag_object is not None:
+        await close_rag_object(rag_object)
+
+    redis_client = await get_context_var(REDIS_CLIENT_KEY)
+    if redis_client is not None:
+        await close_redis_client(redis_client)
+
+    logger.info("Shared resources closed")
+
+
+@dataclasses.dataclass
+class QuerySession:
+    request_user_id: str
+    user_id: str
+    session_id: str
+    app_name: str
+    runner: Runner
+    session: Session
+
+    @property
+    def is_first_turn(self) -> bool:
+        return not self.session.events
+
+    def job_turn(self, job_id: str) -> list[Event] | None:
+        """The events since an earlier attempt at `job_id` asked its query."""
+
+        events = self.session.events
+        for index in range(len(events) - 1, -1, -1):
+            event = events[index]
+            if (
+                    event.author == "user"
+                    and event.actions.state_delta.get(JOB_ID_STATE_KEY)
+                    == job_id
+            ):
+                return events[index:]
+
+        return None
+
+
+def final_response_text(events: list[Event]) -> str | None:
+    for event in reversed(events):
+        if (
+                event.author != "user"
+                and event.is_final_response()
+                and event.content
+                and event.content.parts
+        ):
+            return event.content.parts[0].text
+
+    return None
+
+
+def validate_query_request(
+        request_data: dict[str, typing.Any] | None,
+) -> bool:
+    if not request_data:
+        logger.error("Missing request data.")
+
+        return False
+
+    if "query" not in request_data:
+        logger.error("Missing 'query' in request data")
+        logger.error(f"Request data: {request_data}")
+
+        return False
+
+    if "username" not in request_data or "user_id" not in request_data:
+        logger.error("Missing request data")
+        logger.error(f"Request data: {request_data}")
+
+        return False
+
+    return True
+
+
+def validate_callback_url(request_data: dict[str, typing.Any]) -> bool:
+    callback_url = request_data.get("callback_url")
+    if callback_url is None:
+        return True
+
+    if not is_allowed_callback_url(callback_url, JOB_CALLBACK_HOSTS):
+        logger.error(f"Callback URL not allowed: {callback_url!r}")
+
+        return False
+
+    return True
+
+
+@timed("query.open_session")
+async def open_query_session(
+        request_data: dict[str, typing.Any],
+) -> QuerySession:
+    app_name: str = config["APP_NAME"]
+    request_username = request_data["username"]
+    request_user_id = str(request_data["user_id"])
+
+    user_id_script = await get_user_id_script()
+    user_id_cache = await get_user_id_cache()
+    user_id = await resolve_user_id(
+        request_user_id,
+        request_username,
+        user_id_script,
+        user_id_cache,
+    )
+
+    session_id = f"session://{user_id}"
+
+    database_session_service = await get_database_session_service()
+
+    session = await retrieve_session_async(
+        database_session_service,
+        app_name,
+        user_id,
+        session_id,
+    )
+    if session is None:
+        session = await create_session_async(
+            database_session_service,
+            app_name,
+            user_id,
+            session_id,
+        )
+
+    session = await compact_query_session(session)
+
+    agent = await route_query(request_data["query"])
+
+    runner = await create_runner_async(
+        app_name=app_name,
+        session_service=database_session_service,
+        agent=agent,
+    )
+    logger.info("Runner created")
+
+    return QuerySession(
+        request_user_id=request_user_id,
+        user_id=user_id,
+        session_id=session_id,
+        app_name=app_name,
+        runner=runner,
+        session=session,
+    )
+
+
+@timed("retrieval")
+async def retrieve_query_chunks(user_query: str) -> list[RetrievedChunk]:
+    retriever = await get_retriever()
+    chunks = await asyncio.wait_for(
+        retriever.retrieve(user_query),
+        timeout=RAGFLOW_RETRIEVAL_TIMEOUT,
+    )
+
+    return chunks
+
+
+@timed("prompt.build")
+async def build_query_content(
+        user_query: str,
+        chunks: list[RetrievedChunk],
+) -> types.Content:
+    """
+    Build the message sent to the runner for this turn.
+
+    In "ephemeral" RAG_CONTEXT_MODE the message is just the question and
+    the chunks go to the agents' before_model_callback through a context
+    variable, so they are never stored in the session. In "inline" mode
+    they are appended to the message, as before.
+    """
+
+    prompt_context = build_prompt_context(
+        chunks,
+        token_budget=PROMPT_TOKEN_BUDGET,
+        dedup_threshold=PROMPT_DEDUP_THRESHOLD,
+    )
+
+    if RAG_CONTEXT_MODE == "ephemeral":
+        set_rag_context(prompt_context.text)
+        final_prompt = user_query
+
+    else:
+        final_prompt = "\n\n".join((
+            user_query,
+            RAG_CONTEXT_INSTRUCTION.format(chunks=prompt_context.text),
+        ))
+
+    content = types.Content(
+        role="user",
+        parts=[types.Part(text=final_prompt)]
+    )
+    logger.info(
+        f"Prompt context ({RAG_CONTEXT_MODE}): "
+        f"{len(prompt_context.chunks)}/{len(chunks)} chunks, "
+        f"~{prompt_context.tokens} tokens, "
+        f"~{prompt_context.tokens_saved} tokens saved "
+        f"({prompt_context.duplicates} duplicates, "
+        f"{prompt_context.over_budget} over budget)"
+    )
+
+    return content
+
+
+@timed("answer_cache.lookup")
+async def lookup_cached_answer(
+        query_session: QuerySession,
+        user_query: str,
+        chunks: list[RetrievedChunk],
+        content: types.Content,
+) -> tuple[str | None, str | None]:
+    """
+    Return the cache key and, on a hit, the cached answer.
+
+    Only first-turn questions are cached, since later answers depend on
+    the session history. The key is None when the answer is not cacheable.
+    """
+
+    if not ANSWER_CACHE_ENABLED or not query_session.is_first_turn:
+        return None, None
+
+    answer_cache = await get_answer_cache()
+    cache_key = answer_cache_key(
+        answer_cache,
+        user_query,
+        chunks,
+        await get_agent_version(),
+    )
+
+    cached_answer = await answer_cache.get(cache_key)
+    if cached_answer is None:
+        return cache_key, None
+
+    response, author = deserialize_answer(cached_answer)
+    await replay_cached_answer(
+        await get_database_session_service(),
+        query_session.session,
+        content,
+        response,
+        author,
+    )
+    logger.info("Answer cache hit")
+
+    return cache_key, response
+
+
+@timed("answer_cache.store")
+async def store_cached_answer(
+        cache_key: str | None,
+        response: str | None,
+        author: str,
+        run_seconds: float,
+) -> None:
+    if cache_key is None or not response:
+        return
+
+    answer_cache = await get_answer_cache()
+    answer_cache.record_miss_latency(run_seconds)
+
+    # Tagged with the answering sub-agent, i.e. the legal domain, so one
+    # domain can be purged on its own.
+    await answer_cache.set(
+        cache_key,
+        serialize_answer(response, author),
+        tags=(author,),
+    )
+
+
+async def begin_answer_flight(
+        query_session: QuerySession,
+        user_query: str,
+        chunks: list[RetrievedChunk],
+) -> Flight[tuple[str, str]] | None:
+    """
+    Lead, or join, the generation of an answer to this exact first-turn
+    question. None for later turns, whose answers depend on the history.
+    """
+
+    if not query_session.is_first_turn:
+        return None
+
+    answer_flight = await get_answer_flight()
+    flight_key = answer_cache_key(
+        await get_answer_cache(),
+        user_query,
+        chunks,
+        await get_agent_version(),
+    )
+
+    return await answer_flight.begin(flight_key)
+
+
+async def wait_for_shared_answer(
+        flight: Flight[tuple[str, str]] | None,
+        query_session: QuerySession,
+        content: types.Content,
+) -> tuple[str, str] | None:
+    """
+    The answer of an identical question already being generated, recorded
+    in this session too. None when this request has to generate it.
+    """
+
+    if flight is None or flight.is_leader:
+        return None
+
+    answer = await flight.wait()
+    if answer is None:
+        return None
+
+    response, author = answer
+    await replay_cached_answer(
+        await get_database_session_service(),
+        query_session.session,
+        content,
+        response,
+        author,
+    )
+    logger.info("Answer shared with an identical in-flight question")
+
+    return answer
+
+
+async def query_error_response(
+        query_session: QuerySession,
+        error: Exception,
+) -> tuple[dict[str, str], int]:
+    import traceback
+
+    if isinstance(error, (TimeoutError, httpx.TimeoutException)):
+        response = {
+            "response": "Retrieval timed out",
+        }
+        logger.error(traceback.format_exc())
+        QUERY_ERRORS.inc(error=error_type(error), status="504")
+
+        return response, 504
+
+    # TODO: invest in better error handling
+    if isinstance(error, google_exceptions.ServerError):
+        response = {
+            "response": "Internal Server Error",
+        }
+        logger.error(traceback.format_exc())
+        QUERY_ERRORS.inc(error=error_type(error), status="500")
+
+        return response, 500
+
+    if isinstance(error, google_exceptions.ClientError):
+        response = {
+            "response": "Client error."
+        }
+
+        # TODO: this should try again
+        if error.code == 400:
+            response = {
+                "response": "The request was invalid."
+            }
+
+            await reset_query_session(query_session)
+
+        # TODO: this should clean session and try again
+        elif error.code == 429:
+            response = {
+                "response": "Limit quota exceeded",
+            }
+
+            await reset_query_session(query_session)
+
+        logger.error(traceback.format_exc())
+        QUERY_ERRORS.inc(error=error_type(error), status="429")
+
+        return response, 429
+
+    # Catch-all for unexpected errors to ensure a tuple is always returned
+    logger.error(f"Unexpected error: {error}")
+    logger.error(traceback.format_exc())
+    QUERY_ERRORS.inc(error=error_type(error), status="500")
+
+    return {"response": f"An unexpected error occurred: {error}"}, 500
+
+
+async def reset_query_session(query_session: QuerySession) -> None:
+    redis_client = await get_redis_client()
+    user_id_cache = await get_user_id_cache()
+    database_session_service = await get_database_session_service()
+
+    await pop_user_id(
+        query_session.request_user_id,
+        redis_client,
+        user_id_cache,
+    )
+
+    await delete_session_async(
+        database_session_service,
+        query_session.app_name,
+        query_session.user_id,
+        query_session.session_id,
+    )
+
+
+async def stream_query_events(
+        request_data: dict[str, typing.Any],
+) -> typing.AsyncIterator[dict[str, typing.Any]]:
+    query_session = await open_query_session(request_data)
+
+    try:
+        user_query = request_data["query"]
+        chunks = await retrieve_query_chunks(user_query)
+        content = await build_query_content(user_query, chunks)
+
+        cache_key, cached_response = await lookup_cached_answer(
+            query_session,
+            user_query,
+            chunks,
+            content,
+        )
+        if cached_response is not None:
+            yield {"type": "final", "response": cached_response}
+
+            return
+
+        flight = await begin_answer_flight(query_session, user_query, chunks)
+        answer = None
+        try:
+            answer = await wait_for_shared_answer(
+                flight,
+                query_session,
+                content,
+            )
+            if answer is not None:
+                yield {"type": "final", "response": answer[0]}
+
+                return
+
+            started_at = time.perf_counter()
+            first_delta = True
+            async for event in query_session.runner.run_async(
+                user_id=query_session.user_id,
+                session_id=query_session.session_id,
+                new_message=content,
+                run_config=RunConfig(streaming_mode=StreamingMode.SSE),
+            ):
+                if not event.content or not event.content.parts:
+                    continue
+
+                text = event.content.parts[0].text
+                if event.partial:
+                    if text:
+                        if first_delta:
+                            first_delta = False
+                            STAGE_SECONDS.observe(
+                                time.perf_counter() - started_at,
+                                stage="llm.first_delta",
+                            )
+
+                        yield {"type": "delta", "text": text}
+
+                elif event.is_final_response():
+                    run_seconds = time.perf_counter() - started_at
+                    STAGE_SECONDS.observe(run_seconds, stage="llm")
+                    logged_response = BODY_SAMPLER.sample(text)
+                    if logged_response is not None:
+                        logger.info(
+                            f"Final model's response: {logged_response}"
+                        )
+
+                    await store_cached_answer(
+                        cache_key,
+                        text,
+                        event.author,
+                        run_seconds,
+                    )
+                    # Released before the last event is sent, so waiting
+                    # requests do not depend on this client reading it.
+                    answer = (text, event.author)
+                    if flight is not None:
+                        await flight.finish(answer)
+
+                    yield {"type": "final", "response": text}
+
+                    return
+
+        finally:
+            if flight is not None:
+                await flight.finish(answer)
+
+        logger.warning("Runner finished without a final response event.")
+        yield {
+            "type": "error",
+            "status": 500,
+            "response": "No final response received from agent.",
+        }
+
+    except Exception as e:
+        response, status = await query_error_response(query_session, e)
+
+        yield {"type": "error", "status": status, **response}
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """Whether asking again later may succeed: timeouts, 5xx and 429s."""
+
+    if isinstance(
+            error,
+            (
+                TimeoutError,
+                httpx.TimeoutException,
+                google_exceptions.ServerError,
+            ),
+    ):
+        return True
+
+    return (
+        isinstance(error, google_exceptions.ClientError)
+        and error.code == 429
+    )
+
+
+async def run_query(
+        request_data: dict[str, typing.Any],
+        job_id: str | None = None,
+        raise_retryable: bool = False,
+) -> tuple[dict[str, str], int]:
+    """
+    Answer a query. A job passes its `job_id`, so its attempts share one
+    turn in the session, and sets `raise_retryable` to get the errors
+    `is_retryable_error` accepts raised instead of turned into a response.
+    """
+
+    query_session = await open_query_session(request_data)
+
+    try:
+        new_message_state = None
+        job_turn = None
+        if job_id is not None:
+            new_message_state = {JOB_ID_STATE_KEY: job_id}
+            job_turn = query_session.job_turn(job_id)
+
+        if job_turn is not None:
+            final_response = final_response_text(job_turn)
+            if final_response is not None:
+                logger.info(f"Job {job_id} was already answered")
+
+                return {"response": final_response}, 200
+
+        user_query = request_data["query"]
+        chunks = await retrieve_query_chunks(user_query)
+        content = await build_query_content(user_query, chunks)
+
+        cache_key, cached_response = await lookup_cached_answer(
+            query_session,
+            user_query,
+            chunks,
+            content,
+        )
+        if cached_response is not None:
+            return {"response": cached_response}, 200
+
+        flight = await begin_answer_flight(query_session, user_query, chunks)
+        answer = None
+        try:
+            answer = await wait_for_shared_answer(
+                flight,
+                query_session,
+                content,
+            )
+            if answer is not None:
+                return {"response": answer[0]}, 200
+
+            started_at = time.perf_counter()
+            async for event in query_session.runner.run_async(
+                user_id=query_session.user_id,
+                session_id=query_session.session_id,
+                # Without a new message the runner answers the question an
+                # earlier attempt left in the session.
+                new_message=content if job_turn is None else None,
+                state_delta=new_message_state,
+            ):
+                if event.is_final_response():
+                    run_seconds = time.perf_counter() - started_at
+                    STAGE_SECONDS.observe(run_seconds, stage="llm")
+
+                    final_response = event.content.parts[0].text
+                    data = {
+                        "response": final_response,
+                    }
+                    logged_response = BODY_SAMPLER.sample(final_response)
+                    if logged_response is not None:
+                        logger.info(
+                            f"Final model's response: {logged_response}"
+                        )
+
+                    await store_cached_answer(
+                        cache_key,
+                        final_response,
+                        event.author,
+                        run_seconds,
+                    )
+                    answer = (final_response, event.author)
+
+                    return data, 200
+
+        finally:
+            if flight is not None:
+                await flight.finish(answer)
+
+        response = {"response": "No final response received from agent."}
+
+        logger.warning("Runner finished without a final response event.")
+        return response, 500
+
+    except Exception as e:
+        if raise_retryable and is_retryable_error(e):
+            raise
+
+        return await query_error_response(query_session, e)
+
+
+async def enqueue_query(request_data: dict[str, typing.Any]) -> str:
+    job_queue = await get_job_queue()
+
+    return await job_queue.enqueue(request_data)
+
+
+async def retrieve_job(job_id: str) -> dict[str, typing.Any] | None:
+    job_queue = await get_job_queue()
+
+    return await job_queue.retrieve(job_id)
+
+
+async def clear_user_session(request_user_id: str) -> int:
+    redis_client = await get_redis_client()
+    user_id_cache = await get_user_id_cache()
+    user_id_bytes = await retrieve_user_id(request_user_id, redis_client)
+    if user_id_bytes is None:
+        user_id_cache.pop(request_user_id, None)
+
+        return 204
+
+    user_id = user_id_bytes.decode("utf-8")
+
+    session_id = f"session://{user_id}"
+
+    app_name: str = config["APP_NAME"]
+    database_session_service = await get_database_session_service()
+
+    await pop_user_id(request_user_id, redis_client, user_id_cache)
+
+    await delete_session_async(
+        database_session_service,
+        app_name,
+        user_id,
+        session_id,
+    )
+
+    return 200
+
+
+async def save_rating(
+        request_data: dict[str, typing.Any] | None,
+) -> tuple[dict[str, str], int]:
+    if not request_data or "request_user_id" not in request_data or "rating" not in request_data:
+        logger.error(f"Invalid rating data: {request_data}")
+        return {"error": "Missing user_id or rating"}, 400
+
+    request_user_id = request_data["request_user_id"]
+    rating = str(request_data["rating"]).lower()
+
+    if not isinstance(request_user_id, int) or rating not in RATINGS:
+        logger.error(f"Invalid rating data: {request_data}")
+        return {"error": "Invalid user_id or rating"}, 400
+
+    logger.info(f"Received rating {rating} from user {request_user_id}")
+
+    try:
+        rating_buffer = await get_rating_buffer()
+        await rating_buffer.add(request_user_id, rating)
+
+        return {"message": "Rating saved"}, 200
+
+    except Exception as e:
+        logger.error(f"Database error saving rating: {e}")
+        import traceback
+        logger.error(traceback.format_exc())
+        return {"error": "Failed to save rating"}, 500
+
+
+async def retrieve_rating_percentages(
+) -> tuple[dict[str, typing.Any], int, str | None]:
+    """Return the response body, status code and ETag for the dashboard."""
+
+    try:
+        # Buffered ratings show up once their worker flushes them, within
+        # RATING_FLUSH_INTERVAL seconds.
+        db_pool = await get_db_pool()
+        results = await retrieve_rating_counts(db_pool)
+
+        counts_dict = {
+            "bad": 0,
+            "good": 0,
+            "excellent": 0
+        }
+        total_votes = 0
+
+        for row in results:
+            rating_name = row[0].lower()
+            count = row[1]
+            total_votes += count
+
+            if rating_name in counts_dict:
+                counts_dict[rating_name] = count
+
+        if total_votes == 0:
+            percentages_dict = {"bad": 0, "good": 0, "excellent": 0}
+        else:
+            percentages_dict = {
+                "bad": (
+                    round((counts_dict["bad"] / total_votes) * 100, 2)
+                ),
+                "good": (
+                    round((counts_dict["good"] / total_votes) * 100, 2)
+                ),
+                "excellent": (
+                    round((counts_dict["excellent"] / total_votes) * 100, 2)
+                )
+            }
+
+        etag = hashlib.sha1(
+            repr(sorted(counts_dict.items())).encode("utf-8"),
+        ).hexdigest()
+
+        return percentages_dict, 200, etag
+
+    except Exception as e:
+        logger.error(f"Database error getting ratings: {e}")
+        import traceback
+        logger.error(traceback.format_exc())
+        return {"error": "Failed to get ratings"}, 500, None
+
+
+async def retrieve_pool_stats() -> dict[str, typing.Any]:
+    database_session_service = await get_database_session_service()
+    stats = await retrieve_pool_stats_async(database_session_service)
+
+    max_connections = (
+        config.get("DB_POOL_SIZE", 5)
+        + config.get("DB_MAX_OVERFLOW", 10)
+    )
+    stats["max_connections"] = max_connections
+    stats["saturated"] = stats["checked_out"] >= max_connections
+
+    return stats
+
+
+async def retrieve_cache_stats() -> dict[str, typing.Any]:
+    retrieval_cache = await get_retrieval_cache()
+    answer_cache = await get_answer_cache()
+
+    return {
+        "worker": os.getpid(),
+        "retrieval": retrieval_cache.stats(),
+        "answers": answer_cache.stats(),
+    }
+
+
+async def purge_answer_cache(domain: str | None = None) -> int:
+    answer_cache = await get_answer_cache()
+    if domain is None:
+        return await answer_cache.purge()
+
+    return await answer_cache.purge_tag(domain)
+
+
+async def retrieve_metrics() -> str:
+    return await collect_metrics(await get_redis_client())
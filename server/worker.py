@@ -0,0 +1,264 @@
+import asyncio
+import json
+import os
+import signal
+import socket
+import time
+import typing
+
+import httpx
+import redis.asyncio as redis
+
+from helpers.job_queue import (
+    is_allowed_callback_url,
+    Job,
+    JobQueue,
+    sign_callback,
+)
+from helpers.log_helpers import set_request_id
+from helpers.metrics import error_type, STAGE_SECONDS, time_stage
+from services import (
+    get_job_queue,
+    JOB_CALLBACK_HOSTS,
+    JOB_TIMEOUT,
+    logger,
+    run_query,
+    setup_shared_resources,
+    teardown_shared_resources,
+)
+
+JOB_WORKER_CONCURRENCY = int(os.environ.get("JOB_WORKER_CONCURRENCY", 4))
+# Jobs still running this long after SIGTERM are left to another worker.
+JOB_SHUTDOWN_GRACE = float(os.environ.get("JOB_SHUTDOWN_GRACE", 30.0))
+JOB_CALLBACK_ATTEMPTS = int(os.environ.get("JOB_CALLBACK_ATTEMPTS", 3))
+JOB_CALLBACK_SECRET = os.environ.get("JOB_CALLBACK_SECRET")
+# The secret itself never leaves the worker; only this HMAC of the body
+# does.
+CALLBACK_SIGNATURE_HEADER = "X-Job-Callback-Signature"
+
+
+async def deliver_result(
+        http_client: httpx.AsyncClient,
+        job: Job,
+        result: dict[str, typing.Any],
+) -> None:
+    """
+    POST the result to the job's `callback_url`, if it has one. Clients
+    that get no callback can still poll /jobs/<job_id>.
+    """
+
+    callback_url = job.payload.get("callback_url")
+    if not callback_url:
+        return
+
+    # Checked by /query/ too, but the job may predate JOB_CALLBACK_HOSTS.
+    if not is_allowed_callback_url(callback_url, JOB_CALLBACK_HOSTS):
+        logger.error(
+            f"Callback URL of job {job.job_id} not allowed: {callback_url!r}"
+        )
+        return
+
+    body = json.dumps({
+        **result,
+        "job_id": job.job_id,
+        "user_id": job.payload.get("user_id"),
+        "message_id": job.payload.get("message_id"),
+    }).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    if JOB_CALLBACK_SECRET:
+        headers[CALLBACK_SIGNATURE_HEADER] = sign_callback(
+            JOB_CALLBACK_SECRET,
+            body,
+        )
+
+    for attempt in range(JOB_CALLBACK_ATTEMPTS):
+        try:
+            response = await http_client.post(
+                callback_url,
+                content=body,
+                headers=headers,
+            )
+            if response.status_code < 500:
+                if response.status_code >= 400:
+                    logger.warning(
+                        f"Callback for job {job.job_id} refused: "
+                        f"{response.status_code}"
+                    )
+
+                return
+
+        except httpx.HTTPError as e:
+            logger.warning(f"Callback for job {job.job_id} failed: {e}")
+
+        await asyncio.sleep(2 ** attempt)
+
+    logger.error(f"Could not deliver job {job.job_id} to {callback_url}")
+
+
+async def fail_job(
+        job_queue: JobQueue,
+        http_client: httpx.AsyncClient,
+        job: Job,
+        reason: str,
+) -> None:
+    result = {
+        "code": 500,
+        "response": {"response": "The query could not be answered."},
+    }
+    await job_queue.dead_letter(job, result, reason)
+    logger.error(f"Job {job.job_id} dead-lettered: {reason}")
+
+    await deliver_result(http_client, job, {"status": "failed", **result})
+
+
+async def process_job(
+        job_queue: JobQueue,
+        http_client: httpx.AsyncClient,
+        job: Job,
+) -> None:
+    set_request_id(job.job_id[:16])
+
+    attempt = await job_queue.begin(job)
+    if attempt is None:
+        # Finished, but the worker died before acknowledging it.
+        await job_queue.acknowledge(job)
+        job_record = await job_queue.retrieve(job.job_id)
+        if job_record is not None:
+            await deliver_result(http_client, job, job_record)
+
+        return
+
+    if attempt > job_queue.max_attempts:
+        # Only jobs whose workers died get here; failures are counted below.
+        await fail_job(
+            job_queue,
+            http_client,
+            job,
+            f"abandoned after {attempt - 1} attempts",
+        )
+        return
+
+    # The client's own deadline, counted from when the job was first
+    # enqueued; retries and reclaims do not extend it.
+    remaining = JOB_TIMEOUT
+    client_timeout = job.payload.get("timeout")
+    if client_timeout is not None:
+        remaining = job.enqueued_at + float(client_timeout) - time.time()
+        if remaining <= 0:
+            logger.warning(
+                f"Job {job.job_id} expired before attempt {attempt}"
+            )
+            await job_queue.expire(
+                job,
+                {
+                    "code": 504,
+                    "response": {"response": "The query timed out."},
+                },
+            )
+            return
+
+    STAGE_SECONDS.observe(time.time() - job.enqueued_at, stage="job.wait")
+    try:
+        with time_stage("job.run"):
+            response, code = await asyncio.wait_for(
+                run_query(
+                    job.payload,
+                    job_id=job.job_id,
+                    # The last attempt answers with the error instead.
+                    raise_retryable=attempt < job_queue.max_attempts,
+                ),
+                min(JOB_TIMEOUT, remaining),
+            )
+
+    except Exception as e:
+        logger.error(f"Job {job.job_id} attempt {attempt} failed: {e}")
+        if attempt >= job_queue.max_attempts:
+            await fail_job(job_queue, http_client, job, error_type(e))
+        else:
+            await job_queue.retry(job)
+
+        return
+
+    result = {"code": code, "response": response}
+    await job_queue.complete(job, result)
+
+    await deliver_result(http_client, job, {"status": "done", **result})
+
+
+async def consume(
+        job_queue: JobQueue,
+        http_client: httpx.AsyncClient,
+        consumer: str,
+        stopped: asyncio.Event,
+) -> None:
+    while not stopped.is_set():
+        try:
+            jobs = await job_queue.read(consumer)
+
+        except redis.RedisError as e:
+            logger.error(f"Could not read jobs: {e}")
+            await asyncio.sleep(1.0)
+
+            continue
+
+        for job in jobs:
+            try:
+                await process_job(job_queue, http_client, job)
+
+            except Exception as e:
+                # Left pending, so another consumer claims it later.
+                logger.exception(f"Job {job.job_id} interrupted: {e}")
+
+
+async def main() -> None:
+    """
+    Answer the queries /query/ enqueued while JOB_QUEUE_ENABLED is on,
+    JOB_WORKER_CONCURRENCY at a time. Run as many of these processes as
+    answer capacity needs; they share the stream's consumer group.
+    """
+
+    await setup_shared_resources()
+
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signal_number, stopped.set)
+
+    try:
+        job_queue = await get_job_queue()
+        await job_queue.ensure_group()
+
+        consumer_prefix = f"{socket.gethostname()}-{os.getpid()}"
+        async with httpx.AsyncClient(
+                timeout=httpx.Timeout(timeout=10.0, connect=3.0),
+        ) as http_client:
+            consumers = [
+                asyncio.create_task(
+                    consume(
+                        job_queue,
+                        http_client,
+                        f"{consumer_prefix}-{n}",
+                        stopped,
+                    ),
+                )
+                for n in range(JOB_WORKER_CONCURRENCY)
+            ]
+            logger.info(f"Job worker started with {len(consumers)} consumers")
+
+            await stopped.wait()
+
+            _, running = await asyncio.wait(
+                consumers,
+                timeout=JOB_SHUTDOWN_GRACE,
+            )
+            for consumer in running:
+                consumer.cancel()
+
+            await asyncio.gather(*consumers, return_exceptions=True)
+
+    finally:
+        await teardown_shared_resources()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,409 +1,197 @@
-import os
-import logging
-import psycopg2
+import atexit
+import json
+import time
+import typing
 
-from dotenv import load_dotenv
 from flask import (
     current_app,
     Flask,
+    g,
     jsonify,
     request,
     Response,
 )
-from google.genai import types
-
-from google.adk.agents import LlmAgent
-from google.genai import errors as google_exceptions
-
-from agents.legal_dispatcher.agent import (
-    create_root_agent_async,
-    create_runner_async,
-    create_session_async,
-    delete_session_async,
-    instantiate_database_session_service,
-    retrieve_session_async,
-)
-from helpers.context_helpers import (
-    ContextKey,
-    get_context_var,
-    set_context_var,
-)
-from helpers.db_helpers import (
-    get_db_connection_sync,
-    save_rating_sync,
-)
-from helpers.sessions import (
-    instantiate_redis_client,
-    pop_user_id,
-    retrieve_user_id,
-    set_user_id,
-)
-
-from helpers.rag import instantiate_rag_object, retrieve_chunks
 
-entrypoint = os.path.abspath(os.path.dirname(__file__))
-logger = logging.getLogger("server_logs")
-logger.setLevel(logging.INFO)
+from helpers.log_helpers import set_request_id
+from helpers.loop_helpers import iterate_async_sync, run_coroutine_sync
+from helpers.metrics import REQUEST_SECONDS, REQUESTS
+from services import (
+    BODY_SAMPLER,
+    clear_user_session,
+    config,
+    enqueue_query,
+    JOB_QUEUE_ENABLED,
+    logger,
+    RATINGS_CACHE_MAX_AGE,
+    retrieve_cache_stats,
+    retrieve_job,
+    retrieve_metrics,
+    retrieve_pool_stats,
+    retrieve_rating_percentages,
+    run_query,
+    save_rating,
+    setup_shared_resources,
+    stream_query_events,
+    teardown_shared_resources,
+    validate_callback_url,
+    validate_query_request,
+)
 
-server_logs_path = os.path.join(entrypoint, "server_logs.log")
-file_handler = logging.FileHandler(server_logs_path)
-file_handler.setLevel(logging.INFO)
 
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+class LegalAssistantFlask(Flask):
+    # Flask runs every async view in a brand new event loop by default, which
+    # makes loop-bound clients (e.g. the Redis pool) unusable across requests.
+    # Views are run on one long-lived loop per worker instead.
+    def async_to_sync(
+            self,
+            func: typing.Callable[..., typing.Coroutine],
+    ) -> typing.Callable[..., typing.Any]:
+        def wrapper(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
+            return run_coroutine_sync(func(*args, **kwargs))
 
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+        return wrapper
 
-logger.addHandler(file_handler)
 
-load_dotenv()
+app = LegalAssistantFlask(__name__)
+app.config.update(config)
 
-app = Flask(__name__)
-app.config.from_prefixed_env()
 
-AGENT_KEY = ContextKey[LlmAgent]("agent")
+@app.before_request
+def start_request_timer() -> None:
+    g.request_started_at = time.perf_counter()
+    # Async views run with a copy of this context, so they log the same id.
+    g.request_id = set_request_id(
+        request.headers.get("X-Request-ID", "")[:64] or None,
+    )
 
 
-def _get_db_connection():
-    # TODO: host is not on the environment
-    return psycopg2.connect(
-        host="postgres",
-        database=os.environ["POSTGRES_DB"],
-        user=os.environ["POSTGRES_USER"],
-        password=os.environ["POSTGRES_PASSWORD"],
-        port=5432
+@app.after_request
+def record_request_metrics(response: Response) -> Response:
+    # Streamed answers are timed until the view returns, not until the last
+    # event is sent; the per-stage "llm" metric covers the full generation.
+    endpoint = request.url_rule.rule if request.url_rule else "other"
+    REQUEST_SECONDS.observe(
+        time.perf_counter() - g.request_started_at,
+        endpoint=endpoint,
     )
-    # TODO: port is not too
+    REQUESTS.inc(endpoint=endpoint, status=str(response.status_code))
+    response.headers["X-Request-ID"] = g.request_id
+
+    return response
 
 
 @app.post("/query/")
 async def query() -> tuple[Response, int]:
     request_data = request.get_json()
-    if not request_data:
-        logger.error("Missing request data.")
-
+    if not validate_query_request(request_data):
         return jsonify({"response": "Missing request data."}), 400
 
-    if "query" not in request_data:
-        logger.error("Missing 'query' in request data")
-        logger.error(f"Request data: {request_data}")
+    if not validate_callback_url(request_data):
+        return jsonify({"response": "Callback URL not allowed."}), 400
 
-        return jsonify({"response": "Missing request data."}), 400
+    logged_query = BODY_SAMPLER.sample(request_data["query"])
+    if logged_query is not None:
+        logger.info(f"Received query: {logged_query}")
 
-    if not request_data or "username" not in request_data or "user_id" not in request_data:
-        logger.error("Missing request data")
-        logger.error(f"Request data: {request_data}")
+    if JOB_QUEUE_ENABLED:
+        job_id = await enqueue_query(request_data)
 
-        return jsonify({"response": "Missing request data."}), 400
+        return jsonify({"job_id": job_id, "status": "queued"}), 202
 
-    logger.info(f"Received query: {request_data['query']}")
+    response, status = await run_query(request_data)
 
-    request_username = request_data["username"]
-    request_user_id = request_data["user_id"]
+    return jsonify(response), status
 
-    # TODO: put these arguments into the environment
-    redis_host = os.environ["REDIS_HOST"]
-    redis_port = os.environ["REDIS_PORT"]
 
-    redis_client = await instantiate_redis_client(redis_host, int(redis_port))
-    user_id_bytes = await retrieve_user_id(request_user_id, redis_client)
-    if user_id_bytes is None:
-        user_id_bytes = await set_user_id(
-            request_user_id,
-            request_username,
-            redis_client,
-        )
+@app.get("/jobs/<job_id>")
+async def job_status(job_id: str) -> tuple[Response, int]:
+    job = await retrieve_job(job_id)
+    if job is None:
+        return jsonify({"response": "Job not found."}), 404
 
-    user_id = user_id_bytes.decode("utf-8")
-    if user_id.startswith("b'") and user_id.endswith("'"):
-        user_id = user_id[2:-1]
+    return jsonify(job), 200
 
-    session_id = f"session://{user_id}"
 
-    db_url: str = current_app.config["DB_URL"]
-    app_name: str = current_app.config["APP_NAME"]
-    database_session_service = await instantiate_database_session_service(
-        db_url,
-    )
-
-    session = await retrieve_session_async(
-        database_session_service,
-        app_name,
-        user_id,
-        session_id,
-    )
-    if session is None:
-        session = await create_session_async(
-            database_session_service,
-            app_name,
-            user_id,
-            session_id,
-        )
-
-    agent: LlmAgent | None = await get_context_var(AGENT_KEY)
-    if agent is None:
-        _agent = await create_root_agent_async()
-        await set_context_var(AGENT_KEY, _agent)
-
-        agent = _agent
-
-    runner = await create_runner_async(
-        app_name=app_name,
-        session_service=database_session_service,
-        agent=agent,
-    )
-    logger.info("Runner created")
-
-    try:
-        ragflow_api_key = os.environ["RAGFLOW_API_KEY"]
-        ragflow_base_url = os.environ["RAGFLOW_BASE_URL"]
-        law_dataset_name = os.environ["LAW_DATASET_NAME"]
-
-        prompt_template = (
-            "{user_query}\n\n"
-            "Please, use the provided context below to provide "
-            "a better response to the user.\n\n"
-            "{chunks}"
-        )
-
-        user_query = request_data["query"]
-
-        rag_object = await instantiate_rag_object(
-            api_key=ragflow_api_key,
-            base_url=ragflow_base_url,
-        )
-        chunks = await retrieve_chunks(
-            law_dataset_name,
-            user_query,
-            rag_object,
-        )
-
-        formatted_chunks = ""
-        for i, chunk in enumerate(chunks):
-            formatted_text = f"Chunk #{i+1}\n{chunk.content}\n\n"
-            formatted_chunks += formatted_text
-
-        final_prompt = prompt_template.format(
-            user_query=user_query,
-            chunks=formatted_chunks,
-        )
-
-        content = types.Content(
-            role="user",
-            parts=[types.Part(text=final_prompt)]
-        )
-        logger.info(f"Final prompt:\n{final_prompt}")
-
-        async for event in runner.run_async(
-            user_id=user_id,
-            session_id=session_id,
-            new_message=content,
-        ):
-            if event.is_final_response():
-                final_response = event.content.parts[0].text
-                data = {
-                    "response": final_response,
-                }
-                logger.info(f"Final model's response: {final_response}")
-
-                return jsonify(data), 200
-
-        response = {"response": "No final response received from agent."}
-
-        logger.warning("Runner finished without a final response event.")
-        return jsonify(response), 500
-
-    # TODO: invest in better error handling
-    except google_exceptions.ServerError:
-        import traceback
-
-        response = {
-            "response": "Internal Server Error",
-        }
-        logger.error(traceback.format_exc())
-
-        return jsonify(response), 500
-
-    except google_exceptions.ClientError as e:
-        import traceback
-
-        response = {
-            "response": "Client error."
-        }
-
-        # TODO: this should try again
-        if e.code == 400:
-            response = {
-                "response": "The request was invalid."
-            }
-
-            await pop_user_id(user_id, redis_client)
-
-            await delete_session_async(
-                database_session_service,
-                app_name,
-                user_id,
-                session_id,
-            )
-
-        # TODO: this should clean session and try again
-        elif e.code == 429:
-            response = {
-                "response": "Limit quota exceeded",
-            }
-
-            await pop_user_id(user_id, redis_client)
+@app.post("/query/stream/")
+async def query_stream() -> Response | tuple[Response, int]:
+    """
+    Same as `/query/`, but answers with newline-delimited JSON events:
+    `delta` events carry text as the model produces it and a last `final`
+    (or `error`) event carries the complete response.
+    """
 
-            await delete_session_async(
-                database_session_service,
-                app_name,
-                user_id,
-                session_id,
-            )
+    request_data = request.get_json()
+    if not validate_query_request(request_data):
+        return jsonify({"response": "Missing request data."}), 400
 
-        logger.error(traceback.format_exc())
+    logged_query = BODY_SAMPLER.sample(request_data["query"])
+    if logged_query is not None:
+        logger.info(f"Received streaming query: {logged_query}")
 
-        return jsonify(response), 429
+    events = iterate_async_sync(stream_query_events(request_data))
 
-    except Exception as e:
-        import traceback
+    def _generate() -> typing.Iterator[str]:
+        for event in events:
+            yield json.dumps(event, ensure_ascii=False) + "\n"
 
-        # Catch-all for unexpected errors to ensure a tuple is always returned
-        logger.error(f"Unexpected error: {e}")
-        logger.error(traceback.format_exc())
-        return jsonify({"response": f"An unexpected error occurred: {e}"}), 500
+    return Response(
+        _generate(),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.delete("/clear/")
 async def clear_session():
     request_user_id = request.args.get("user_id")
 
-    redis_host = os.environ["REDIS_HOST"]
-    redis_port = os.environ["REDIS_PORT"]
+    status = await clear_user_session(request_user_id)
 
-    redis_client = await instantiate_redis_client(redis_host, int(redis_port))
-    user_id_bytes = await retrieve_user_id(request_user_id, redis_client)
-    if user_id_bytes is None:
-        return jsonify(), 204
+    return jsonify(), status
 
-    user_id = user_id_bytes.decode("utf-8")
-    if user_id.startswith("b'") and user_id.endswith("'"):
-        user_id = user_id[2:-1]
 
-    session_id = f"session://{user_id}"
-
-    db_url: str = current_app.config["DB_URL"]
-    app_name: str = current_app.config["APP_NAME"]
-    database_session_service = await instantiate_database_session_service(
-        db_url,
-    )
+@app.post("/rate/")
+async def rate_interaction():
+    request_data = request.get_json()
 
-    await pop_user_id(request_user_id, redis_client)
+    response, status = await save_rating(request_data)
 
-    await delete_session_async(
-        database_session_service,
-        app_name,
-        user_id,
-        session_id,
-    )
+    return jsonify(response), status
 
-    return jsonify(), 200
 
+@app.get("/api/get-ratings")
+async def get_ratings():
+    percentages, status, etag = await retrieve_rating_percentages()
+    if etag is None:
+        return jsonify(percentages), status
 
-@app.post("/rate/")
-async def rate_interaction():
-    request_data = request.get_json()
+    response = jsonify(percentages)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = RATINGS_CACHE_MAX_AGE
 
-    if not request_data or "request_user_id" not in request_data or "rating" not in request_data:
-        logger.error(f"Invalid rating data: {request_data}")
-        return jsonify({"error": "Missing user_id or rating"}), 400
+    return response.make_conditional(request)
 
-    request_user_id = request_data["request_user_id"]
-    rating = request_data["rating"]
 
-    logger.info(f"Received rating {rating} from user {request_user_id}")
+@app.get("/stats/pool/")
+async def pool_stats():
+    stats = await retrieve_pool_stats()
 
-    upsert_query = """
-    INSERT INTO users_rate_tb (request_user_id, rating)
-    VALUES (%s, %s)
-    ON CONFLICT (request_user_id)
-    DO UPDATE SET
-        rating = EXCLUDED.rating,
-        updated_at = CURRENT_TIMESTAMP;
-    """
+    return jsonify(stats), 200
 
-    try:
-        with _get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(upsert_query, (request_user_id, rating))
-            conn.commit()
 
-        return jsonify({"message": "Rating saved"}), 200
+@app.get("/stats/cache/")
+async def cache_stats():
+    stats = await retrieve_cache_stats()
 
-    except Exception as e:
-        logger.error(f"Database error saving rating: {e}")
-        import traceback
-        logger.error(traceback.format_exc())
-        return jsonify({"error": "Failed to save rating"}), 500
+    return jsonify(stats), 200
 
 
-@app.get("/api/get-ratings")
-async def get_ratings():
-    query = """
-    SELECT
-        rating, COUNT(rating)
-    FROM
-        users_rate_tb
-    GROUP BY
-        rating;
-    """
+@app.get("/metrics")
+async def metrics():
+    body = await retrieve_metrics()
 
-    try:
-        with _get_db_connection() as conn:
-            if conn is None:
-                raise Exception("Database connection failed")
-
-            with conn.cursor() as cur:
-                cur.execute(query)
-                results = cur.fetchall()
-
-        counts_dict = {
-            "bad": 0,
-            "good": 0,
-            "excellent": 0
-        }
-        total_votes = 0
-
-        for row in results:
-            rating_name = row[0].lower()
-            count = row[1]
-            total_votes += count
-
-            if rating_name in counts_dict:
-                counts_dict[rating_name] = count
-
-        if total_votes == 0:
-            percentages_dict = {"bad": 0, "good": 0, "excellent": 0}
-        else:
-            percentages_dict = {
-                "bad": (
-                    round((counts_dict["bad"] / total_votes) * 100, 2)
-                ),
-                "good": (
-                    round((counts_dict["good"] / total_votes) * 100, 2)
-                ),
-                "excellent": (
-                    round((counts_dict["excellent"] / total_votes) * 100, 2)
-                )
-            }
-
-        return jsonify(percentages_dict), 200
-
-    except Exception as e:
-        logger.error(f"Database error getting ratings: {e}")
-        import traceback
-        logger.error(traceback.format_exc())
-        return jsonify({"error": "Failed to get ratings"}), 500
+    return Response(body, mimetype="text/plain; version=0.0.4")
 
 
 @app.get("/healthcheck/")
@@ -411,6 +199,12 @@ async def healthcheck():
     return jsonify({"status": "ok"}), 200
 
 
+# Gunicorn imports this module once per worker, so each worker builds its
+# shared resources here instead of on every request.
+run_coroutine_sync(setup_shared_resources())
+atexit.register(lambda: run_coroutine_sync(teardown_shared_resources()))
+
+
 if __name__ == "__main__":
     with app.app_context():
         logger.info("Starting the server...")
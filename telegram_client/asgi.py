@@ -1,13 +1,19 @@
 import asyncio
+import functools
+import json
 import logging
 import os
+import socket
 import sys
 
 import httpx
 
 from aiogram import Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command, CommandStart
 from aiogram.utils.chat_action import ChatActionSender
 from aiogram.types import (
@@ -20,9 +26,31 @@ from aiogram.types import (
 
 from dotenv import load_dotenv
 
+from chat_queue import ChatQueue, ReleaseSlot, merge_messages
+from jobs import JobWaiter
+from webhook import WebhookServer
+
 load_dotenv()
 
 TOKEN = os.environ["BOT_TOKEN"]
+# "polling" for development, "webhook" behind nginx in production.
+BOT_MODE = os.environ.get("BOT_MODE", "polling").lower()
+# Points the bot at another Bot API server, e.g. fake_telegram.py.
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+
+QUERY_STREAMING = os.environ.get("QUERY_STREAMING", "false").lower() == "true"
+# Telegram rate-limits message edits, so partial answers are flushed at most
+# once per interval.
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", 1.5))
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Queries all chats may run against the server at once; later ones wait.
+MAX_CONCURRENT_QUERIES = int(os.environ.get("MAX_CONCURRENT_QUERIES", 20))
+# Messages a chat sends within this many seconds of each other are asked as
+# one query. 0 answers every message on its own, still one at a time.
+MESSAGE_MERGE_WINDOW = float(os.environ.get("MESSAGE_MERGE_WINDOW", 0))
+# Where the server's job workers POST answers to queued queries.
+JOB_CALLBACK_PORT = int(os.environ.get("JOB_CALLBACK_PORT", 0))
+QUEUED_MESSAGE = "⏳ Na fila... responderei assim que possível."
 
 dp = Dispatcher()
 
@@ -46,47 +74,36 @@ async def command_start_handler(message: Message) -> None:
 
 
 @dp.message(Command("clear"))
-async def command_clear_handler(message: Message) -> None:
+async def command_clear_handler(
+        message: Message,
+        http_client: httpx.AsyncClient,
+) -> None:
     """
     This handler receives messages `/clear` command
     """
-    server_host = os.environ["SERVER_HOST"]
-    server_url = f"{server_host}/clear/"
-
-    httpx_headers = httpx.Headers(
-        headers={
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        }
-    )
-    httpx_timeout = httpx.Timeout(timeout=200.0, connect=5.0)
     async with ChatActionSender.typing(bot=message.bot, chat_id=message.chat.id):
-        async with httpx.AsyncClient(
-            headers=httpx_headers,
-            timeout=httpx_timeout,
-        ) as httpx_async_client:
-            request_user_user_id = message.chat.id
+        request_user_user_id = message.chat.id
 
-            params = {
-                "user_id": request_user_user_id,
-            }
-
-            try:
-                response: httpx.Response = await httpx_async_client.delete(
-                    server_url,
-                    params=params,
-                )
-                if response.status_code == 200:
-                    await message.answer(
-                        "Sessão limpa! 🧹\nPodemos começar de novo.",
-                    )
-                elif response.status_code == 204:
-                    await message.answer("Sessão inexistente. Nada a fazer.")
+        params = {
+            "user_id": request_user_user_id,
+        }
 
-            except httpx.ConnectError:
+        try:
+            response: httpx.Response = await http_client.delete(
+                "/clear/",
+                params=params,
+            )
+            if response.status_code == 200:
                 await message.answer(
-                    "Não consegui me conectar ao servidor para limpar a sessão.",
+                    "Sessão limpa! 🧹\nPodemos começar de novo.",
                 )
+            elif response.status_code == 204:
+                await message.answer("Sessão inexistente. Nada a fazer.")
+
+        except httpx.ConnectError:
+            await message.answer(
+                "Não consegui me conectar ao servidor para limpar a sessão.",
+            )
 
 
 @dp.message(Command("rate"))
@@ -120,7 +137,10 @@ async def show_rate(message: Message):
 
 
 @dp.callback_query(F.data.startswith("rate_"))
-async def process_rating(callback: CallbackQuery):
+async def process_rating(
+        callback: CallbackQuery,
+        http_client: httpx.AsyncClient,
+):
     rating_key = callback.data.split("_")[1]
     rating_map = {
         "bad": "Ruim",
@@ -132,41 +152,37 @@ async def process_rating(callback: CallbackQuery):
 
     request_user_id = callback.from_user.id
 
-    server_host = os.environ["SERVER_HOST"]
-    server_url = f"{server_host}/rate/"
-
     payload = {
         "request_user_id": request_user_id,
         "rating": rating_key,
     }
-    async with httpx.AsyncClient() as client:
-        try:
-            await callback.answer("Salvando...")
-
-            response = await client.post(
-                server_url,
-                json=payload,
-                timeout=10.0,
-            )
+    try:
+        await callback.answer("Salvando...")
 
-            if response.status_code == 200:
-                await callback.message.edit_text(
-                    f"Obrigado! Nota <b>{rating_value}</b> registrada.",
-                    reply_markup=None,
-                )
+        response = await http_client.post(
+            "/rate/",
+            json=payload,
+            timeout=10.0,
+        )
 
-            else:
-                print(f"Server Error: {response.text}")
-                await callback.message.edit_text(
-                    "Erro ao salvar avaliação no servidor.",
-                )
+        if response.status_code == 200:
+            await callback.message.edit_text(
+                f"Obrigado! Nota <b>{rating_value}</b> registrada.",
+                reply_markup=None,
+            )
 
-        except httpx.RequestError as e:
-            print(f"Connection Error: {e}")
+        else:
+            print(f"Server Error: {response.text}")
             await callback.message.edit_text(
-                "Erro de conexão ao salvar avaliação.",
+                "Erro ao salvar avaliação no servidor.",
             )
 
+    except httpx.RequestError as e:
+        print(f"Connection Error: {e}")
+        await callback.message.edit_text(
+            "Erro de conexão ao salvar avaliação.",
+        )
+
 
 @dp.callback_query(F.data == "close_menu")
 async def close_menu(callback: CallbackQuery):
@@ -174,16 +190,200 @@ async def close_menu(callback: CallbackQuery):
     await callback.message.delete()
 
 
+async def _edit_answer(
+        message: Message,
+        text: str,
+        parse_mode: str | None = None,
+) -> None:
+    try:
+        await message.edit_text(
+            text[:TELEGRAM_MESSAGE_LIMIT],
+            parse_mode=parse_mode,
+        )
+
+    except TelegramBadRequest as e:
+        # Raised for unchanged text and for HTML the model got wrong.
+        if "message is not modified" in str(e):
+            return
+
+        if parse_mode is not None:
+            await _edit_answer(message, text, parse_mode=None)
+            return
+
+        raise
+
+
+async def _send_final_answer(
+        message: Message,
+        placeholder: Message,
+        text: str,
+) -> None:
+    await _edit_answer(placeholder, text, parse_mode=ParseMode.HTML)
+
+    limit = TELEGRAM_MESSAGE_LIMIT
+    for start in range(limit, len(text), limit):
+        await message.answer(text[start:start + limit], parse_mode=None)
+
+
+async def _stream_answer(
+        message: Message,
+        http_client: httpx.AsyncClient,
+        server_url: str,
+        data: dict,
+) -> None:
+    placeholder = await message.answer("✍️ ...", parse_mode=None)
+
+    loop = asyncio.get_running_loop()
+    partial_text = ""
+    shown_text = ""
+    last_edit_at = 0.0
+
+    async with http_client.stream(
+        "POST",
+        server_url,
+        json=data,
+    ) as response:
+        response.raise_for_status()
+
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+
+            event = json.loads(line)
+            if event["type"] == "delta":
+                partial_text += event["text"]
+
+                now = loop.time()
+                if (
+                    now - last_edit_at >= STREAM_EDIT_INTERVAL
+                    and partial_text.strip()
+                    and partial_text != shown_text
+                ):
+                    # Partial text may contain unbalanced HTML tags.
+                    await _edit_answer(placeholder, partial_text)
+
+                    shown_text = partial_text
+                    last_edit_at = now
+
+            elif event["type"] == "final":
+                await _send_final_answer(
+                    message,
+                    placeholder,
+                    event["response"],
+                )
+                return
+
+            else:
+                logging.error(f"Error processing query: {event}")
+                await _edit_answer(
+                    placeholder,
+                    "Ocorreu um erro ao processar sua mensagem.",
+                )
+                return
+
+    await _edit_answer(
+        placeholder,
+        "Ocorreu um erro ao processar sua mensagem.",
+    )
+
+
+async def answer_question(
+        messages: list[Message],
+        release_slot: ReleaseSlot,
+        http_client: httpx.AsyncClient,
+        job_waiter: JobWaiter,
+) -> None:
+    """
+    Make a HTTP request to the server where the agent is hosted in and
+    send the response back to the client. Messages merged by the chat
+    queue are asked as one query, answered in reply to the last of them.
+    The chat queue's slot is released once a query is queued on the
+    server, while its answer is still awaited.
+    """
+
+    message = messages[-1]
+
+    async with ChatActionSender.typing(bot=message.bot, chat_id=message.chat.id):
+        request_user_username = (
+            message.chat.first_name or message.chat.username
+        )
+        request_user_user_id = message.chat.id
+
+        data = {
+            "query": merge_messages(messages),
+            "username": request_user_username,
+            "user_id": request_user_user_id,
+        }
+
+        try:
+            if QUERY_STREAMING:
+                await _stream_answer(
+                    message,
+                    http_client,
+                    "/query/stream/",
+                    data,
+                )
+                return
+
+            # Workers drop the job once the bot has stopped waiting for it.
+            data["timeout"] = job_waiter.timeout
+            if job_waiter.callback_url:
+                data["callback_url"] = job_waiter.callback_url
+                data["message_id"] = message.message_id
+
+            response: httpx.Response = await http_client.post(
+                "/query/",
+                json=data
+            )
+            response.raise_for_status() # Raise exception for 4xx/5xx
+            response_json = response.json()
+
+            if response.status_code == 202:
+                # Queued: a server worker answers it in the background.
+                release_slot()
+                result = await job_waiter.wait(response_json["job_id"])
+                if result["code"] != 200:
+                    logging.error(f"Error processing query: {result}")
+                    await message.answer(
+                        "Ocorreu um erro ao processar sua mensagem.",
+                    )
+                    return
+
+                response_json = result["response"]
+
+            await message.answer(response_json["response"])
+
+        except httpx.ConnectError:
+            await message.answer("Erro: Não consegui conectar ao servidor.")
+        except Exception as e:
+            logging.error(f"Error processing query: {e}")
+            await message.answer("Ocorreu um erro ao processar sua mensagem.")
+
+
+async def notify_queued(message: Message) -> None:
+    await message.answer(QUEUED_MESSAGE, parse_mode=None)
+
+
 @dp.message()
-async def question_handler(message: Message) -> None:
+async def question_handler(
+        message: Message,
+        chat_queue: ChatQueue,
+) -> None:
     """
-    Handler will receive the user question and make a HTTP
-    request to the server where the agent is hosted in
-    and send back to the client the response.
+    Handler will receive the user question and queue it behind the
+    chat's earlier questions, which are answered one at a time.
     """
 
-    server_host = os.environ["SERVER_HOST"]
-    server_url = f"{server_host}/query/"
+    # Queued before any await, so messages keep the order they arrived in.
+    if chat_queue.submit(message):
+        await chat_queue.notify(message)
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """
+    Build the client shared by every handler, so Telegram updates reuse
+    keep-alive connections to the server instead of opening new ones.
+    """
 
     httpx_headers = httpx.Headers(
         headers={
@@ -192,42 +392,126 @@ async def question_handler(message: Message) -> None:
         }
     )
     httpx_timeout = httpx.Timeout(timeout=200.0, connect=5.0)
-    async with ChatActionSender.typing(bot=message.bot, chat_id=message.chat.id):
-        async with httpx.AsyncClient(
+    httpx_limits = httpx.Limits(
+        max_connections=int(os.environ.get("HTTP_MAX_CONNECTIONS", 100)),
+        max_keepalive_connections=int(
+            os.environ.get("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20),
+        ),
+        keepalive_expiry=float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", 30.0)),
+    )
+    http2 = os.environ.get("HTTP_HTTP2", "false").lower() == "true"
+
+    try:
+        return httpx.AsyncClient(
+            base_url=os.environ["SERVER_HOST"],
             headers=httpx_headers,
             timeout=httpx_timeout,
-        ) as httpx_async_client:
-            request_user_username = (
-                message.chat.first_name or message.chat.username
-            )
-            request_user_user_id = message.chat.id
-
-            data = {
-                "query": message.text,
-                "username": request_user_username,
-                "user_id": request_user_user_id,
-            }
-
-            try:
-                response: httpx.Response = await httpx_async_client.post(
-                    server_url,
-                    json=data
-                )
-                response.raise_for_status() # Raise exception for 4xx/5xx
-                response_json = response.json()
+            limits=httpx_limits,
+            http2=http2,
+        )
+
+    except ImportError:
+        logging.warning("HTTP/2 requires the 'h2' package, using HTTP/1.1.")
+
+        return httpx.AsyncClient(
+            base_url=os.environ["SERVER_HOST"],
+            headers=httpx_headers,
+            timeout=httpx_timeout,
+            limits=httpx_limits,
+        )
+
+
+def create_job_waiter(http_client: httpx.AsyncClient) -> JobWaiter:
+    """
+    With JOB_CALLBACK_PORT set, the server's workers POST answers to this
+    process; otherwise queued queries are polled for. Unless JOB_DEADLINE
+    says otherwise, a query is waited for long enough to sit in the queue
+    for JOB_QUEUE_WAIT seconds, use up all JOB_MAX_ATTEMPTS attempts and be
+    reclaimed once from a worker that died.
+    """
+
+    job_timeout = float(os.environ.get("JOB_TIMEOUT", 300.0))
+    deadline = (
+        float(os.environ.get("JOB_QUEUE_WAIT", 60.0))
+        + int(os.environ.get("JOB_MAX_ATTEMPTS", 3)) * job_timeout
+        + float(os.environ.get("JOB_CLAIM_IDLE", job_timeout + 30.0))
+    )
 
-                await message.answer(response_json["response"])
+    callback_url = os.environ.get("JOB_CALLBACK_URL")
+    if callback_url is None and JOB_CALLBACK_PORT:
+        callback_url = (
+            f"http://{socket.gethostname()}:{JOB_CALLBACK_PORT}/jobs/callback"
+        )
+
+    # The callback port is reachable by anything on the network, and the
+    # shared secret is what keeps others from answering users' questions.
+    secret = os.environ.get("JOB_CALLBACK_SECRET")
+    if JOB_CALLBACK_PORT and not secret:
+        raise RuntimeError("JOB_CALLBACK_PORT requires JOB_CALLBACK_SECRET")
+
+    return JobWaiter(
+        http_client,
+        callback_url=callback_url,
+        secret=secret,
+        timeout=float(os.environ.get("JOB_DEADLINE", deadline)),
+        poll_interval=float(os.environ.get("JOB_POLL_INTERVAL", 2.0)),
+    )
 
-            except httpx.ConnectError:
-                await message.answer("Erro: Não consegui conectar ao servidor.")
-            except Exception as e:
-                logging.error(f"Error processing query: {e}")
-                await message.answer("Ocorreu um erro ao processar sua mensagem.")
+
+async def run_webhook(bot: Bot, **handler_kwargs) -> None:
+    port = int(os.environ.get("WEBHOOK_PORT", 8080))
+    path = os.environ.get("WEBHOOK_PATH", "/telegram/webhook")
+    # Telegram sends it with every update, and replicas with every update
+    # they pass on; without it anyone could post updates to the bot.
+    secret = os.environ.get("WEBHOOK_SECRET")
+    if not secret:
+        raise RuntimeError("BOT_MODE=webhook requires WEBHOOK_SECRET")
+
+    replicas = [
+        replica.strip().rstrip("/")
+        for replica in os.environ.get("WEBHOOK_REPLICAS", "").split(",")
+        if replica.strip()
+    ]
+    replica = os.environ.get(
+        "WEBHOOK_REPLICA",
+        f"http://{socket.gethostname()}:{port}",
+    )
+
+    webhook_url = os.environ.get("WEBHOOK_URL")
+    if webhook_url:
+        # Every replica registers the same URL, so any of them can start
+        # first.
+        await bot.set_webhook(
+            webhook_url.rstrip("/") + path,
+            secret_token=secret,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=int(
+                os.environ.get("WEBHOOK_MAX_CONNECTIONS", 40),
+            ),
+        )
+
+    server = WebhookServer(
+        dp,
+        bot,
+        secret,
+        path=path,
+        replicas=replicas,
+        replica=replica,
+        **handler_kwargs,
+    )
+    await server.run(os.environ.get("WEBHOOK_HOST", "0.0.0.0"), port)
 
 
 async def main_async() -> None:
+    session = None
+    if TELEGRAM_API_URL:
+        session = AiohttpSession(
+            api=TelegramAPIServer.from_base(TELEGRAM_API_URL),
+        )
+
     bot = Bot(
         token=TOKEN,
+        session=session,
         default=DefaultBotProperties(parse_mode=ParseMode.HTML)
     )
 
@@ -244,7 +528,48 @@ async def main_async() -> None:
 
     await bot.set_my_commands(commands)
 
-    await dp.start_polling(bot)
+    http_client = create_http_client()
+    job_waiter = create_job_waiter(http_client)
+    chat_queue = ChatQueue(
+        functools.partial(
+            answer_question,
+            http_client=http_client,
+            job_waiter=job_waiter,
+        ),
+        notify_queued,
+        max_concurrent=MAX_CONCURRENT_QUERIES,
+        merge_window=MESSAGE_MERGE_WINDOW,
+    )
+    callback_runner = None
+    try:
+        if JOB_CALLBACK_PORT:
+            callback_runner = await job_waiter.serve(
+                "0.0.0.0",
+                JOB_CALLBACK_PORT,
+            )
+
+        # Injected into every handler that declares an `http_client` or
+        # `chat_queue` argument.
+        if BOT_MODE == "webhook":
+            await run_webhook(
+                bot,
+                http_client=http_client,
+                chat_queue=chat_queue,
+            )
+        else:
+            # Telegram refuses long polling while a webhook is set.
+            await bot.delete_webhook()
+            await dp.start_polling(
+                bot,
+                http_client=http_client,
+                chat_queue=chat_queue,
+            )
+
+    finally:
+        await chat_queue.close()
+        if callback_runner is not None:
+            await callback_runner.cleanup()
+        await http_client.aclose()
 
 
 if __name__ == "__main__":
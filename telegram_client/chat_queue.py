@@ -0,0 +1,156 @@
+import asyncio
+import collections
+import logging
+import typing
+
+from aiogram.types import Message
+
+ReleaseSlot = typing.Callable[[], None]
+AnswerMessages = typing.Callable[
+    [list[Message], ReleaseSlot],
+    typing.Awaitable[None],
+]
+NotifyQueued = typing.Callable[[Message], typing.Awaitable[None]]
+
+
+def merge_messages(messages: list[Message]) -> str | None:
+    """Join the text of messages answered as one query."""
+
+    texts = [message.text for message in messages if message.text]
+
+    return "\n".join(texts) if texts else None
+
+
+class ChatQueue:
+    """
+    Answer every chat's messages in order, one query at a time.
+
+    aiogram runs handlers concurrently, so without this a user who sends
+    several messages quickly starts parallel queries racing on the same
+    server session. Each chat with pending messages gets one worker task.
+    With a `merge_window` above zero, messages sent within that many
+    seconds of each other, or while the previous answer was being
+    generated, are answered together as a single query.
+
+    A semaphore caps how many queries all chats run against the server at
+    once; a chat that has to wait for a slot is told so via
+    `notify_queued`. `answer` gets a callable that gives the slot back
+    early, once the server has taken the query and only waiting is left,
+    so queued jobs do not hold slots for as long as they take. The chat
+    still waits for the answer before its next query.
+    """
+
+    def __init__(
+            self,
+            answer: AnswerMessages,
+            notify_queued: NotifyQueued,
+            max_concurrent: int = 20,
+            merge_window: float = 0.0,
+    ):
+        self._answer = answer
+        self._notify_queued = notify_queued
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._merge_window = merge_window
+        self._pending: dict[int, collections.deque[Message]] = {}
+        self._last_arrival: dict[int, float] = {}
+        self._workers: dict[int, asyncio.Task] = {}
+        self._answering: set[int] = set()
+
+    def submit(self, message: Message) -> bool:
+        """
+        Queue `message` for its chat. Returns True when it is the first
+        one waiting behind a query still being answered, so the caller can
+        tell the user it was queued.
+        """
+
+        chat_id = message.chat.id
+        pending = self._pending.setdefault(chat_id, collections.deque())
+        pending.append(message)
+        self._last_arrival[chat_id] = asyncio.get_running_loop().time()
+
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(
+                self._drain(chat_id),
+            )
+
+        return chat_id in self._answering and len(pending) == 1
+
+    async def notify(self, message: Message) -> None:
+        """Tell the chat its message is queued; failing to is not fatal."""
+
+        try:
+            await self._notify_queued(message)
+
+        except Exception as e:
+            logging.warning(f"Could not notify chat {message.chat.id}: {e}")
+
+    async def _next_batch(self, chat_id: int) -> list[Message]:
+        pending = self._pending[chat_id]
+        if self._merge_window <= 0:
+            return [pending.popleft()]
+
+        loop = asyncio.get_running_loop()
+        # Wait until the chat has been quiet for a whole window.
+        while True:
+            quiet_for = loop.time() - self._last_arrival[chat_id]
+            if quiet_for >= self._merge_window:
+                break
+
+            await asyncio.sleep(self._merge_window - quiet_for)
+
+        batch = list(pending)
+        pending.clear()
+
+        return batch
+
+    def _slot_releaser(self) -> ReleaseSlot:
+        """Release the acquired slot on the first call only."""
+
+        released = False
+
+        def release_slot() -> None:
+            nonlocal released
+            if not released:
+                released = True
+                self._slots.release()
+
+        return release_slot
+
+    async def _drain(self, chat_id: int) -> None:
+        pending = self._pending[chat_id]
+
+        try:
+            while pending:
+                batch = await self._next_batch(chat_id)
+
+                if self._slots.locked():
+                    await self.notify(batch[-1])
+
+                await self._slots.acquire()
+                release_slot = self._slot_releaser()
+                self._answering.add(chat_id)
+                try:
+                    await self._answer(batch, release_slot)
+
+                except Exception as e:
+                    logging.exception(f"Error answering chat {chat_id}: {e}")
+
+                finally:
+                    self._answering.discard(chat_id)
+                    release_slot()
+
+        finally:
+            # Nothing awaits between the empty check and here, so a new
+            # message either made it into `pending` or starts a new worker.
+            del self._workers[chat_id]
+            del self._pending[chat_id]
+            del self._last_arrival[chat_id]
+
+    async def close(self) -> None:
+        """Cancel the chats still waiting or being answered."""
+
+        workers = list(self._workers.values())
+        for worker in workers:
+            worker.cancel()
+
+        await asyncio.gather(*workers, return_exceptions=True)
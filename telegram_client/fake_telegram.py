@@ -0,0 +1,328 @@
+"""
+Offline stand-in for Telegram and the legal assistant server.
+
+Starts a fake Bot API and a fake answer server, sends updates from a few
+simulated chats to the bot and checks what comes back. Run the bot against
+it with, e.g.:
+
+    TELEGRAM_API_URL=http://localhost:8081 SERVER_HOST=http://localhost:8082 \\
+    BOT_TOKEN=123456:fake BOT_MODE=webhook WEBHOOK_SECRET=fake-secret \\
+    python asgi.py
+
+and then:
+
+    python fake_telegram.py --mode webhook --secret fake-secret
+
+Every replica of a webhook deployment can be pointed at the same fakes with
+--replicas; the updates then go to the load balancer's URL via --webhook-url.
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import sys
+import time
+import typing
+
+import httpx
+
+from aiohttp import web
+
+from webhook import SECRET_HEADER
+
+ANSWER_PREFIX = "Resposta: "
+
+
+class FakeTelegram:
+    """
+    The Bot API methods the bot calls, answering like Telegram would, and
+    recording every message it sends or edits per chat.
+    """
+
+    def __init__(self):
+        self.sent: dict[int, list[str]] = collections.defaultdict(list)
+        self.webhook: dict[str, typing.Any] = {}
+        self.webhook_registrations = 0
+        self._updates: asyncio.Queue = asyncio.Queue()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def make_update(self, chat_id: int, text: str) -> dict[str, typing.Any]:
+        user = {"id": chat_id, "is_bot": False, "first_name": f"Chat{chat_id}"}
+
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {**user, "type": "private"},
+                "from": user,
+                "text": text,
+            },
+        }
+
+    def enqueue_update(self, update: dict[str, typing.Any]) -> None:
+        """Make `update` available to a bot using long polling."""
+
+        self._updates.put_nowait(update)
+
+    def _message(self, chat_id: int, text: str) -> dict[str, typing.Any]:
+        self.sent[chat_id].append(text)
+
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "Fake"},
+            "text": text,
+        }
+
+    async def _get_updates(self, params: dict) -> list:
+        try:
+            update = await asyncio.wait_for(
+                self._updates.get(),
+                float(params.get("timeout", 0)) or 0.1,
+            )
+
+        except TimeoutError:
+            return []
+
+        updates = [update]
+        while not self._updates.empty():
+            updates.append(self._updates.get_nowait())
+
+        return updates
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        if not params and request.can_read_body:
+            params = await request.json()
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Fake"}
+        elif method == "getUpdates":
+            result = await self._get_updates(params)
+        elif method == "setWebhook":
+            self.webhook = params
+            self.webhook_registrations += 1
+            result = True
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(int(params["chat_id"]), params["text"])
+        else:
+            # setMyCommands, deleteWebhook, sendChatAction, ...
+            result = True
+
+        return web.json_response({"ok": True, "result": result})
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+
+        return app
+
+
+class FakeServer:
+    """
+    Answers /query/ and /query/stream/ after `latency` seconds and tracks
+    how many queries per user run at the same time.
+    """
+
+    def __init__(self, latency: float = 0.5):
+        self.latency = latency
+        self.queries: dict[int, list[str]] = collections.defaultdict(list)
+        self.max_in_flight: dict[int, int] = collections.defaultdict(int)
+        self._in_flight: dict[int, int] = collections.defaultdict(int)
+
+    async def _answer(self, data: dict[str, typing.Any]) -> str:
+        user_id = int(data["user_id"])
+        self.queries[user_id].append(data["query"])
+        self._in_flight[user_id] += 1
+        self.max_in_flight[user_id] = max(
+            self.max_in_flight[user_id],
+            self._in_flight[user_id],
+        )
+
+        try:
+            await asyncio.sleep(self.latency)
+
+        finally:
+            self._in_flight[user_id] -= 1
+
+        return ANSWER_PREFIX + data["query"]
+
+    async def query(self, request: web.Request) -> web.Response:
+        answer = await self._answer(await request.json())
+
+        return web.json_response({"response": answer})
+
+    async def query_stream(self, request: web.Request) -> web.StreamResponse:
+        answer = await self._answer(await request.json())
+
+        response = web.StreamResponse(
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+        await response.prepare(request)
+        for event in (
+            {"type": "delta", "text": answer},
+            {"type": "final", "response": answer},
+        ):
+            await response.write(json.dumps(event).encode("utf-8") + b"\n")
+        await response.write_eof()
+
+        return response
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/query/", self.query)
+        app.router.add_post("/query/stream/", self.query_stream)
+
+        return app
+
+
+async def _start(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+
+    return runner
+
+
+def check_chats(
+        telegram: FakeTelegram,
+        server: FakeServer,
+        expected: dict[int, list[str]],
+) -> list[str]:
+    """Describe every chat answered out of order, concurrently or not at all."""
+
+    problems = []
+    for chat_id, texts in expected.items():
+        asked = "\n".join(server.queries[chat_id]).split("\n")
+        if asked != texts:
+            problems.append(f"chat {chat_id} asked {asked}, sent {texts}")
+
+        if server.max_in_flight[chat_id] > 1:
+            problems.append(
+                f"chat {chat_id} ran {server.max_in_flight[chat_id]} "
+                "queries at once"
+            )
+
+        answered = [
+            text for text in telegram.sent[chat_id]
+            if text.startswith(ANSWER_PREFIX)
+        ]
+        if not answered:
+            problems.append(f"chat {chat_id} got no answer")
+
+    return problems
+
+
+async def run_harness(args: argparse.Namespace) -> int:
+    telegram = FakeTelegram()
+    server = FakeServer(latency=args.latency)
+    runners = [
+        await _start(telegram.create_app(), args.telegram_port),
+        await _start(server.create_app(), args.server_port),
+    ]
+    webhook_url = args.webhook_url
+
+    try:
+        if args.mode == "webhook":
+            print(f"Waiting for {args.replicas} bot replicas to start...")
+            while telegram.webhook_registrations < args.replicas:
+                await asyncio.sleep(0.1)
+
+            webhook_url = webhook_url or telegram.webhook["url"]
+
+        expected: dict[int, list[str]] = {}
+        async with httpx.AsyncClient(timeout=10.0) as client:
+            for burst in range(args.messages):
+                for chat in range(args.chats):
+                    chat_id = 1000 + chat
+                    text = f"Pergunta {burst + 1} do chat {chat_id}"
+                    expected.setdefault(chat_id, []).append(text)
+                    update = telegram.make_update(chat_id, text)
+
+                    if args.mode == "polling":
+                        telegram.enqueue_update(update)
+                        continue
+
+                    response = await client.post(
+                        webhook_url,
+                        json=update,
+                        headers={SECRET_HEADER: args.secret},
+                    )
+                    response.raise_for_status()
+
+                await asyncio.sleep(args.interval)
+
+        # Wait for the last question of every chat to be answered.
+        deadline = time.monotonic() + args.timeout
+        while time.monotonic() < deadline:
+            if all(
+                any(texts[-1] in sent for sent in telegram.sent[chat_id])
+                for chat_id, texts in expected.items()
+            ):
+                break
+
+            await asyncio.sleep(0.1)
+
+        problems = check_chats(telegram, server, expected)
+        queries = sum(len(queries) for queries in server.queries.values())
+        print(
+            f"{args.chats} chats sent {args.chats * args.messages} "
+            f"messages, answered in {queries} queries."
+        )
+        for problem in problems:
+            print(f"  {problem}")
+
+        return 1 if problems else 0
+
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--mode",
+        choices=("webhook", "polling"),
+        default="webhook",
+    )
+    parser.add_argument(
+        "--webhook-url",
+        help="Where updates go, e.g. a load balancer in front of replicas; "
+        "by default the URL the bot registered.",
+    )
+    parser.add_argument(
+        "--replicas",
+        type=int,
+        default=1,
+        help="Bot replicas that register a webhook before updates are sent.",
+    )
+    parser.add_argument("--secret", default="fake-secret")
+    parser.add_argument("--chats", type=int, default=5)
+    parser.add_argument("--messages", type=int, default=3)
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.2,
+        help="Seconds between one message from every chat and the next.",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.5,
+        help="Seconds the fake server takes to answer.",
+    )
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--telegram-port", type=int, default=8081)
+    parser.add_argument("--server-port", type=int, default=8082)
+
+    sys.exit(asyncio.run(run_harness(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
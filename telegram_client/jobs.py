@@ -0,0 +1,170 @@
+import asyncio
+import collections
+import hashlib
+import hmac
+import json
+import logging
+import typing
+
+import httpx
+
+from aiohttp import web
+
+CALLBACK_SIGNATURE_HEADER = "X-Job-Callback-Signature"
+# Callbacks that arrive before the server's 202 response has been read, and
+# jobs given up on, whose callbacks are refused.
+EARLY_RESULTS_LIMIT = 1000
+ABANDONED_JOBS_LIMIT = 1000
+
+
+class JobWaiter:
+    """
+    Wait for answers the server generates in the background.
+
+    With `callback_url` set, the server's worker POSTs each result to this
+    process, which `serve` listens for; /jobs/<job_id> is polled only if no
+    callback arrives in time. Without a `callback_url`, that endpoint is
+    polled every `poll_interval` seconds. Callbacks must carry an
+    HMAC-SHA256 of their body, keyed with the `secret` shared with the
+    workers, in the X-Job-Callback-Signature header.
+    """
+
+    def __init__(
+            self,
+            http_client: httpx.AsyncClient,
+            callback_url: str | None = None,
+            secret: str | None = None,
+            timeout: float = 300.0,
+            poll_interval: float = 2.0,
+    ):
+        self.callback_url = callback_url
+        self._http_client = http_client
+        self._secret = secret
+        self._timeout = timeout
+        self._poll_interval = poll_interval
+        self._waiters: dict[str, asyncio.Future] = {}
+        self._early_results: collections.OrderedDict[str, dict] = (
+            collections.OrderedDict()
+        )
+        self._abandoned: collections.OrderedDict[str, None] = (
+            collections.OrderedDict()
+        )
+
+    @property
+    def timeout(self) -> float:
+        return self._timeout
+
+    async def handle_callback(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        if self._secret is not None:
+            signature = hmac.new(
+                self._secret.encode("utf-8"),
+                body,
+                hashlib.sha256,
+            ).hexdigest()
+            received = request.headers.get(CALLBACK_SIGNATURE_HEADER, "")
+            if not hmac.compare_digest(received, signature):
+                return web.Response(status=401, text="Unauthorized")
+
+        try:
+            result = json.loads(body)
+            job_id = result["job_id"]
+
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400, text="Bad Request")
+
+        if not isinstance(job_id, str):
+            return web.Response(status=400, text="Bad Request")
+
+        if job_id in self._abandoned:
+            # The user was already told it failed.
+            del self._abandoned[job_id]
+
+            return web.Response(status=410, text="Gone")
+
+        waiter = self._waiters.get(job_id)
+        if waiter is not None:
+            if not waiter.done():
+                waiter.set_result(result)
+
+        else:
+            self._early_results[job_id] = result
+            if len(self._early_results) > EARLY_RESULTS_LIMIT:
+                self._early_results.popitem(last=False)
+
+        return web.Response(text="OK")
+
+    async def _poll(self, job_id: str) -> dict[str, typing.Any] | None:
+        response = await self._http_client.get(f"/jobs/{job_id}")
+        response.raise_for_status()
+        job = response.json()
+
+        return job if job["status"] in ("done", "failed") else None
+
+    async def _wait_for_callback(
+            self,
+            job_id: str,
+    ) -> dict[str, typing.Any] | None:
+        result = self._early_results.pop(job_id, None)
+        if result is not None:
+            return result
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[job_id] = waiter
+        try:
+            return await asyncio.wait_for(waiter, self._timeout)
+
+        except TimeoutError:
+            # The callback may have been lost; the result may not.
+            result = await self._poll(job_id)
+            if result is None:
+                self._abandoned[job_id] = None
+                if len(self._abandoned) > ABANDONED_JOBS_LIMIT:
+                    self._abandoned.popitem(last=False)
+
+            return result
+
+        finally:
+            del self._waiters[job_id]
+
+    async def _wait_by_polling(
+            self,
+            job_id: str,
+    ) -> dict[str, typing.Any] | None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._timeout
+        while loop.time() < deadline:
+            await asyncio.sleep(self._poll_interval)
+            result = await self._poll(job_id)
+            if result is not None:
+                return result
+
+        return None
+
+    async def wait(self, job_id: str) -> dict[str, typing.Any]:
+        """
+        The job's result: its `status` ("done" or "failed"), the HTTP
+        status `code` a synchronous /query/ would have returned, and that
+        `response`. Raises TimeoutError if the job does not finish in time.
+        """
+
+        if self.callback_url:
+            result = await self._wait_for_callback(job_id)
+        else:
+            result = await self._wait_by_polling(job_id)
+
+        if result is None:
+            raise TimeoutError(f"Job {job_id} did not finish in time")
+
+        return result
+
+    async def serve(self, host: str, port: int) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_post("/jobs/callback", self.handle_callback)
+
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logging.info(f"Job callbacks listening on {host}:{port}")
+
+        return runner
@@ -0,0 +1,192 @@
+import asyncio
+import hmac
+import logging
+import signal
+import typing
+
+import httpx
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Marks updates another replica passed on, so they are never passed on again.
+FORWARDED_HEADER = "X-Bot-Replica-Forwarded"
+
+
+def update_chat_id(update: Update) -> int | None:
+    if update.message is not None:
+        return update.message.chat.id
+
+    if update.callback_query is not None:
+        if update.callback_query.message is not None:
+            return update.callback_query.message.chat.id
+
+        return update.callback_query.from_user.id
+
+    return None
+
+
+class WebhookServer:
+    """
+    Receive Telegram updates over HTTP and feed them to the dispatcher.
+
+    Telegram delivers each update once, to whichever replica the load
+    balancer picks, but the chat queue only orders the messages of a chat
+    within one process. So every chat has an owner among `replicas`, the
+    base URLs of all replicas in the same order everywhere, and updates
+    reaching any other replica are passed on to it. When the owner cannot
+    be reached the update is handled where it landed: answered, if maybe
+    out of order.
+
+    Updates are acknowledged as soon as they are scheduled, so Telegram
+    never waits for an answer to be generated.
+    """
+
+    def __init__(
+            self,
+            dispatcher: Dispatcher,
+            bot: Bot,
+            secret: str,
+            path: str = "/telegram/webhook",
+            replicas: list[str] | None = None,
+            replica: str | None = None,
+            **handler_kwargs: typing.Any,
+    ):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.path = path
+        self._secret = secret
+        self._replicas = replicas or []
+        self._replica = replica
+        self._handler_kwargs = handler_kwargs
+        self._tasks: set[asyncio.Task] = set()
+        self._peer_client: httpx.AsyncClient | None = None
+
+        if self._replicas and replica not in self._replicas:
+            logging.warning(
+                f"Replica {replica} is not among {self._replicas}; "
+                "it will pass on every chat's updates."
+            )
+
+    def _owner(self, chat_id: int | None) -> str | None:
+        if chat_id is None or len(self._replicas) < 2:
+            return self._replica
+
+        return self._replicas[chat_id % len(self._replicas)]
+
+    async def _feed(self, update: Update) -> None:
+        try:
+            await self.dispatcher.feed_update(
+                self.bot,
+                update,
+                **self._handler_kwargs,
+            )
+
+        except Exception as e:
+            logging.exception(f"Error handling update {update.update_id}: {e}")
+
+    def _schedule(self, update: Update) -> None:
+        task = asyncio.create_task(self._feed(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _forward(self, owner: str, body: bytes) -> bool:
+        try:
+            response = await self._peer_client.post(
+                owner + self.path,
+                content=body,
+                headers={
+                    "Content-Type": "application/json",
+                    SECRET_HEADER: self._secret,
+                    FORWARDED_HEADER: "1",
+                },
+            )
+
+            return response.status_code == 200
+
+        except httpx.HTTPError as e:
+            logging.warning(f"Could not pass update on to {owner}: {e}")
+
+            return False
+
+    async def handle(self, request: web.Request) -> web.Response:
+        received_secret = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(received_secret, self._secret):
+            return web.Response(status=401, text="Unauthorized")
+
+        body = await request.read()
+        try:
+            update = Update.model_validate_json(
+                body,
+                context={"bot": self.bot},
+            )
+
+        except ValueError:
+            return web.Response(status=400, text="Invalid update")
+
+        owner = self._owner(update_chat_id(update))
+        if (
+            owner != self._replica
+            and FORWARDED_HEADER not in request.headers
+            and await self._forward(owner, body)
+        ):
+            return web.Response(text="OK")
+
+        self._schedule(update)
+
+        return web.Response(text="OK")
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+
+        return app
+
+    async def run(self, host: str = "0.0.0.0", port: int = 8080) -> None:
+        """
+        Serve until SIGTERM/SIGINT, then let running updates finish.
+
+        Like `Dispatcher.start_polling`, runs the dispatcher's startup and
+        shutdown handlers around serving and closes the bot's session.
+        """
+
+        workflow_data = {
+            "dispatcher": self.dispatcher,
+            "bots": [self.bot],
+            **self.dispatcher.workflow_data,
+            **self._handler_kwargs,
+        }
+        await self.dispatcher.emit_startup(bot=self.bot, **workflow_data)
+
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signal_number, stopped.set)
+
+        self._peer_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout=5.0, connect=1.0),
+        )
+        runner = web.AppRunner(self.create_app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logging.info(f"Webhook listening on {host}:{port}{self.path}")
+
+        try:
+            await stopped.wait()
+
+        finally:
+            await runner.cleanup()
+            await self._peer_client.aclose()
+            if self._tasks:
+                await asyncio.wait(self._tasks)
+
+            try:
+                await self.dispatcher.emit_shutdown(
+                    bot=self.bot,
+                    **workflow_data,
+                )
+
+            finally:
+                await self.bot.session.close()